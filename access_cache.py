@@ -0,0 +1,229 @@
+import asyncio
+import datetime
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from sqlalchemy import delete, func, insert, select
+
+from config import (
+    ACCESS_CACHE_TTL, ACCESS_CACHE_MAX_SIZE, ACCESS_INVALIDATION_INTERVAL, ACCESS_INVALIDATION_RETENTION
+)
+from database import get_async_db
+from models import AccessInvalidation, User, Subscription, Whitelist
+
+logger = logging.getLogger(__name__)
+
+def _as_utc(value: datetime.datetime | None) -> datetime.datetime | None:
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+@dataclass(slots=True)
+class AccessRecord:
+    """Сжатое решение о доступе пользователя к курсу."""
+    user: User | None
+    whitelisted: bool
+    whitelist_expires_at: datetime.datetime | None
+    subscription_end: datetime.datetime | None
+    cached_until: datetime.datetime
+
+    @property
+    def registered(self) -> bool:
+        return bool(self.user and self.user.email and not self.user.email.startswith("temp_"))
+
+    @property
+    def active(self) -> bool:
+        return bool(self.user and self.user.is_active)
+
+    def is_whitelisted(self, now: datetime.datetime) -> bool:
+        return self.whitelisted and (self.whitelist_expires_at is None or self.whitelist_expires_at > now)
+
+    def has_subscription(self, now: datetime.datetime) -> bool:
+        return self.subscription_end is not None and self.subscription_end > now
+
+    def has_access(self, now: datetime.datetime) -> bool:
+        return self.is_whitelisted(now) or self.has_subscription(now)
+
+class AccessCache:
+    """
+    Кэш решений о доступе в памяти процесса по telegram_id.
+
+    Запись живёт не дольше ACCESS_CACHE_TTL и не дольше окончания подписки
+    или записи в белом списке. При оплате, отмене подписки и изменении белого
+    списка запись нужно сбрасывать явно: invalidate_access() — в своем
+    процессе, publish_access_change() — во всех остальных (см.
+    InvalidationPoller). Изменение из другого процесса видно не позже чем
+    через ACCESS_INVALIDATION_INTERVAL секунд; если опрос не работает —
+    через ACCESS_CACHE_TTL.
+    """
+
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.max_size = max_size
+        self._records: OrderedDict[int, AccessRecord] = OrderedDict()
+        # Админ-панель работает в потоках того же процесса (run.py)
+        self._lock = threading.Lock()
+
+    def get(self, telegram_id: int, now: datetime.datetime) -> AccessRecord | None:
+        with self._lock:
+            record = self._records.get(telegram_id)
+            if record is None:
+                return None
+            if record.cached_until <= now:
+                del self._records[telegram_id]
+                return None
+            self._records.move_to_end(telegram_id)
+            return record
+
+    def put(self, telegram_id: int, record: AccessRecord):
+        with self._lock:
+            self._records[telegram_id] = record
+            self._records.move_to_end(telegram_id)
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+
+    def invalidate(self, telegram_id: int):
+        with self._lock:
+            self._records.pop(telegram_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+access_cache = AccessCache(ACCESS_CACHE_TTL, ACCESS_CACHE_MAX_SIZE)
+
+async def load_access(telegram_id: int) -> AccessRecord:
+    """Читает решение о доступе из БД (пользователь, белый список, подписка)."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    async with get_async_db() as db:
+        user = await db.scalar(select(User).where(User.telegram_id == telegram_id))
+        whitelist_entry = None
+        subscription_end = None
+        if user:
+            whitelist_entry = await db.scalar(select(Whitelist).where(Whitelist.telegram_id == telegram_id))
+            subscription_end = await db.scalar(
+                select(Subscription.end_date)
+                .where(Subscription.user_id == user.id)
+                .where(Subscription.end_date > now)
+                .where(Subscription.is_active == True)
+                .order_by(Subscription.end_date.desc())
+                .limit(1)
+            )
+
+    whitelist_expires_at = _as_utc(whitelist_entry.expires_at) if whitelist_entry else None
+    subscription_end = _as_utc(subscription_end)
+    cached_until = now + access_cache.ttl
+    for deadline in (whitelist_expires_at, subscription_end):
+        if deadline is not None and deadline < cached_until:
+            cached_until = deadline
+
+    return AccessRecord(
+        user=user,
+        whitelisted=whitelist_entry is not None,
+        whitelist_expires_at=whitelist_expires_at,
+        subscription_end=subscription_end,
+        cached_until=cached_until
+    )
+
+async def get_access(telegram_id: int) -> AccessRecord:
+    """Возвращает решение о доступе из кэша, при промахе — из БД."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    record = access_cache.get(telegram_id, now)
+    if record is not None:
+        return record
+    record = await load_access(telegram_id)
+    # Незарегистрированных не кэшируем: после ввода email они сразу должны получить доступ
+    if record.user is not None:
+        access_cache.put(telegram_id, record)
+    return record
+
+def invalidate_access(telegram_id: int | None):
+    """Сбрасывает запись кэша в текущем процессе (вызывать после commit)."""
+    if telegram_id is None:
+        return
+    logger.debug(f"Access cache invalidated for {telegram_id}")
+    access_cache.invalidate(telegram_id)
+
+def publish_access_change(db, telegram_id: int | None):
+    """Сообщает остальным процессам об изменении доступа, в транзакции db (синхронная сессия), без commit."""
+    if telegram_id is not None:
+        db.execute(insert(AccessInvalidation).values(telegram_id=telegram_id))
+
+async def publish_access_change_async(db, telegram_id: int | None):
+    """То же для асинхронной сессии: сброс публикуется атомарно вместе с изменением."""
+    if telegram_id is not None:
+        await db.execute(insert(AccessInvalidation).values(telegram_id=telegram_id))
+
+# Окно повторного чтения: строка транзакции, начатой раньше, но зафиксированной позже
+# предыдущего опроса, получает более ранний created_at и иначе была бы пропущена
+INVALIDATION_OVERLAP = datetime.timedelta(seconds=30)
+
+class InvalidationPoller:
+    """
+    Сброс кэша доступа по изменениям из других процессов.
+
+    Раз в interval секунд читает строки access_invalidations, появившиеся
+    после прошлого опроса (по часам БД, с перекрытием INVALIDATION_OVERLAP),
+    и сбрасывает соответствующие записи кэша. Строки старше retention секунд
+    удаляются — их удаление в нескольких процессах безопасно.
+    """
+
+    def __init__(self, interval: float, retention: int):
+        self.interval = interval
+        self.retention = datetime.timedelta(seconds=retention)
+        self.invalidated = 0
+        self._since: datetime.datetime | None = None
+        self._seen: set[int] = set()
+        self._pruned_at: datetime.datetime | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при чтении сбросов кэша доступа: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def poll(self) -> int:
+        """Один опрос; возвращает число сброшенных записей."""
+        async with get_async_db() as db:
+            now = await db.scalar(select(func.now()))
+            if self._since is None:
+                # Первый опрос: кэш процесса еще пуст, прошлые изменения не нужны
+                self._since = self._pruned_at = now
+                return 0
+            rows = (await db.execute(
+                select(AccessInvalidation.id, AccessInvalidation.telegram_id)
+                .where(AccessInvalidation.created_at >= self._since - INVALIDATION_OVERLAP)
+            )).all()
+            if now - self._pruned_at >= self.retention:
+                await db.execute(delete(AccessInvalidation).where(AccessInvalidation.created_at < now - self.retention))
+                await db.commit()
+                self._pruned_at = now
+        count = 0
+        for row in rows:
+            if row.id not in self._seen:
+                access_cache.invalidate(row.telegram_id)
+                count += 1
+        # Строки окна прочитаются и в следующий раз; повторно их не применяем
+        self._seen = {row.id for row in rows}
+        self._since = now
+        self.invalidated += count
+        return count
+
+access_invalidations = InvalidationPoller(ACCESS_INVALIDATION_INTERVAL, ACCESS_INVALIDATION_RETENTION)
@@ -6,15 +6,25 @@ from functools import wraps
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 sys.path.insert(0, project_root)
 
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, session, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 import asyncio
-from config import DATABASE_URL, ADMIN_USERNAME, ADMIN_PASSWORD, BOT_TOKEN, TBANK_SECRET_KEY, ADMIN_TG_ACCOUNT
-from models import User, Subscription, Whitelist, SessionLocal, init_db, Referral, Admin, StopCommand, Payment, PaymentStatus, TariffPlan, PaymentMethod
+from config import DATABASE_URL, ADMIN_USERNAME, ADMIN_PASSWORD, BOT_TOKEN, TBANK_SECRET_KEY, ADMIN_TG_ACCOUNT, ADMIN_USERS_PAGE_SIZE, BROADCAST_MEDIA_MAX_SIZE
+from models import User, Subscription, Whitelist, SessionLocal, init_db, Referral, Admin, StopCommand, Payment, PaymentStatus, TariffPlan, PaymentMethod, BroadcastJob, BroadcastStatus
+from access_cache import invalidate_access, publish_access_change
+from send_queue import send_queue, PRIORITY_SERVICE
+from payment_scheduler import payment_scheduler
+from tbank import tbank_client
+import stats
+import analytics
+from export import EXPORTS, FORMATS, export_query, stream_export
+from broadcast import AUDIENCES, MAX_CAPTION_LENGTH, broadcast_worker, create_broadcast, save_media
 from aiogram import Bot
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, exists, func, or_
+from sqlalchemy.orm import aliased
 
 # Настройка логирования
 logging.basicConfig(level=logging.DEBUG)
@@ -85,7 +95,10 @@ def toggle_user_active(user_id):
                 flash("Пользователь не найден.", "error")
             else:
                 user.is_active = not user.is_active
+                stats.increment(db, {stats.USERS_ACTIVE: 1 if user.is_active else -1})
+                publish_access_change(db, user.telegram_id)
                 db.commit()
+                invalidate_access(user.telegram_id)
                 flash("Статус пользователя изменён.", "success")
     except Exception as e:
         app.logger.error(f"Ошибка при переключении статуса пользователя {user_id}: {e}")
@@ -110,6 +123,130 @@ def logout():
     session.pop('logged_in', None)
     return redirect(url_for('login'))
 
+def active_paid(subscription, now):
+    """Условие для подписки (или ее alias): активна, не закончилась и оплачена."""
+    paid = exists().where(Payment.subscription_id == subscription.id, Payment.status == PaymentStatus.COMPLETED)
+    return and_(subscription.is_active == True, subscription.end_date > now, paid)
+
+def subscription_ends(db, user_ids, now):
+    """{user_id: окончание последней активной оплаченной подписки} — только для пользователей страницы."""
+    if not user_ids:
+        return {}
+    return dict(db.query(Subscription.user_id, func.max(Subscription.end_date))
+        .filter(Subscription.user_id.in_(user_ids), active_paid(Subscription, now))
+        .group_by(Subscription.user_id)
+        .all())
+
+def users_by_registration(db, search, position, limit, now):
+    """Страница списка (user, end_date), сначала новые; окончания подписок — только для этой страницы."""
+    query = db.query(User)
+    if search is not None:
+        query = query.filter(search)
+    if position and position[0] is not None:
+        value, last_id = position
+        query = query.filter(or_(
+            User.registration_date < value,
+            and_(User.registration_date == value, User.id < last_id)
+        ))
+    page = query.order_by(User.registration_date.desc(), User.id.desc()).limit(limit).all()
+    ends = subscription_ends(db, [user.id for user in page], now)
+    return [(user, ends.get(user.id)) for user in page]
+
+def users_by_subscription_end(db, search, position, limit, now):
+    """
+    Страница списка (user, end_date), сначала поздние окончания подписок.
+
+    Подписки читаются по idx_sub_active_end от поздних окончаний, у каждого
+    пользователя берется только последняя, поэтому цена страницы зависит от
+    ее размера, а не от числа активных подписок. Пользователи без подписки
+    идут в конце, по убыванию id; курсор с пустым значением — уже они.
+    """
+    rows = []
+    if position is None or position[0] is not None:
+        later = aliased(Subscription)
+        query = (db.query(User, Subscription.end_date)
+            .join(User, User.id == Subscription.user_id)
+            .filter(active_paid(Subscription, now), ~exists().where(
+                later.user_id == Subscription.user_id,
+                active_paid(later, now),
+                or_(
+                    later.end_date > Subscription.end_date,
+                    and_(later.end_date == Subscription.end_date, later.id > Subscription.id)
+                )
+            )))
+        if search is not None:
+            query = query.filter(search)
+        if position:
+            value, last_id = position
+            query = query.filter(or_(
+                Subscription.end_date < value,
+                and_(Subscription.end_date == value, User.id < last_id)
+            ))
+        rows = query.order_by(Subscription.end_date.desc(), User.id.desc()).limit(limit).all()
+    if len(rows) < limit:
+        query = db.query(User).filter(~exists().where(Subscription.user_id == User.id, active_paid(Subscription, now)))
+        if search is not None:
+            query = query.filter(search)
+        if position and position[0] is None:
+            query = query.filter(User.id < position[1])
+        rows += [(user, None) for user in query.order_by(User.id.desc()).limit(limit - len(rows))]
+    return rows
+
+# Сортировки списка пользователей: ключ -> подпись в форме
+USER_SORTS = {
+    'registered': 'Сначала новые',
+    'subscription_end': 'По окончанию подписки'
+}
+MAX_USERS_PAGE_SIZE = 500
+MAX_TELEGRAM_ID = 10 ** 16
+
+def telegram_id_prefix_filter(digits):
+    """Поиск по началу telegram_id диапазонами: 123 -> [123, 124), [1230, 1240), ... — работает по индексу."""
+    low, high = int(digits), int(digits) + 1
+    ranges = []
+    while low < MAX_TELEGRAM_ID:
+        ranges.append(and_(User.telegram_id >= low, User.telegram_id < high))
+        low, high = low * 10, high * 10
+        if low == 0:
+            break
+    return or_(*ranges)
+
+def lower_prefix_filter(column, prefix, dialect):
+    """
+    lower(column) начинается с prefix — по индексу на lower(column).
+
+    PostgreSQL применяет индекс text_pattern_ops к LIKE 'abc%'. SQLite
+    использует для LIKE только индексы с NOCASE, поэтому там — диапазон
+    [prefix, prefix + U+10FFFF): строки сравниваются побайтно, в порядке кодов.
+    """
+    expression = func.lower(column)
+    if dialect == 'postgresql':
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return expression.like(escaped + '%', escape='\\')
+    return and_(expression >= prefix, expression < prefix + '\U0010ffff')
+
+def user_search_filter(query, dialect):
+    """Поиск по началу email, username (без учета регистра) или telegram_id."""
+    prefix = query.lower()
+    conditions = [
+        lower_prefix_filter(User.email, prefix, dialect),
+        lower_prefix_filter(User.telegram_username, prefix.lstrip('@'), dialect)
+    ]
+    if query.isdigit() and int(query) < MAX_TELEGRAM_ID:
+        conditions.append(telegram_id_prefix_filter(query))
+    return or_(*conditions)
+
+def encode_cursor(value, user_id):
+    return f"{value.isoformat() if value else ''}_{user_id}"
+
+def decode_cursor(cursor):
+    """(значение ключа сортировки, id) или None для некорректного курсора."""
+    try:
+        value, user_id = cursor.rsplit('_', 1)
+        return (datetime.fromisoformat(value) if value else None), int(user_id)
+    except ValueError:
+        return None
+
 @app.route('/users')
 @login_required
 def users():
@@ -117,46 +254,55 @@ def users():
     try:
         db = next(get_db())
         logger.debug("Получен доступ к БД для /users")
-        
-        # Получаем всех пользователей и их статусы автоплатежей
-        users_data = []
-        users = db.query(User).all()
+
+        query = request.args.get('q', '').strip()
+        sort = request.args.get('sort', 'registered')
+        if sort not in USER_SORTS:
+            sort = 'registered'
+        per_page = min(max(request.args.get('per_page', ADMIN_USERS_PAGE_SIZE, type=int), 1), MAX_USERS_PAGE_SIZE)
+        cursor = request.args.get('after')
+        position = decode_cursor(cursor) if cursor else None
+
+        # Keyset-пагинация: следующая страница начинается после последней строки текущей
         now = datetime.now(MSK)
-        
-        for user in users:
-            stop_command = db.query(StopCommand).filter(StopCommand.telegram_id == user.telegram_id).first()
-            user_data = {
-                'user': user,
-                'autopayment_enabled': not bool(stop_command),
-                'active_subscription': None,
-                'subscription_end': None
-            }
-            
-            # Получаем активную подписку с проверкой платежа
-            active_sub = (db.query(Subscription)
-                .join(Payment, Subscription.payments)
-                .filter(
-                    Subscription.user_id == user.id,
-                    Subscription.end_date > now,
-                    Subscription.is_active == True,
-                    Payment.status == PaymentStatus.COMPLETED
-                )
-                .order_by(Subscription.end_date.desc())
-                .first())
-            
-            if active_sub:
-                user_data['active_subscription'] = active_sub
+        search = user_search_filter(query, db.get_bind().dialect.name) if query else None
+        load_page = users_by_subscription_end if sort == 'subscription_end' else users_by_registration
+        rows = load_page(db, search, position, per_page + 1, now)
+        next_cursor = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            user, end_date = rows[-1]
+            next_cursor = encode_cursor(end_date if sort == 'subscription_end' else user.registration_date, user.id)
+
+        # Отметки /stop — тоже только для пользователей страницы
+        stopped = {row.telegram_id for row in db.query(StopCommand.telegram_id)
+            .filter(StopCommand.telegram_id.in_([user.telegram_id for user, _ in rows]))}
+
+        users_data = []
+        for user, end_date in rows:
+            subscription_end = None
+            if end_date:
                 # Конвертируем время окончания подписки в московское
-                end_date_utc = active_sub.end_date
-                if end_date_utc.tzinfo is None:
-                    end_date_utc = end_date_utc.replace(tzinfo=timezone.utc)
-                user_data['subscription_end'] = end_date_utc.astimezone(MSK)
-                logger.debug(f"Найдена активная подписка для пользователя {user.id}: {active_sub.id}, окончание: {user_data['subscription_end']}")
-            
-            users_data.append(user_data)
-
-        logger.debug(f"Найдено {len(users)} пользователей")
-        return render_template('users.html', users_data=users_data)
+                if end_date.tzinfo is None:
+                    end_date = end_date.replace(tzinfo=timezone.utc)
+                subscription_end = end_date.astimezone(MSK)
+            users_data.append({
+                'user': user,
+                'autopayment_enabled': user.telegram_id not in stopped,
+                'subscription_end': subscription_end
+            })
+
+        logger.debug(f"Найдено {len(users_data)} пользователей")
+        return render_template(
+            'users.html',
+            users_data=users_data,
+            q=query,
+            sort=sort,
+            sorts=USER_SORTS,
+            per_page=per_page,
+            cursor=cursor,
+            next_cursor=next_cursor
+        )
     except Exception as e:
         logger.exception("Ошибка при получении списка пользователей:")
         flash(f'Ошибка при получении списка пользователей: {str(e)}', 'error')
@@ -176,8 +322,13 @@ def edit_user(user_id):
         if request.method == 'POST':
             user.referral_link_override = request.form.get('referral_link')
             user.referral_status_override = request.form.get('referral_status') == 'true'
-            user.is_active = request.form.get('is_active') == 'true'
+            is_active = request.form.get('is_active') == 'true'
+            if bool(user.is_active) != is_active:
+                stats.increment(db, {stats.USERS_ACTIVE: 1 if is_active else -1})
+            user.is_active = is_active
+            publish_access_change(db, user.telegram_id)
             db.commit()
+            invalidate_access(user.telegram_id)
             flash('Пользователь успешно обновлен', 'success')
             return redirect(url_for('users'))
         
@@ -198,7 +349,9 @@ def whitelist():
                     telegram_id = int(telegram_id)
                     whitelist_entry = Whitelist(telegram_id=telegram_id)
                     db.add(whitelist_entry)
+                    publish_access_change(db, telegram_id)
                     db.commit()
+                    invalidate_access(telegram_id)
                     flash('Telegram ID успешно добавлен в белый список', 'success')
                 except ValueError:
                     flash('Telegram ID должен быть числом', 'error')
@@ -218,8 +371,11 @@ def delete_whitelist(entry_id):
         db = next(get_db())
         entry = db.get(Whitelist, entry_id)
         if entry:
+            telegram_id = entry.telegram_id
             db.delete(entry)
+            publish_access_change(db, telegram_id)
             db.commit()
+            invalidate_access(telegram_id)
             flash('Запись успешно удалена из белого списка', 'success')
         else:
             flash('Запись не найдена', 'error')
@@ -266,18 +422,65 @@ def subscriptions():
         flash(f'Ошибка при получении информации о подписках: {str(e)}', 'error')
         return redirect(url_for('index'))
 
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_MAX_DAYS = 3660
+
+def analytics_range() -> tuple:
+    """Период из ?date_from=&date_to= (YYYY-MM-DD); по умолчанию — 30 дней по вчера."""
+    yesterday = datetime.now(MSK).date() - timedelta(days=1)
+    date_to = request.args.get('date_to')
+    date_to = datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else yesterday
+    date_from = request.args.get('date_from')
+    if date_from:
+        date_from = datetime.strptime(date_from, '%Y-%m-%d').date()
+    else:
+        date_from = date_to - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if date_from > date_to or (date_to - date_from).days >= ANALYTICS_MAX_DAYS:
+        raise ValueError('Некорректный период')
+    return date_from, date_to
+
+@app.route('/analytics')
+@login_required
+def analytics_page():
+    try:
+        date_from, date_to = analytics_range()
+    except ValueError:
+        flash('Укажите период в формате YYYY-MM-DD (не больше 10 лет)', 'error')
+        return redirect(url_for('analytics_page'))
+    db = next(get_db())
+    # Только дневные сводки: время ответа не зависит от объема payments
+    rows = analytics.load_rollups(db, date_from, date_to)
+    return render_template('analytics.html', rows=rows, summary=analytics.summarize(rows),
+                           date_from=date_from, date_to=date_to)
+
+@app.route('/api/analytics')
+@login_required
+def analytics_api():
+    try:
+        date_from, date_to = analytics_range()
+    except ValueError:
+        return jsonify({'error': 'Период — date_from и date_to в формате YYYY-MM-DD, не больше 10 лет'}), 400
+    db = next(get_db())
+    rows = analytics.load_rollups(db, date_from, date_to)
+    return jsonify({
+        'date_from': date_from.isoformat(),
+        'date_to': date_to.isoformat(),
+        'summary': analytics.summarize(rows),
+        'days': rows
+    })
+
 @app.route('/broadcast')
 @login_required
 def broadcast_page():
     try:
         db = next(get_db())
         users = db.query(User).filter(User.telegram_id.isnot(None)).all()
-        return render_template('broadcast.html', users=users)
+        jobs = db.query(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(20).all()
+        return render_template('broadcast.html', users=users, jobs=jobs, audiences=AUDIENCES)
     except Exception as e:
         flash(f'Ошибка при загрузке страницы рассылки: {str(e)}', 'error')
         return redirect(url_for('index'))
 
-# ВНИМАНИЕ: для production рассылку лучше делать через очередь задач (Celery, RQ) или отдельный сервис!
 async def send_message_async(user_id, text):
     try:
         logger.debug(f"Попытка отправить сообщение пользователю {user_id}")
@@ -289,6 +492,14 @@ async def send_message_async(user_id, text):
         return False, str(e)
 
 def send_message_sync(user_id, text):
+    # Если бот запущен в этом же процессе (run.py), отправляем через его очередь с учетом лимитов
+    if send_queue.running:
+        try:
+            send_queue.submit_threadsafe(user_id, priority=PRIORITY_SERVICE, text=text).result()
+            return True, None
+        except Exception as e:
+            logger.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+            return False, str(e)
     try:
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
@@ -302,71 +513,144 @@ def send_message_sync(user_id, text):
 @app.route('/send_broadcast', methods=['POST'])
 @login_required
 def send_broadcast():
-    if bot is None:
-        logger.error("Бот не инициализирован. Рассылка невозможна.")
-        flash('Ошибка: Бот не инициализирован.', 'error')
-        return redirect(url_for('broadcast_page'))
-
     try:
         message = request.form.get('message_text')
         broadcast_type = request.form.get('broadcast_type')
         selected_user_form_id = request.form.get('selected_user_id')
+        media = request.files.get('media')
 
         message_log = f"{message[:20]}..." if message else "[пустое сообщение]"
         logger.debug(f"Получен запрос на рассылку: тип={broadcast_type}, выбранный пользователь ID={selected_user_form_id}, сообщение='{message_log}'")
 
-        if not message:
+        media_data = None
+        if media and media.filename:
+            media_data = media.read()
+            if len(media_data) > BROADCAST_MEDIA_MAX_SIZE:
+                flash(f'Файл больше {BROADCAST_MEDIA_MAX_SIZE // (1024 * 1024)} МБ — Telegram его не примет', 'error')
+                return redirect(url_for('broadcast_page'))
+            if message and len(message) > MAX_CAPTION_LENGTH:
+                flash(f'Подпись к медиа не длиннее {MAX_CAPTION_LENGTH} символов', 'error')
+                return redirect(url_for('broadcast_page'))
+        elif not message:
             flash('Введите текст сообщения', 'error')
             return redirect(url_for('broadcast_page'))
+        if broadcast_type not in AUDIENCES:
+            broadcast_type = 'all'
 
-        db = next(get_db())
-        target_users = []
-
-        if broadcast_type == 'all':
-            target_users = db.query(User).filter(User.telegram_id.isnot(None)).all()
-            logger.debug(f"Выбраны все пользователи с telegram_id, найдено {len(target_users)}")
-        elif broadcast_type == 'selected' and selected_user_form_id:
+        target_user_id = None
+        if broadcast_type == 'selected':
             try:
-                user_id = int(selected_user_form_id)
-                user = db.query(User).filter(User.id == user_id, User.telegram_id.isnot(None)).first()
-                if user:
-                    target_users = [user]
-                else:
-                    logger.warning(f"Выбранный пользователь с ID {selected_user_form_id} не найден или не имеет telegram_id.")
-            except ValueError:
-                logger.warning(f"Некорректный ID пользователя: {selected_user_form_id}")
-        else:
-            # Если не выбран пользователь или не указан тип — всем
-            target_users = db.query(User).filter(User.telegram_id.isnot(None)).all()
-            logger.debug(f"Выбраны все пользователи с telegram_id, найдено {len(target_users)}")
+                target_user_id = int(selected_user_form_id)
+            except (TypeError, ValueError):
+                flash('Выберите пользователя для рассылки', 'error')
+                return redirect(url_for('broadcast_page'))
 
-        if not target_users:
-            flash('Нет пользователей для рассылки', 'error')
-            return redirect(url_for('broadcast_page'))
+        # Отправляет фоновый воркер бота; здесь только постановка в очередь
+        db = next(get_db())
+        media_id = None
+        if media_data:
+            # Файл загрузит в Telegram воркер, один раз; тот же файл в новой рассылке берется по file_id
+            media_id = save_media(db, media_data, media.filename, media.mimetype)
+        job_id = create_broadcast(db, message or '', broadcast_type, target_user_id, media_id)
+        flash(f'Рассылка #{job_id} поставлена в очередь. Прогресс — в таблице ниже.', 'success')
+        return redirect(url_for('broadcast_page'))
 
-        success_count = 0
-        error_count = 0
-        error_messages = []
+    except Exception as e:
+        logger.exception("Ошибка при создании рассылки:")
+        flash(f'Ошибка при создании рассылки: {str(e)}', 'error')
+        return redirect(url_for('broadcast_page'))
 
-        for user in target_users:
-            success, error = send_message_sync(user.telegram_id, message)
-            if success:
-                success_count += 1
-            else:
-                error_count += 1
-                error_messages.append(f"Пользователь {user.id}: {error}")
+@app.route('/broadcast/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_broadcast(job_id):
+    db = next(get_db())
+    canceled = (db.query(BroadcastJob)
+        .filter(
+            BroadcastJob.id == job_id,
+            BroadcastJob.status.in_([BroadcastStatus.PENDING, BroadcastStatus.RUNNING])
+        )
+        .update({BroadcastJob.status: BroadcastStatus.CANCELED, BroadcastJob.finished_at: datetime.now(timezone.utc)},
+                synchronize_session=False))
+    db.commit()
+    if canceled:
+        flash(f'Рассылка #{job_id} остановлена', 'success')
+    else:
+        flash(f'Рассылка #{job_id} уже завершена', 'warning')
+    return redirect(url_for('broadcast_page'))
+
+def parse_export_date(value: str | None, end: bool = False) -> datetime | None:
+    """Дата YYYY-MM-DD по Москве; для конца периода — начало следующего дня."""
+    if not value:
+        return None
+    day = datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=MSK)
+    return day + timedelta(days=1) if end else day
+
+@app.route('/export')
+@login_required
+def export_page():
+    return render_template('export.html', exports=EXPORTS, formats=FORMATS, statuses=list(PaymentStatus))
 
-        if error_count > 0:
-            flash(f'Рассылка завершена. Успешно: {success_count}, Ошибок: {error_count}. Подробности: {", ".join(error_messages)}', 'warning')
-        else:
-            flash(f'Рассылка успешно завершена. Отправлено сообщений: {success_count}', 'success')
+@app.route('/export/download')
+@login_required
+def export_download():
+    kind = request.args.get('kind', 'payments')
+    fmt = request.args.get('format', 'csv')
+    if kind not in EXPORTS or fmt not in FORMATS:
+        return jsonify({'error': 'Неизвестная выгрузка или формат'}), 400
+    try:
+        date_from = parse_export_date(request.args.get('date_from'))
+        date_to = parse_export_date(request.args.get('date_to'), end=True)
+        status = PaymentStatus(request.args['status']) if request.args.get('status') else None
+    except ValueError:
+        return jsonify({'error': 'Даты — в формате YYYY-MM-DD, статус — pending, completed или failed'}), 400
+    compress = request.args.get('gzip') in ('1', 'true', 'on')
+
+    # Ответ — генератор: строки читаются из БД по мере отправки, вся выгрузка в памяти не собирается
+    query = export_query(kind, date_from, date_to, status)
+    filename = f"{kind}_{datetime.now(MSK).strftime('%Y%m%d_%H%M')}.{fmt}" + ('.gz' if compress else '')
+    logger.info(f"Выгрузка {kind} ({fmt}{', gzip' if compress else ''}): {request.args.to_dict()}")
+    return Response(
+        stream_export(query, fmt, compress),
+        mimetype='application/gzip' if compress else FORMATS[fmt],
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'X-Accel-Buffering': 'no'  # nginx не копит ответ целиком
+        }
+    )
+
+@app.route('/api/broadcasts')
+@login_required
+def broadcasts_progress():
+    db = next(get_db())
+    jobs = db.query(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(20).all()
+    return jsonify({
+        'worker': broadcast_worker.stats(),
+        'jobs': [
+            {
+                'id': job.id,
+                'status': job.status.value,
+                'total': job.total,
+                'sent': job.sent,
+                'failed': job.failed
+            }
+            for job in jobs
+        ]
+    })
 
-        return redirect(url_for('broadcast_page'))
+@app.route('/api/send_queue')
+@login_required
+def send_queue_stats():
+    return jsonify(send_queue.stats())
 
-    except Exception as e:
-        logger.exception("Ошибка при выполнении рассылки:")
-        flash(f'Ошибка при выполнении рассылки: {str(e)}', 'error')
-        return redirect(url_for('broadcast_page'))
+@app.route('/api/payment_scheduler')
+@login_required
+def payment_scheduler_stats():
+    return jsonify(payment_scheduler.stats())
+
+@app.route('/api/tbank')
+@login_required
+def tbank_stats():
+    return jsonify(tbank_client.stats())
 
 @app.route('/user/<int:user_id>')
 @login_required
@@ -469,6 +753,11 @@ def manage_subscription(user_id):
                 if current_sub:
                     # Продлеваем существующую подписку
                     current_sub.end_date = now + duration
+                    if current_sub.tariff_id != selected_tariff.id:
+                        stats.increment(db, {
+                            stats.tariff_counter(current_sub.tariff_id): -1,
+                            stats.tariff_counter(selected_tariff.id): 1
+                        })
                     current_sub.tariff_id = selected_tariff.id
                 else:
                     # Создаем новую подписку
@@ -488,10 +777,20 @@ def manage_subscription(user_id):
                         amount=selected_tariff.price,
                         currency='RUB',
                         status=PaymentStatus.COMPLETED,
-                        payment_method=PaymentMethod.CARD
+                        payment_method=PaymentMethod.CARD,
+                        completed_at=now
                     )
                     db.add(new_payment)
+                    stats.increment(db, {
+                        stats.SUBSCRIPTIONS_TOTAL: 1,
+                        stats.SUBSCRIPTIONS_ACTIVE: 1,
+                        stats.tariff_counter(selected_tariff.id): 1,
+                        stats.PAYMENTS_COMPLETED: 1,
+                        stats.REVENUE_TOTAL: selected_tariff.price
+                    })
+                publish_access_change(db, user.telegram_id)
                 db.commit()
+                invalidate_access(user.telegram_id)
                 flash(f'Подписка успешно выдана/продлена на {duration_str}', 'success')
 
             elif action == 'cancel':
@@ -502,7 +801,12 @@ def manage_subscription(user_id):
                 ).all()
                 for sub in active_subs:
                     sub.is_active = False
+                stats.increment(db, {stats.SUBSCRIPTIONS_ACTIVE: -len(active_subs)})
+                publish_access_change(db, user.telegram_id)
                 db.commit()
+                invalidate_access(user.telegram_id)
+                for sub in active_subs:
+                    payment_scheduler.refresh_threadsafe(sub.id)
                 flash('Все активные подписки отменены', 'success')
 
             return redirect(url_for('user_details', user_id=user_id))
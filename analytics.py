@@ -0,0 +1,173 @@
+import argparse
+import asyncio
+import datetime
+import logging
+
+import pytz
+from sqlalchemy import exists, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import aliased
+
+from config import ANALYTICS_LOOKBACK_DAYS
+from database import get_async_db
+from models import DailyRollup, Payment, PaymentStatus, Subscription, payment_status_is
+
+logger = logging.getLogger(__name__)
+
+MSK = pytz.timezone('Europe/Moscow')  # границы суток в сводках — как в bot.py
+
+# Колонки сводки, которые отдают API и графики
+METRICS = [
+    'revenue', 'payments', 'new_subscriptions', 'renewals', 'failed_renewals', 'churned', 'active_subscribers'
+]
+
+def day_bounds(day: datetime.date) -> tuple[datetime.datetime, datetime.datetime]:
+    # Зону pytz нельзя передавать в tzinfo= — смещение берется через localize()
+    start = MSK.localize(datetime.datetime.combine(day, datetime.time.min))
+    end = MSK.localize(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min))
+    return start, end
+
+def _is_renewal():
+    """Платеж — продление, если у подписки уже был более ранний успешный платеж."""
+    earlier = aliased(Payment)
+    return exists().where(
+        earlier.subscription_id == Payment.subscription_id,
+        earlier.status == PaymentStatus.COMPLETED,
+        earlier.id < Payment.id
+    )
+
+def _is_paid():
+    """Подписка оплачена (брошенные попытки оплаты не считаются)."""
+    return exists().where(Payment.subscription_id == Subscription.id, Payment.status == PaymentStatus.COMPLETED)
+
+async def compute_day(db, day: datetime.date) -> dict:
+    """Метрики за сутки day по исходным таблицам; каждый запрос — диапазон по индексу."""
+    start, end = day_bounds(day)
+    is_renewal = _is_renewal()
+    payments, revenue, renewals = (await db.execute(
+        select(func.count(), func.coalesce(func.sum(Payment.amount), 0), func.count().filter(is_renewal))
+        .where(
+            payment_status_is(PaymentStatus.COMPLETED),
+            Payment.completed_at >= start,
+            Payment.completed_at < end
+        )
+    )).one()
+    failed_renewals = await db.scalar(
+        select(func.count())
+        .where(
+            Payment.status == PaymentStatus.FAILED,
+            Payment.created_at >= start,
+            Payment.created_at < end,
+            is_renewal
+        )
+    )
+    # Продление сдвигает end_date, поэтому закончившаяся в этот день подписка не продлена
+    churned = await db.scalar(
+        select(func.count())
+        .select_from(Subscription)
+        .where(Subscription.end_date >= start, Subscription.end_date < end, _is_paid())
+    )
+    active_subscribers = await db.scalar(
+        select(func.count(Subscription.user_id.distinct()))
+        .where(Subscription.start_date < end, Subscription.end_date >= end, _is_paid())
+    )
+    return {
+        'day': day,
+        'revenue': float(revenue),
+        'payments': payments,
+        'new_subscriptions': payments - renewals,
+        'renewals': renewals,
+        'failed_renewals': failed_renewals,
+        'churned': churned,
+        'active_subscribers': active_subscribers
+    }
+
+async def _save(db, values: dict):
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    statement = insert(DailyRollup).values(values)
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=['day'],
+        set_={**{name: statement.excluded[name] for name in METRICS}, 'updated_at': func.now()}
+    ))
+
+async def rollup_days(first: datetime.date, last: datetime.date) -> int:
+    """Пересчитывает сводки за дни first..last включительно; каждый день — своя короткая транзакция."""
+    day = first
+    count = 0
+    while day <= last:
+        async with get_async_db() as db:
+            await _save(db, await compute_day(db, day))
+            await db.commit()
+        day += datetime.timedelta(days=1)
+        count += 1
+    return count
+
+async def refresh_rollups(today: datetime.date | None = None) -> int:
+    """
+    Ночное обновление: дописывает сводки с последнего сохраненного дня по
+    вчерашний и пересчитывает последние ANALYTICS_LOOKBACK_DAYS дней —
+    поздние подтверждения оплат и продления после неудачных попыток меняют
+    недавние цифры. Пустую таблицу заполняет только за вчера; история —
+    командой python analytics.py.
+    """
+    today = today or datetime.datetime.now(MSK).date()
+    yesterday = today - datetime.timedelta(days=1)
+    async with get_async_db() as db:
+        last = await db.scalar(select(func.max(DailyRollup.day)))
+    first = yesterday
+    if last is not None:
+        first = min(last + datetime.timedelta(days=1), today - datetime.timedelta(days=ANALYTICS_LOOKBACK_DAYS))
+    return await rollup_days(first, yesterday)
+
+def load_rollups(db, date_from: datetime.date, date_to: datetime.date) -> list[dict]:
+    """Сводки за date_from..date_to (синхронная сессия админ-панели); исходные таблицы не читаются."""
+    rows = db.execute(
+        select(DailyRollup)
+        .where(DailyRollup.day >= date_from, DailyRollup.day <= date_to)
+        .order_by(DailyRollup.day)
+    ).scalars()
+    return [
+        {'day': row.day.isoformat(), **{name: getattr(row, name) for name in METRICS}}
+        for row in rows
+    ]
+
+def summarize(rows: list[dict]) -> dict:
+    """Итоги за период по дневным сводкам."""
+    renewals = sum(row['renewals'] for row in rows)
+    failed_renewals = sum(row['failed_renewals'] for row in rows)
+    return {
+        'revenue': round(sum(row['revenue'] for row in rows), 2),
+        'payments': sum(row['payments'] for row in rows),
+        'new_subscriptions': sum(row['new_subscriptions'] for row in rows),
+        'renewals': renewals,
+        'failed_renewals': failed_renewals,
+        # Доля списаний, прошедших успешно (повторные попытки считаются отдельно)
+        'renewal_success_rate': round(renewals / (renewals + failed_renewals), 4) if renewals + failed_renewals else None,
+        'churned': sum(row['churned'] for row in rows),
+        'active_subscribers': rows[-1]['active_subscribers'] if rows else 0
+    }
+
+async def _backfill(date_from: datetime.date | None, date_to: datetime.date | None) -> int:
+    if date_from is None:
+        async with get_async_db() as db:
+            first_payment = await db.scalar(select(func.min(Payment.created_at)))
+        if first_payment is None:
+            return 0
+        if first_payment.tzinfo is None:
+            first_payment = first_payment.replace(tzinfo=datetime.timezone.utc)
+        date_from = first_payment.astimezone(MSK).date()
+    date_to = date_to or datetime.datetime.now(MSK).date() - datetime.timedelta(days=1)
+    return await rollup_days(date_from, date_to)
+
+if __name__ == '__main__':
+    # Заполнение истории: python analytics.py [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Пересчет дневных сводок аналитики")
+    parser.add_argument('--from', dest='date_from', type=datetime.date.fromisoformat,
+                        help="первый день (по умолчанию — день первого платежа)")
+    parser.add_argument('--to', dest='date_to', type=datetime.date.fromisoformat,
+                        help="последний день (по умолчанию — вчера)")
+    args = parser.parse_args()
+    days = asyncio.run(_backfill(args.date_from, args.date_to))
+    logger.info(f"Дневные сводки пересчитаны: {days} дней")
@@ -2,12 +2,14 @@ from flask import Flask, render_template, request, redirect, url_for, flash, jso
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
-from models import User, Subscription, Payment, Referral, Admin, Whitelist, StopCommand, PaymentStatus, SubscriptionType
-from config import ADMIN_USERNAME, ADMIN_PASSWORD, ADMIN_EMAIL, JWT_SECRET_KEY
+from models import User, Subscription, Payment, Referral, Admin, Whitelist, StopCommand, SubscriptionType
+from config import ADMIN_USERNAME, ADMIN_PASSWORD, ADMIN_EMAIL, JWT_SECRET_KEY, ADMIN_USERS_PAGE_SIZE
 import jwt
 from functools import wraps
-from sqlalchemy import desc, func
+from sqlalchemy import desc
 from database import get_db
+from stats import stats_cache, increment, USERS_ACTIVE, SUBSCRIPTIONS_TOTAL, SUBSCRIPTIONS_ACTIVE
+from access_cache import invalidate_access, publish_access_change
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = JWT_SECRET_KEY
@@ -70,18 +72,13 @@ def logout():
 @login_required
 def index():
     with get_db() as db:
-        users = db.query(User).order_by(desc(User.registration_date)).all()
-        active_subs = db.query(func.count(Subscription.id)).filter_by(is_active=True).scalar()
-        total_users = db.query(func.count(User.id)).scalar()
-        active_users = db.query(func.count(User.id)).filter_by(is_active=True).scalar()
-        total_revenue = db.query(func.sum(Payment.amount)).filter_by(status=PaymentStatus.COMPLETED).scalar() or 0
-        
-        stats = {
-            'active_subscriptions': active_subs,
-            'total_users': total_users,
-            'active_users': active_users,
-            'total_revenue': total_revenue
-        }
+        # Последние зарегистрированные; полный список — на странице пользователей
+        users = (db.query(User)
+            .order_by(desc(User.registration_date), desc(User.id))
+            .limit(ADMIN_USERS_PAGE_SIZE)
+            .all())
+        # Счетчики из stats_counters вместо агрегатов по всем таблицам
+        stats = stats_cache.get(db)
         
         return render_template('index.html', users=users, stats=stats)
 
@@ -125,7 +122,10 @@ def toggle_user_status(user_id):
         user = db.query(User).filter_by(id=user_id).first()
         if user:
             user.is_active = not user.is_active
+            increment(db, {USERS_ACTIVE: 1 if user.is_active else -1})
+            publish_access_change(db, user.telegram_id)
             db.commit()
+            invalidate_access(user.telegram_id)
             return jsonify({'status': 'success', 'is_active': user.is_active})
     return jsonify({'status': 'error', 'message': 'Пользователь не найден'}), 404
 
@@ -135,9 +135,13 @@ def cancel_subscription(sub_id):
     with get_db() as db:
         sub = db.query(Subscription).filter_by(id=sub_id).first()
         if sub:
+            if sub.is_active:
+                increment(db, {SUBSCRIPTIONS_ACTIVE: -1})
             sub.is_active = False
             sub.is_auto_renewal = False
+            publish_access_change(db, sub.user.telegram_id)
             db.commit()
+            invalidate_access(sub.user.telegram_id)
             return jsonify({'status': 'success'})
     return jsonify({'status': 'error', 'message': 'Подписка не найдена'}), 404
 
@@ -162,6 +166,7 @@ def add_subscription(user_id):
         if current_sub:
             current_sub.is_active = False
             current_sub.is_auto_renewal = False
+            increment(db, {SUBSCRIPTIONS_ACTIVE: -1})
         
         # Создаем новую подписку
         new_sub = Subscription(
@@ -174,7 +179,10 @@ def add_subscription(user_id):
         )
         
         db.add(new_sub)
+        increment(db, {SUBSCRIPTIONS_TOTAL: 1, SUBSCRIPTIONS_ACTIVE: 1})
+        publish_access_change(db, user.telegram_id)
         db.commit()
+        invalidate_access(user.telegram_id)
         
         return jsonify({
             'status': 'success',
@@ -190,28 +198,7 @@ def add_subscription(user_id):
 @login_required
 def get_stats():
     with get_db() as db:
-        total_users = db.query(func.count(User.id)).scalar()
-        active_users = db.query(func.count(User.id)).filter_by(is_active=True).scalar()
-        total_subs = db.query(func.count(Subscription.id)).scalar()
-        active_subs = db.query(func.count(Subscription.id)).filter_by(is_active=True).scalar()
-        total_revenue = db.query(func.sum(Payment.amount)).filter_by(status=PaymentStatus.COMPLETED).scalar() or 0
-        
-        # Статистика по типам подписок
-        sub_types = db.query(
-            Subscription.subscription_type,
-            func.count(Subscription.id)
-        ).group_by(Subscription.subscription_type).all()
-        
-        sub_stats = {str(t.value): c for t, c in sub_types}
-        
-        return jsonify({
-            'total_users': total_users,
-            'active_users': active_users,
-            'total_subscriptions': total_subs,
-            'active_subscriptions': active_subs,
-            'total_revenue': total_revenue,
-            'subscription_types': sub_stats
-        })
+        return jsonify(stats_cache.get(db))
 
 if __name__ == '__main__':
     init_admin()
@@ -2,20 +2,23 @@ import asyncio
 import logging
 import re
 import datetime
+import inspect
+import multiprocessing
 from functools import wraps
-import aiohttp
+from aiohttp import web
 import uuid
-import hashlib
 from typing import Union
 import json
-from sqlalchemy import and_
+from collections import Counter
+from sqlalchemy import and_, case, delete, exists, or_, select, update
+from sqlalchemy.orm import aliased, joinedload, selectinload
 import pytz
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -26,6 +29,13 @@ from aiogram.types import (
 
 from config import (
     BOT_TOKEN,
+    BOT_MODE,
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_WORKERS,
     DEFAULT_REFERRAL_STATUS,
     ADMIN_TG_ACCOUNT,
     BOT_USERNAME,
@@ -36,22 +46,72 @@ from config import (
     COMPANY_ACCOUNT,
     COMPANY_SWIFT,
     COMPANY_IBAN,
-    TBANK_SHOP_ID,
-    TBANK_SECRET_KEY
+    FSM_STATE_TTL,
+    FSM_CLEANUP_INTERVAL,
+    RATE_LIMIT_REQUESTS,
+    RATE_LIMIT_PERIOD,
+    RENEWAL_CLAIM_TIMEOUT,
+    RENEWAL_SAVE_ATTEMPTS,
+    RENEWAL_SAVE_RETRY_DELAY,
+    TBANK_NOTIFICATION_URL,
+    TBANK_NOTIFICATION_PATH,
+    RECONCILE_INTERVAL,
+    RECONCILE_MIN_AGE,
+    RECONCILE_CONCURRENCY,
+    RECONCILE_PAGE_SIZE,
+    CHECKOUT_RETENTION,
+    CHECKOUT_GC_INTERVAL,
+    CHECKOUT_GC_BATCH_SIZE,
+    CHECKOUT_LINK_TTL,
+    STATS_RECOMPUTE_INTERVAL,
+    ANALYTICS_ROLLUP_HOUR
 )
-from database import init_db, get_db
-from models import User, Subscription, Whitelist, StopCommand, Payment, PaymentStatus, PaymentMethod, TariffPlan, SubscriptionType
+from database import init_async_db, get_async_db
+from access_cache import get_access, invalidate_access, publish_access_change_async, access_invalidations, AccessRecord
+from tbank import tbank_client, notification_waiters, TBankError, GatewayUnavailable, FAILED_STATUSES
+from fsm_storage import SQLAlchemyStorage
+from send_queue import send_queue, PRIORITY_PAYMENT
+from throttling import ThrottlingMiddleware
+from singleflight import SingleFlight
+from payment_scheduler import payment_scheduler
+from leader import scheduler_leader
+from broadcast import broadcast_worker
+import stats
+import analytics
+from models import User, Subscription, Whitelist, StopCommand, Payment, PaymentStatus, PaymentMethod, TariffPlan, SubscriptionType, payment_status_is
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-storage = MemoryStorage()
+storage = SQLAlchemyStorage(state_ttl=FSM_STATE_TTL)
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher(storage=storage)
 
+# Ограничение частоты запросов ставим перед FSM-middleware, чтобы лишние
+# обновления отсекались до чтения состояния и любых обращений к БД/шлюзу
+throttling = ThrottlingMiddleware(RATE_LIMIT_REQUESTS, RATE_LIMIT_PERIOD)
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(throttling)
+dp.update.outer_middleware(dp.fsm)
+
 SUBSCRIPTION_DURATION = datetime.timedelta(minutes=10)  # Тестовая длительность - 10 минут
+
+# Нажатия «Оплатить» одного пользователя, ожидающие общий вызов Init
+checkout_flight = SingleFlight()
+
 MSK = pytz.timezone('Europe/Moscow')
 
+@dp.startup()
+async def on_startup():
+    send_queue.start(bot)
+    # Сбросы кэша доступа из других процессов (админ-панель, вебхук-процессы, реплики)
+    access_invalidations.start()
+
+@dp.shutdown()
+async def on_shutdown():
+    await send_queue.stop()
+    await access_invalidations.stop()
+
 class RegistrationStates(StatesGroup):
     waiting_for_email = State()
 
@@ -77,7 +137,13 @@ main_keyboard = ReplyKeyboardMarkup(
 def is_valid_email(email: str) -> bool:
     return "@" in email and "." in email
 
+def accepts_access(func) -> bool:
+    """Ожидает ли обработчик решение о доступе в параметре access."""
+    return 'access' in inspect.signature(func).parameters
+
 def check_registered_active(func):
+    pass_access = accepts_access(func)
+
     @wraps(func)
     async def wrapper(message_or_cq: types.Message | types.CallbackQuery, state: FSMContext | None = None, *args, **kwargs):
         if isinstance(message_or_cq, types.Message):
@@ -92,30 +158,32 @@ def check_registered_active(func):
             return
 
         telegram_id = user_tg.id
-        user_db: User | None = None
-
-        with get_db() as db:
-            user_db = db.query(User).filter(User.telegram_id == telegram_id).first()
-
-            if not user_db or not user_db.email or user_db.email.startswith("temp_") or not user_db.is_active:
-                logger.warning(f"Access denied for {telegram_id} by check_registered_active: Not registered, no email, or inactive.")
-                await target_message.answer("Пожалуйста, пройдите регистрацию (или убедитесь, что ваш аккаунт активен), используя /start.")
-                if state and (not user_db or not user_db.email or user_db.email.startswith("temp_")):
-                    logger.info(f"Redirecting user {telegram_id} to email input.")
-                    if not user_db:
-                        await state.update_data(new_telegram_id=telegram_id, new_username=user_tg.username)
-                    else:
-                        await state.update_data(user_id_to_update=user_db.id)
-                    await target_message.answer("Пожалуйста, введите ваш email:", reply_markup=ReplyKeyboardRemove())
-                    await state.set_state(RegistrationStates.waiting_for_email)
-                return
+        access = await get_access(telegram_id)
+        user_db: User | None = access.user
+
+        if not access.registered or not access.active:
+            logger.warning(f"Access denied for {telegram_id} by check_registered_active: Not registered, no email, or inactive.")
+            await target_message.answer("Пожалуйста, пройдите регистрацию (или убедитесь, что ваш аккаунт активен), используя /start.")
+            if state and not access.registered:
+                logger.info(f"Redirecting user {telegram_id} to email input.")
+                if not user_db:
+                    await state.update_data(new_telegram_id=telegram_id, new_username=user_tg.username)
+                else:
+                    await state.update_data(user_id_to_update=user_db.id)
+                await target_message.answer("Пожалуйста, введите ваш email:", reply_markup=ReplyKeyboardRemove())
+                await state.set_state(RegistrationStates.waiting_for_email)
+            return
 
-            kwargs['user'] = user_db
-            return await func(message_or_cq, *args, **kwargs)
+        kwargs['user'] = user_db
+        if pass_access:
+            kwargs['access'] = access
+        return await func(message_or_cq, *args, **kwargs)
 
     return wrapper
 
 def check_access(handler):
+    pass_access = accepts_access(handler)
+
     @wraps(handler)
     async def wrapper(message_or_cq: types.Message | types.CallbackQuery, state: FSMContext | None = None, *args, **kwargs):
         if isinstance(message_or_cq, types.Message):
@@ -130,51 +198,36 @@ def check_access(handler):
             return
         
         telegram_id = user_tg.id
-        user_db: User | None = None
-        access_granted = False
         now = datetime.datetime.now(datetime.timezone.utc)
+        access = await get_access(telegram_id)
+        user_db: User | None = access.user
+
+        if not access.registered or not access.active:
+            logger.warning(f"Access denied for {telegram_id} by check_access: Not registered, no email, or inactive.")
+            await target_message.answer("Пожалуйста, пройдите регистрацию (или убедитесь, что ваш аккаунт активен), используя /start.")
+            if state and not access.registered:
+                 logger.info(f"Redirecting user {telegram_id} to email input.")
+                 if not user_db:
+                     await state.update_data(new_telegram_id=telegram_id, new_username=user_tg.username)
+                 else:
+                     await state.update_data(user_id_to_update=user_db.id)
+                 await target_message.answer("Пожалуйста, введите ваш email:", reply_markup=ReplyKeyboardRemove())
+                 await state.set_state(RegistrationStates.waiting_for_email)
+            return
 
-        with get_db() as db:
-            user_db = db.query(User).filter(User.telegram_id == telegram_id).first()
-
-            if not user_db or not user_db.email or user_db.email.startswith("temp_") or not user_db.is_active:
-                logger.warning(f"Access denied for {telegram_id} by check_access: Not registered, no email, or inactive.")
-                await target_message.answer("Пожалуйста, пройдите регистрацию (или убедитесь, что ваш аккаунт активен), используя /start.")
-                if state and (not user_db or not user_db.email or user_db.email.startswith("temp_")):
-                     logger.info(f"Redirecting user {telegram_id} to email input.")
-                     if not user_db:
-                         await state.update_data(new_telegram_id=telegram_id, new_username=user_tg.username)
-                     else:
-                         await state.update_data(user_id_to_update=user_db.id)
-                     await target_message.answer("Пожалуйста, введите ваш email:", reply_markup=ReplyKeyboardRemove())
-                     await state.set_state(RegistrationStates.waiting_for_email)
-                return
+        if access.is_whitelisted(now):
+            logger.info(f"Access granted for {telegram_id}: Whitelisted.")
+        elif access.has_subscription(now):
+            logger.info(f"Access granted for {telegram_id}: Active subscription until {access.subscription_end}.")
+        else:
+            logger.warning(f"Access denied for {telegram_id}: No active subscription or whitelist entry.")
+            await target_message.answer("❌ У вас нет активного доступа к курсу.")
+            return
 
-            logger.debug(f"Checking whitelist for telegram_id: {telegram_id} (type: {type(telegram_id)})")
-            whitelist_entry = db.query(Whitelist).filter(Whitelist.telegram_id == telegram_id).first()
-            logger.debug(f"Whitelist query result for {telegram_id}: {whitelist_entry}")
-            is_whitelisted = whitelist_entry is not None
-            if is_whitelisted:
-                logger.info(f"Access granted for {telegram_id}: Whitelisted.")
-                access_granted = True
-            else:
-                active_subscription = (db.query(Subscription)
-                                       .filter(Subscription.user_id == user_db.id)
-                                       .filter(Subscription.end_date > now)
-                                       .filter(Subscription.is_active == True)
-                                       .order_by(Subscription.end_date.desc())
-                                       .first())
-                if active_subscription:
-                    logger.info(f"Access granted for {telegram_id}: Active subscription until {active_subscription.end_date}.")
-                    access_granted = True
-
-            if access_granted:
-                kwargs['user'] = user_db
-                return await handler(message_or_cq, *args, **kwargs)
-            else:
-                logger.warning(f"Access denied for {telegram_id}: No active subscription or whitelist entry.")
-                await target_message.answer("❌ У вас нет активного доступа к курсу.")
-                return
+        kwargs['user'] = user_db
+        if pass_access:
+            kwargs['access'] = access
+        return await handler(message_or_cq, *args, **kwargs)
 
     return wrapper
 
@@ -203,8 +256,8 @@ async def handle_start(message: types.Message, state: FSMContext):
             )
             return
 
-    with get_db() as db:
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
+    async with get_async_db() as db:
+        user = await db.scalar(select(User).where(User.telegram_id == telegram_id))
 
         if user:
             logger.info(f"User {telegram_id} already exists.")
@@ -244,8 +297,8 @@ async def handle_email(message: types.Message, state: FSMContext):
         await message.answer("❌ Не похоже на email. Пожалуйста, введите корректный адрес электронной почты.")
         return
 
-    with get_db() as db:
-        existing_user_by_email = db.query(User).filter(User.email == email).first()
+    async with get_async_db() as db:
+        existing_user_by_email = await db.scalar(select(User).where(User.email == email))
         user_data = await state.get_data()
         user_id_to_update = user_data.get('user_id_to_update')
 
@@ -254,10 +307,12 @@ async def handle_email(message: types.Message, state: FSMContext):
                 return
 
         if user_id_to_update:
-            user_to_update = db.query(User).filter(User.id == user_id_to_update).first()
+            user_to_update = await db.get(User, user_id_to_update)
             if user_to_update:
                 user_to_update.email = email
-                db.commit()
+                await publish_access_change_async(db, user_to_update.telegram_id)
+                await db.commit()
+                invalidate_access(user_to_update.telegram_id)
                 logger.info(f"Email updated for user {user_to_update.telegram_id}.")
                 await message.answer("✅ Спасибо! Ваш email обновлен.", reply_markup=main_keyboard)
                 await state.clear()
@@ -281,7 +336,9 @@ async def handle_email(message: types.Message, state: FSMContext):
                 email=email
             )
             db.add(new_user)
-            db.commit()
+            await stats.increment_async(db, {stats.USERS_TOTAL: 1, stats.USERS_ACTIVE: 1})
+            await db.commit()
+            invalidate_access(new_telegram_id)
             logger.info(f"New user {new_telegram_id} registered with email {email}.")
             await message.answer("🎉 Спасибо! Вы успешно зарегистрированы.", reply_markup=main_keyboard)
             await state.clear()
@@ -292,28 +349,21 @@ async def handle_email_incorrect_input(message: types.Message):
 
 @dp.message(F.text == "👤 Мой аккаунт")
 @check_registered_active
-async def handle_my_account(message: types.Message, *, user: User):
+async def handle_my_account(message: types.Message, *, user: User, access: AccessRecord):
     logger.info(f"User {user.telegram_id} requested account info.")
     
     now = datetime.datetime.now(datetime.timezone.utc)
     access_status_text = "У вас отсутствует доступ к курсу ❌"
-    with get_db() as db:
-        is_whitelisted = db.query(Whitelist).filter(Whitelist.telegram_id == user.telegram_id).first() is not None
-        stop_command = db.query(StopCommand).filter(StopCommand.telegram_id == user.telegram_id).first()
-        autopayment_status = "❌ Автоплатежи отключены" if stop_command else "✅ Автоплатежи включены"
-        
-        if is_whitelisted:
-            access_status_text = "✅ Доступ к курсу есть (белый список)"
-        else:
-            active_subscription = (db.query(Subscription)
-                                   .filter(Subscription.user_id == user.id)
-                                   .filter(Subscription.end_date > now)
-                                   .order_by(Subscription.end_date.desc())
-                                   .first())
-            if active_subscription:
-                end_date_msk = active_subscription.end_date.astimezone(MSK)
-                end_date_str = end_date_msk.strftime("%d.%m.%Y %H:%M МСК")
-                access_status_text = f"✅ Доступ к курсу есть (до {end_date_str})"
+    async with get_async_db() as db:
+        stop_command = await db.scalar(select(StopCommand).where(StopCommand.telegram_id == user.telegram_id))
+    autopayment_status = "❌ Автоплатежи отключены" if stop_command else "✅ Автоплатежи включены"
+
+    if access.is_whitelisted(now):
+        access_status_text = "✅ Доступ к курсу есть (белый список)"
+    elif access.has_subscription(now):
+        end_date_msk = access.subscription_end.astimezone(MSK)
+        end_date_str = end_date_msk.strftime("%d.%m.%Y %H:%M МСК")
+        access_status_text = f"✅ Доступ к курсу есть (до {end_date_str})"
 
     account_info = (
         f"👤 Ваш аккаунт:\n"
@@ -340,8 +390,8 @@ async def handle_referral_link(message: types.Message, *, user: User):
 async def handle_stop_command(message: types.Message, *, user: User):
     logger.info(f"User {user.telegram_id} used /stop command")
     
-    with get_db() as db:
-        existing_stop = db.query(StopCommand).filter(StopCommand.telegram_id == user.telegram_id).first()
+    async with get_async_db() as db:
+        existing_stop = await db.scalar(select(StopCommand).where(StopCommand.telegram_id == user.telegram_id))
         
         if existing_stop:
             await message.answer("❌ У вас уже отключены автоплатежи\nЧтобы возобновить автоплатежи - введите команду /resume")
@@ -351,7 +401,7 @@ async def handle_stop_command(message: types.Message, *, user: User):
                 telegram_id=user.telegram_id
             )
             db.add(stop_command)
-            db.commit()
+            await db.commit()
             await message.answer("Автоплатежи выключены! ❌\nЧтобы возобновить автоплатежи - введите команду /resume")
 
 @dp.message(lambda message: message.text == "/resume")
@@ -359,12 +409,12 @@ async def handle_stop_command(message: types.Message, *, user: User):
 async def handle_resume_command(message: types.Message, *, user: User):
     logger.info(f"User {user.telegram_id} used /resume command")
     
-    with get_db() as db:
-        existing_stop = db.query(StopCommand).filter(StopCommand.telegram_id == user.telegram_id).first()
+    async with get_async_db() as db:
+        existing_stop = await db.scalar(select(StopCommand).where(StopCommand.telegram_id == user.telegram_id))
         
         if existing_stop:
-            db.delete(existing_stop)
-            db.commit()
+            await db.delete(existing_stop)
+            await db.commit()
             await message.answer("Автоплатежи были включены ✅\nВ следующем месяце произойдет списание!")
         else:
             await message.answer("✅ У вас уже включены автоплатежи!\nЧтобы выключить автоплатежи - введите команду /stop")
@@ -381,62 +431,53 @@ async def handle_referral_status(message: types.Message, *, user: User):
 
 @dp.message(F.text == "⏳ Моя подписка")
 @check_registered_active
-async def handle_my_subscription(message: types.Message, *, user: User):
+async def handle_my_subscription(message: types.Message, *, user: User, access: AccessRecord):
     logger.info(f"User {user.telegram_id} requested subscription status.")
     now = datetime.datetime.now(datetime.timezone.utc)
     
-    with get_db() as db:
-        # Проверяем активную подписку
-        active_subscription = (db.query(Subscription)
-                               .filter(Subscription.user_id == user.id)
-                               .filter(Subscription.end_date > now)
-                               .filter(Subscription.is_active == True)
-                               .order_by(Subscription.end_date.desc())
-                               .first())
-        
-        # Добавляем логирование для отладки
-        logger.info(f"Active subscription query result: {active_subscription}")
-        if active_subscription:
-            logger.info(f"Subscription details - End date: {active_subscription.end_date}, Now: {now}")
-        
-        is_whitelisted = db.query(Whitelist).filter(Whitelist.telegram_id == user.telegram_id).first() is not None
-        
-        if active_subscription:
-            end_date_msk = active_subscription.end_date.astimezone(MSK)
-            end_date_str = end_date_msk.strftime("%d.%m.%Y %H:%M МСК")
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text="🔄 Продлить подписку", callback_data="buy_access")]
-                ]
-            )
-            await message.answer(
-                f"✅ Ваш доступ к обучающему курсу активен до: {end_date_str}\n\n"
-                "Для продления подписки нажмите на кнопку ниже:",
-                reply_markup=keyboard
-            )
-        elif is_whitelisted:
-            await message.answer(
-                "✨ У вас постоянный доступ к курсу (белый список)."
-            )
-        else:
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [InlineKeyboardButton(text="💳 Оплатить 1500₽", callback_data="process_payment")]
-                ]
-            )
-            await message.answer(
-                "📚 Продукт: Приватный чат \"СИСТЕМНИК УБТ ПРИВАТ\"\n\n"
-                "🗓 Тарифный план: СИСТЕМНИК УБТ (Карта РФ)\n\n"
-                "💰 Сумма к оплате: 1500 RUB\n\n"
-                "✨ После оплаты будет предоставлен доступ:\n\n"
-                "📱 Группа «СИСТЕМНИК УБТ ПРИВАТ»\n\n"
-                "📋 Оплачивая подписку вы принимаете условия "
-                "[Публичной оферты](https://docs.google.com/document/d/1tgPqQTkjQDgftj-a0vNOgs53mi7-sctjv4WJ2BF9DTA/edit) и "
-                "[Политики конфиденциальности](https://docs.google.com/document/d/10s0vc9sBXMeC8a-_VGSXzCPi0Z5k4AMy/edit)",
-                reply_markup=keyboard,
-                parse_mode="Markdown",
-                disable_web_page_preview=True
-            )
+    # Активная подписка и белый список уже проверены в check_registered_active (кэш доступа)
+    has_subscription = access.has_subscription(now)
+    if has_subscription:
+        logger.info(f"Subscription details - End date: {access.subscription_end}, Now: {now}")
+    
+    is_whitelisted = access.is_whitelisted(now)
+    
+    if has_subscription:
+        end_date_msk = access.subscription_end.astimezone(MSK)
+        end_date_str = end_date_msk.strftime("%d.%m.%Y %H:%M МСК")
+        keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="🔄 Продлить подписку", callback_data="buy_access")]
+            ]
+        )
+        await message.answer(
+            f"✅ Ваш доступ к обучающему курсу активен до: {end_date_str}\n\n"
+            "Для продления подписки нажмите на кнопку ниже:",
+            reply_markup=keyboard
+        )
+    elif is_whitelisted:
+        await message.answer(
+            "✨ У вас постоянный доступ к курсу (белый список)."
+        )
+    else:
+        keyboard = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [InlineKeyboardButton(text="💳 Оплатить 1500₽", callback_data="process_payment")]
+            ]
+        )
+        await message.answer(
+            "📚 Продукт: Приватный чат \"СИСТЕМНИК УБТ ПРИВАТ\"\n\n"
+            "🗓 Тарифный план: СИСТЕМНИК УБТ (Карта РФ)\n\n"
+            "💰 Сумма к оплате: 1500 RUB\n\n"
+            "✨ После оплаты будет предоставлен доступ:\n\n"
+            "📱 Группа «СИСТЕМНИК УБТ ПРИВАТ»\n\n"
+            "📋 Оплачивая подписку вы принимаете условия "
+            "[Публичной оферты](https://docs.google.com/document/d/1tgPqQTkjQDgftj-a0vNOgs53mi7-sctjv4WJ2BF9DTA/edit) и "
+            "[Политики конфиденциальности](https://docs.google.com/document/d/10s0vc9sBXMeC8a-_VGSXzCPi0Z5k4AMy/edit)",
+            reply_markup=keyboard,
+            parse_mode="Markdown",
+            disable_web_page_preview=True
+        )
 
 @dp.message(F.text == "🆘 Поддержка")
 @check_registered_active
@@ -449,56 +490,109 @@ async def handle_support(message: types.Message, *, user: User):
         "📨 Только по долгим проблемам с оплатой — @" + ADMIN_TG_ACCOUNT
     )
 
+async def find_open_checkout(user: User, amount: int) -> tuple[str, str] | None:
+    """Неоплаченная ссылка пользователя, еще действующая в шлюзе (моложе CHECKOUT_LINK_TTL)."""
+    valid_after = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=CHECKOUT_LINK_TTL)
+    async with get_async_db() as db:
+        payment = await db.scalar(
+            select(Payment)
+            .where(
+                Payment.user_id == user.id,
+                Payment.status == PaymentStatus.PENDING,
+                Payment.amount == amount,
+                Payment.created_at > valid_after,
+                Payment.payment_data.isnot(None)
+            )
+            .order_by(Payment.created_at.desc())
+            .limit(1)
+        )
+    if not payment:
+        return None
+    pay_url = json.loads(payment.payment_data).get("PaymentURL")
+    return (pay_url, payment.external_id) if pay_url else None
+
+async def create_checkout(user: User, amount: int, description: str) -> tuple[str, str]:
+    """Создает платеж в шлюзе и записи Subscription/Payment для него."""
+    order_id = f"{user.telegram_id}_{int(datetime.datetime.now().timestamp())}"
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # Ссылка в шлюзе живет столько же, сколько мы готовы выдавать ее повторно
+    pay_url, payment_id = await tbank_create_payment(
+        int(amount), order_id, description, user.email,
+        redirect_due_date=now + datetime.timedelta(seconds=CHECKOUT_LINK_TTL)
+    )
+    async with get_async_db() as db:
+        # Получаем базовый тариф
+        basic_tariff = await db.scalar(select(TariffPlan).where(TariffPlan.type == SubscriptionType.BASIC))
+        if not basic_tariff:
+            raise Exception("Базовый тариф не найден")
+
+        # Деактивируем все предыдущие подписки пользователя
+        deactivated = await db.execute(
+            update(Subscription)
+            .where(Subscription.user_id == user.id, Subscription.is_active == True)
+            .values(is_active=False, auto_renewal=False, rebill_id=None)
+        )
+        
+        # Создаем новую подписку
+        new_sub = Subscription(
+            user_id=user.id,
+            tariff_id=basic_tariff.id,  # Добавляем tariff_id
+            start_date=now,
+            end_date=now + SUBSCRIPTION_DURATION,
+            payment_amount=amount,
+            is_active=False
+        )
+        db.add(new_sub)
+        await db.flush()
+
+        # Создаем запись о платеже
+        new_payment = Payment(
+            user_id=user.id,
+            subscription_id=new_sub.id,
+            external_id=payment_id,  # Исправляем payment_id на external_id
+            amount=amount,
+            currency='RUB',
+            status=PaymentStatus.PENDING,
+            payment_method=PaymentMethod.CARD,
+            payment_data=json.dumps({"PaymentURL": pay_url})
+        )
+        db.add(new_payment)
+        await stats.increment_async(db, {
+            stats.SUBSCRIPTIONS_TOTAL: 1,
+            stats.SUBSCRIPTIONS_ACTIVE: -deactivated.rowcount,
+            stats.tariff_counter(basic_tariff.id): 1
+        })
+        await publish_access_change_async(db, user.telegram_id)
+        await db.commit()
+    # Предыдущие подписки деактивированы
+    invalidate_access(user.telegram_id)
+    return pay_url, payment_id
+
+async def get_or_create_checkout(user: User, amount: int, description: str) -> tuple[str, str]:
+    """Возвращает действующую ссылку на оплату или создает новую."""
+    checkout = await find_open_checkout(user, amount)
+    if checkout:
+        logger.info(f"Reusing open payment {checkout[1]} for user {user.telegram_id}")
+        return checkout
+    return await create_checkout(user, amount, description)
+
 @dp.callback_query(F.data == "process_payment")
 @check_registered_active
 async def handle_process_payment(callback: types.CallbackQuery, *, user: User):
     logger.info("НАЖАТА КНОПКА ОПЛАТИТЬ 1500Р")
-    order_id = f"{user.telegram_id}_{int(datetime.datetime.now().timestamp())}"
     amount = 1500  # сумма в рублях
     description = "Подписка на СИСТЕМНИК УБТ ПРИВАТ"
     try:
-        pay_url, payment_id = await tbank_create_payment(int(amount), order_id, description, user.email)
-        now = datetime.datetime.now(datetime.timezone.utc)
-        with get_db() as db:
-            # Получаем базовый тариф
-            basic_tariff = db.query(TariffPlan).filter(TariffPlan.type == SubscriptionType.BASIC).first()
-            if not basic_tariff:
-                raise Exception("Базовый тариф не найден")
-
-            # Деактивируем все предыдущие подписки пользователя
-            db.query(Subscription).filter(
-                Subscription.user_id == user.id,
-                Subscription.is_active == True
-            ).update({
-                'is_active': False,
-                'auto_renewal': False,
-                'rebill_id': None
-            })
-            
-            # Создаем новую подписку
-            new_sub = Subscription(
-                user_id=user.id,
-                tariff_id=basic_tariff.id,  # Добавляем tariff_id
-                start_date=now,
-                end_date=now + SUBSCRIPTION_DURATION,
-                payment_amount=amount,
-                is_active=False
-            )
-            db.add(new_sub)
-            db.flush()
-
-            # Создаем запись о платеже
-            new_payment = Payment(
-                user_id=user.id,
-                subscription_id=new_sub.id,
-                external_id=payment_id,  # Исправляем payment_id на external_id
-                amount=amount,
-                currency='RUB',
-                status=PaymentStatus.PENDING,
-                payment_method=PaymentMethod.CARD
-            )
-            db.add(new_payment)
-            db.commit()
+        # Одновременные нажатия одного пользователя разделяют один вызов Init
+        pay_url, payment_id = await checkout_flight.do(
+            user.id, lambda: get_or_create_checkout(user, amount, description)
+        )
+    except GatewayUnavailable as e:
+        logger.warning(f"Платежный шлюз недоступен, оплата отложена: {e}")
+        await callback.answer(
+            "⏳ Платежный сервис временно недоступен. Попробуйте через пару минут.", show_alert=True
+        )
+        return
     except Exception as e:
         logger.error(f"Ошибка при создании платежа: {e}")
         await callback.message.edit_text(f"❌ Ошибка при создании платежа: {e}")
@@ -541,66 +635,14 @@ async def handle_check_payment(callback: types.CallbackQuery, *, user: User):
     status = payment_info.get("Status", "")
     
     if status == "CONFIRMED":
-        now = datetime.datetime.now(datetime.timezone.utc)
-        logger.info(f"Payment confirmed at {now}")
-        
-        with get_db() as db:
-            payment = db.query(Payment).filter(
-                Payment.external_id == payment_id,
-                Payment.user_id == user.id
-            ).first()
-            
-            if not payment:
-                logger.error(f"Payment {payment_id} not found in database for user {user.id}")
-                await callback.answer("❌ Платеж не найден. Попробуйте начать оплату заново.", show_alert=True)
-                return
-                
-            sub = db.query(Subscription).filter(
-                Subscription.id == payment.subscription_id,
-                Subscription.user_id == user.id
-            ).first()
-            
-            if sub:
-                logger.info(f"Found subscription {sub.id}, updating...")
-                sub.is_active = True
-                sub.end_date = now + SUBSCRIPTION_DURATION
-                sub.auto_renewal = True
-                sub.rebill_id = payment_info.get("RebillId")
-                sub.last_payment_date = now
-                sub.next_payment_date = now + SUBSCRIPTION_DURATION
-                try:
-                    amount_from_payment = payment_info.get("Amount")
-                    if amount_from_payment is not None:
-                        sub.payment_amount = float(amount_from_payment) / 100
-                    else:
-                        logger.warning(f"payment_info['Amount'] is None, оставляем прежнее значение: {sub.payment_amount}")
-                except Exception as e:
-                    logger.error(f"Ошибка при обработке суммы платежа: {e}")
-                sub.failed_payments = 0
-                sub.notification_sent = False
-                logger.info(f"Subscription fields after update: is_active={sub.is_active}, end_date={sub.end_date}, auto_renewal={sub.auto_renewal}, rebill_id={sub.rebill_id}, last_payment_date={sub.last_payment_date}, next_payment_date={sub.next_payment_date}, payment_amount={sub.payment_amount}, failed_payments={sub.failed_payments}, notification_sent={sub.notification_sent}")
-                payment.status = PaymentStatus.COMPLETED
-                payment.completed_at = now
-                db.commit()
-                logger.info(f"Subscription {sub.id} updated successfully. End date: {sub.end_date}")
-
-                keyboard = InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [InlineKeyboardButton(text="✅ Перейти в канал", url="https://t.me/+vy7Idslu1FQ4MWQy")],
-                        [InlineKeyboardButton(text="❌ Отключить автоплатеж", callback_data="disable_autopayment")]
-                    ]
-                )
-                
-                end_time = (now + SUBSCRIPTION_DURATION).strftime("%H:%M:%S UTC")
-                
-                await callback.message.edit_text(
-                    "✅ Оплата успешно подтверждена!\n\n"
-                    f"⏳ Доступ предоставлен на 10 минут (до {end_time})\n\n"
-                    "🔄 Автоплатеж включен. После окончания доступа мы автоматически продлим его еще на 10 минут.\n"
-                    "Вы всегда можете отключить автопродление в меню «Моя подписка».\n\n"
-                    "📱 Ссылка на канал уже доступна по кнопке ниже:",
-                    reply_markup=keyboard
-                )
+        # Подписку могло уже активировать уведомление шлюза — тогда просто показываем результат
+        sub, _ = await confirm_payment(payment_id, payment_info, user_id=user.id)
+        if not sub:
+            logger.error(f"Payment {payment_id} not found in database for user {user.id}")
+            await callback.answer("❌ Платеж не найден. Попробуйте начать оплату заново.", show_alert=True)
+            return
+        text, keyboard = payment_confirmed_message(sub)
+        await callback.message.edit_text(text, reply_markup=keyboard)
     else:
         # Оплата не получена
         error_message = payment_info.get("Message")
@@ -629,20 +671,224 @@ async def handle_check_payment(callback: types.CallbackQuery, *, user: User):
         )
         await callback.answer()
 
+def payment_confirmed_message(sub: Subscription) -> tuple[str, InlineKeyboardMarkup]:
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Перейти в канал", url="https://t.me/+vy7Idslu1FQ4MWQy")],
+            [InlineKeyboardButton(text="❌ Отключить автоплатеж", callback_data="disable_autopayment")]
+        ]
+    )
+    
+    end_time = sub.end_date.strftime("%H:%M:%S UTC")
+    
+    text = (
+        "✅ Оплата успешно подтверждена!\n\n"
+        f"⏳ Доступ предоставлен на 10 минут (до {end_time})\n\n"
+        "🔄 Автоплатеж включен. После окончания доступа мы автоматически продлим его еще на 10 минут.\n"
+        "Вы всегда можете отключить автопродление в меню «Моя подписка».\n\n"
+        "📱 Ссылка на канал уже доступна по кнопке ниже:"
+    )
+    return text, keyboard
+
+async def complete_payment(db, payment: Payment, sub: Subscription, payment_info: dict, now: datetime.datetime) -> bool:
+    """Переводит платеж в COMPLETED и активирует подписку в транзакции db (без commit).
+
+    Возвращает False, если платеж уже был подтвержден ранее.
+    """
+    result = await db.execute(
+        update(Payment)
+        .where(Payment.id == payment.id, Payment.status != PaymentStatus.COMPLETED)
+        .values(status=PaymentStatus.COMPLETED, completed_at=now)
+    )
+    if result.rowcount != 1:
+        return False
+
+    logger.info(f"Found subscription {sub.id}, updating...")
+    await stats.increment_async(db, {
+        stats.PAYMENTS_COMPLETED: 1,
+        stats.REVENUE_TOTAL: payment.amount,
+        stats.SUBSCRIPTIONS_ACTIVE: 0 if sub.is_active else 1
+    })
+    # sub загружена вместе с user (selectinload)
+    await publish_access_change_async(db, sub.user.telegram_id)
+    sub.is_active = True
+    sub.end_date = now + SUBSCRIPTION_DURATION
+    sub.auto_renewal = True
+    # В уведомлениях RebillId приходит числом, в GetState — строкой
+    rebill_id = payment_info.get("RebillId")
+    sub.rebill_id = str(rebill_id) if rebill_id is not None else None
+    sub.last_payment_date = now
+    sub.next_payment_date = now + SUBSCRIPTION_DURATION
+    try:
+        amount_from_payment = payment_info.get("Amount")
+        if amount_from_payment is not None:
+            sub.payment_amount = float(amount_from_payment) / 100
+        else:
+            logger.warning(f"payment_info['Amount'] is None, оставляем прежнее значение: {sub.payment_amount}")
+    except Exception as e:
+        logger.error(f"Ошибка при обработке суммы платежа: {e}")
+    sub.failed_payments = 0
+    sub.notification_sent = False
+    logger.info(f"Subscription fields after update: is_active={sub.is_active}, end_date={sub.end_date}, auto_renewal={sub.auto_renewal}, rebill_id={sub.rebill_id}, last_payment_date={sub.last_payment_date}, next_payment_date={sub.next_payment_date}, payment_amount={sub.payment_amount}, failed_payments={sub.failed_payments}, notification_sent={sub.notification_sent}")
+    return True
+
+async def after_payment_confirmed(sub: Subscription):
+    """Сбрасывает кэш доступа и ставит подписку в расписание автоплатежей."""
+    invalidate_access(sub.user.telegram_id)
+    await payment_scheduler.refresh(sub.id)
+    logger.info(f"Subscription {sub.id} updated successfully. End date: {sub.end_date}")
+
+async def send_payment_confirmed(sub: Subscription):
+    """Сообщает об оплате пользователю, который не нажимал «Проверить оплату»."""
+    text, keyboard = payment_confirmed_message(sub)
+    try:
+        await send_queue.send_message(sub.user.telegram_id, text, priority=PRIORITY_PAYMENT, reply_markup=keyboard)
+    except Exception as e:
+        logger.error(f"Ошибка при отправке подтверждения оплаты пользователю {sub.user.telegram_id}: {e}")
+
+async def confirm_payment(payment_id: str, payment_info: dict, user_id: int | None = None) -> tuple[Subscription | None, bool]:
+    """Активирует подписку по подтвержденному платежу.
+
+    Идемпотентно: кнопка «Проверить оплату» и уведомление шлюза могут прийти
+    в любом порядке и одновременно, подписка обновится один раз. Возвращает
+    подписку и признак того, что платеж подтвержден именно этим вызовом.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    logger.info(f"Payment {payment_id} confirmed at {now}")
+    
+    async with get_async_db() as db:
+        query = select(Payment).where(Payment.external_id == payment_id)
+        if user_id is not None:
+            query = query.where(Payment.user_id == user_id)
+        payment = await db.scalar(query)
+        if not payment:
+            return None, False
+            
+        sub = await db.scalar(
+            select(Subscription)
+            .options(selectinload(Subscription.user))
+            .where(Subscription.id == payment.subscription_id, Subscription.user_id == payment.user_id)
+        )
+        if not sub:
+            return None, False
+
+        if not await complete_payment(db, payment, sub, payment_info, now):
+            await db.rollback()
+            return sub, False
+        await db.commit()
+    await after_payment_confirmed(sub)
+    return sub, True
+
+async def fail_payment(payment_id: str, payment_info: dict):
+    """Помечает ожидающий платеж неуспешным (отклонен, отменен, истек срок оплаты)."""
+    async with get_async_db() as db:
+        await db.execute(
+            update(Payment)
+            .where(Payment.external_id == payment_id, Payment.status == PaymentStatus.PENDING)
+            .values(
+                status=PaymentStatus.FAILED,
+                error_message=payment_info.get("Message") or payment_info.get("Status")
+            )
+        )
+        await db.commit()
+
+async def reconcile_pending_payments() -> tuple[int, int]:
+    """Сверяет со шлюзом платежи, зависшие в PENDING дольше RECONCILE_MIN_AGE.
+
+    Платежи читаются страницами по id (keyset), статусы запрашиваются
+    параллельно, но не более RECONCILE_CONCURRENCY запросов GetState
+    одновременно. Итог страницы записывается одной транзакцией. Возвращает
+    число подтвержденных и отклоненных платежей.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cutoff = now - datetime.timedelta(seconds=RECONCILE_MIN_AGE)
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+    async def fetch_state(external_id: str) -> dict | None:
+        async with semaphore:
+            # Пока шлюз недоступен, остаток страницы не запрашиваем
+            if not tbank_client.available:
+                return None
+            return await tbank_get_payment_info(external_id)
+
+    confirmed_total = failed_total = 0
+    last_id = 0
+    while True:
+        async with get_async_db() as db:
+            page = (await db.execute(
+                select(Payment.id, Payment.external_id)
+                .where(
+                    payment_status_is(PaymentStatus.PENDING),
+                    Payment.external_id.isnot(None),
+                    Payment.created_at < cutoff,
+                    Payment.id > last_id
+                )
+                .order_by(Payment.id)
+                .limit(RECONCILE_PAGE_SIZE)
+            )).all()
+        if not page:
+            break
+        last_id = page[-1].id
+
+        states = await asyncio.gather(*(fetch_state(row.external_id) for row in page))
+        to_confirm = {}
+        to_fail = {}
+        for row, info in zip(page, states):
+            if not info or not info.get("Success"):
+                continue
+            if info.get("Status") == "CONFIRMED":
+                to_confirm[row.id] = info
+            elif info.get("Status") in FAILED_STATUSES:
+                to_fail[row.id] = info.get("Message") or info.get("Status")
+
+        confirmed = []
+        now = datetime.datetime.now(datetime.timezone.utc)
+        async with get_async_db() as db:
+            if to_confirm:
+                payments = (await db.scalars(
+                    select(Payment)
+                    .options(selectinload(Payment.subscription).selectinload(Subscription.user))
+                    .where(Payment.id.in_(to_confirm))
+                )).all()
+                for payment in payments:
+                    sub = payment.subscription
+                    if sub is not None and await complete_payment(db, payment, sub, to_confirm[payment.id], now):
+                        confirmed.append(sub)
+            if to_fail:
+                result = await db.execute(
+                    update(Payment)
+                    .where(Payment.id.in_(to_fail), Payment.status == PaymentStatus.PENDING)
+                    .values(status=PaymentStatus.FAILED, error_message=case(to_fail, value=Payment.id))
+                )
+                failed_total += result.rowcount
+            await db.commit()
+
+        for sub in confirmed:
+            await after_payment_confirmed(sub)
+        await asyncio.gather(*(send_payment_confirmed(sub) for sub in confirmed))
+        confirmed_total += len(confirmed)
+        if len(page) < RECONCILE_PAGE_SIZE:
+            break
+        if not tbank_client.available:
+            logger.warning("Сверка платежей прервана: платежный шлюз недоступен")
+            break
+    return confirmed_total, failed_total
+
 # Добавляем обработчик для отключения автоплатежа
 @dp.callback_query(F.data == "disable_autopayment")
 @check_registered_active
 async def handle_disable_autopayment(callback: types.CallbackQuery, *, user: User):
-    with get_db() as db:
-        sub = db.query(Subscription).filter(
+    async with get_async_db() as db:
+        sub = await db.scalar(select(Subscription).where(
             Subscription.user_id == user.id,
             Subscription.is_active == True
-        ).first()
+        ).limit(1))
         
         if sub and sub.auto_renewal:
             sub.auto_renewal = False
             sub.rebill_id = None
-            db.commit()
+            await db.commit()
+            await payment_scheduler.refresh(sub.id)
             await callback.message.edit_text(
                 "✅ Автоплатеж успешно отключен.\n"
                 "Текущая подписка будет действовать до окончания оплаченного периода.",
@@ -659,11 +905,11 @@ async def handle_disable_autopayment(callback: types.CallbackQuery, *, user: Use
 @dp.callback_query(F.data == "enable_autopayment")
 @check_registered_active
 async def handle_enable_autopayment(callback: types.CallbackQuery, *, user: User):
-    with get_db() as db:
-        sub = db.query(Subscription).filter(
+    async with get_async_db() as db:
+        sub = await db.scalar(select(Subscription).where(
             Subscription.user_id == user.id,
             Subscription.is_active == True
-        ).first()
+        ).limit(1))
         
         if sub and not sub.auto_renewal:
             # Здесь нужно создать новый платеж для получения rebill_id
@@ -684,66 +930,31 @@ async def process_back(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     await callback.message.edit_text("Главное меню:")
 
-def generate_token(params: dict, secret_key: str) -> str:
-    params = dict(params)
-    params.pop('Token', None)
-    params['Password'] = secret_key
-    sorted_keys = sorted(params.keys())
-    values_str = ''.join(str(params[k]) for k in sorted_keys)
-    return hashlib.sha256(values_str.encode('utf-8')).hexdigest()
-
-async def tbank_create_payment(amount: int, order_id: str, description: str, user_email: str) -> tuple[str, str]:
-    url = "https://securepay.tinkoff.ru/v2/Init"
-    payload = {
-        "TerminalKey": TBANK_SHOP_ID,
-        "Amount": amount * 100,  # сумма в копейках
-        "OrderId": order_id,
-        "Description": description,
-        "DATA": {
-            "Email": user_email
-        },
+async def tbank_create_payment(amount: int, order_id: str, description: str, user_email: str,
+                               redirect_due_date: datetime.datetime | None = None) -> tuple[str, str]:
+    extra = {}
+    if redirect_due_date is not None:
+        # Срок действия ссылки на оплату
+        extra["RedirectDueDate"] = redirect_due_date.isoformat(timespec="seconds")
+    data = await tbank_client.init(
+        amount,
+        order_id,
+        description,
+        DATA={"Email": user_email},
+        **extra,
         # Добавляем параметры для рекуррентных платежей
-        "Recurrent": "Y",  # Включаем рекуррентные платежи
-        "CustomerKey": str(order_id.split('_')[0]),  # Используем telegram_id как CustomerKey
-    }
-    sign_params = {k: v for k, v in payload.items() if k not in ("Token", "DATA")}
-    token = generate_token(sign_params, TBANK_SECRET_KEY)
-    payload["Token"] = token
-    headers = {"Content-Type": "application/json"}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload, headers=headers) as resp:
-            text = await resp.text()
-            try:
-                data = await resp.json()
-            except Exception:
-                raise Exception(f"Ошибка создания платежа: {resp.status}, ответ: {text}")
-            if data.get("Success"):
-                return data["PaymentURL"], str(data["PaymentId"])
-            else:
-                raise Exception(f"Ошибка создания платежа: {data}")
-
-async def tbank_check_payment(payment_id: str) -> bool:
-    url = "https://securepay.tinkoff.ru/v2/GetState"
-    payload = {
-        "TerminalKey": TBANK_SHOP_ID,
-        "PaymentId": payment_id
-    }
-    token = generate_token(payload, TBANK_SECRET_KEY)
-    payload["Token"] = token
-    headers = {"Content-Type": "application/json"}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload, headers=headers) as resp:
-            text = await resp.text()
-            try:
-                data = await resp.json()
-            except Exception:
-                raise Exception(f"Ошибка проверки статуса: {resp.status}, ответ: {text}")
-            return data.get('Status') in ('CONFIRMED', 'AUTHORIZED')
+        Recurrent="Y",  # Включаем рекуррентные платежи
+        CustomerKey=str(order_id.split('_')[0])  # Используем telegram_id как CustomerKey
+    )
+    if data.get("Success"):
+        return data["PaymentURL"], str(data["PaymentId"])
+    else:
+        raise Exception(f"Ошибка создания платежа: {data}")
 
 async def notify_user(telegram_id: int, message: str):
     """Отправляет уведомление пользователю."""
     try:
-        await bot.send_message(telegram_id, message)
+        await send_queue.send_message(telegram_id, message, priority=PRIORITY_PAYMENT)
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомления пользователю {telegram_id}: {e}")
 
@@ -753,23 +964,14 @@ async def debug_all_callbacks(callback: types.CallbackQuery):
     await callback.answer()
 
 async def tbank_get_payment_info(payment_id: str) -> dict:
-    url = "https://securepay.tinkoff.ru/v2/GetState"
-    payload = {
-        "TerminalKey": TBANK_SHOP_ID,
-        "PaymentId": payment_id
-    }
-    token = generate_token(payload, TBANK_SECRET_KEY)
-    payload["Token"] = token
-    headers = {"Content-Type": "application/json"}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload, headers=headers) as resp:
-            try:
-                return await resp.json()
-            except Exception:
-                return None
+    try:
+        return await tbank_client.get_state(payment_id)
+    except TBankError as e:
+        logger.error(f"Ошибка получения статуса платежа {payment_id}: {e}")
+        return None
 
-async def notify_upcoming_payment(subscription: Subscription):
-    """Отправляет уведомление о предстоящем списании."""
+async def notify_upcoming_payment(subscription: Subscription) -> bool:
+    """Отправляет уведомление о предстоящем списании; True — если сообщение доставлено."""
     try:
         message = (
             "ℹ️ Уведомление о предстоящем списании\n\n"
@@ -777,163 +979,500 @@ async def notify_upcoming_payment(subscription: Subscription):
             f"Сумма к списанию: {subscription.payment_amount}₽\n\n"
             "Чтобы отключить автопродление, используйте команду /stop"
         )
-        await bot.send_message(subscription.user.telegram_id, message)
+        await send_queue.send_message(subscription.user.telegram_id, message, priority=PRIORITY_PAYMENT)
+        return True
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомления о предстоящем списании: {e}")
+        return False
 
-# Функция для проверки и обработки автоплатежей
-async def process_auto_payments():
-    """Обработка автоматических платежей для активных подписок."""
-    logger.info("Начало обработки автоматических платежей")
-    
+# Обработка событий планировщика автоплатежей (payment_scheduler)
+async def process_payment_notifications(subscription_ids: list[int]):
+    """Уведомляет о предстоящем списании пачку подписок.
+
+    Один запрос с пользователями, параллельная отправка через очередь
+    сообщений и один UPDATE для доставленных уведомлений.
+    """
     now = datetime.datetime.now(datetime.timezone.utc)
-    notification_threshold = datetime.timedelta(minutes=2)  # За 2 минуты до списания
-    
-    with get_db() as db:
-        # Получаем подписки для уведомления
-        subscriptions_to_notify = db.query(Subscription).filter(
-            and_(
-                Subscription.auto_renewal == True,
-                Subscription.is_active == True,
-                Subscription.next_payment_date - notification_threshold <= now,
-                Subscription.next_payment_date > now,
-                Subscription.notification_sent == False,  # Новое поле
-                Subscription.rebill_id.isnot(None)
+    async with get_async_db() as db:
+        subscriptions = (await db.scalars(
+            select(Subscription)
+            .options(joinedload(Subscription.user))
+            .where(
+                and_(
+                    Subscription.id.in_(subscription_ids),
+                    Subscription.auto_renewal == True,
+                    Subscription.is_active == True,
+                    Subscription.next_payment_date > now,
+                    Subscription.notification_sent == False,
+                    Subscription.rebill_id.isnot(None)
+                )
             )
-        ).all()
-
-        # Отправляем уведомления
-        for subscription in subscriptions_to_notify:
-            await notify_upcoming_payment(subscription)
-            subscription.notification_sent = True
-            db.commit()
-
-        # Получаем подписки для автоплатежа
-        subscriptions = db.query(Subscription).filter(
-            and_(
-                Subscription.auto_renewal == True,
-                Subscription.is_active == True,
-                Subscription.next_payment_date <= now,
-                Subscription.rebill_id.isnot(None)
+        )).all()
+    if not subscriptions:
+        return
+
+    results = await asyncio.gather(*(notify_upcoming_payment(subscription) for subscription in subscriptions))
+    delivered = [subscription.id for subscription, ok in zip(subscriptions, results) if ok]
+    if delivered:
+        async with get_async_db() as db:
+            await db.execute(
+                update(Subscription)
+                .where(Subscription.id.in_(delivered))
+                .values(notification_sent=True)
             )
-        ).all()
-        
-        for subscription in subscriptions:
-            try:
-                # Создаем платеж
-                order_id = f"auto_{subscription.user.telegram_id}_{int(now.timestamp())}"
-                payment = await tbank_create_rebill_payment(
-                    rebill_id=subscription.rebill_id,
-                    amount=subscription.payment_amount,
-                    order_id=order_id,
-                    description=f"Автоплатеж за подписку {subscription.id}"
+            await db.commit()
+    logger.info(f"Уведомления о списании: доставлено {len(delivered)} из {len(subscriptions)}")
+
+# Захват без срока: подписка ждет ручной сверки (renewal_error)
+RENEWAL_PARKED = datetime.datetime(9999, 1, 1, tzinfo=datetime.timezone.utc)
+
+async def claim_auto_payment(subscription_id: int, now: datetime.datetime) -> Subscription | None:
+    """Атомарно захватывает подписку для списания.
+
+    Возвращает None, если списывать не нужно или подписку уже обрабатывает
+    другой воркер или процесс.
+    """
+    async with get_async_db() as db:
+        result = await db.execute(
+            update(Subscription)
+            .where(
+                and_(
+                    Subscription.id == subscription_id,
+                    Subscription.auto_renewal == True,
+                    Subscription.is_active == True,
+                    Subscription.next_payment_date <= now,
+                    Subscription.rebill_id.isnot(None),
+                    Subscription.renewal_error.is_(None),
+                    or_(Subscription.renewal_claimed_until.is_(None), Subscription.renewal_claimed_until < now)
                 )
-                
-                if payment and await tbank_check_payment(payment.get('PaymentId')):
-                    # Обновляем даты подписки
-                    subscription.end_date = subscription.end_date + SUBSCRIPTION_DURATION
-                    subscription.last_payment_date = now
-                    subscription.next_payment_date = subscription.end_date - datetime.timedelta(minutes=2)
-                    subscription.failed_payments = 0
-                    subscription.notification_sent = False  # Сбрасываем флаг уведомления
-                    
-                    # Создаем запись о платеже
-                    new_payment = Payment(
-                        user_id=subscription.user_id,
-                        subscription_id=subscription.id,
-                        external_id=payment.get('PaymentId'),  # Исправляем payment_id на external_id
-                        amount=subscription.payment_amount,
-                        currency='RUB',
-                        status=PaymentStatus.COMPLETED,
-                        payment_method=PaymentMethod.CARD,
-                        completed_at=now
-                    )
-                    db.add(new_payment)
-                    
-                    await notify_user(
-                        subscription.user.telegram_id,
-                        f"✅ Автоплатеж успешно выполнен\n"
-                        f"Сумма: {subscription.payment_amount}₽\n"
-                        f"Подписка продлена до: {subscription.end_date.strftime('%d.%m.%Y %H:%M')} UTC"
-                    )
-                else:
-                    subscription.failed_payments += 1
-                    
-                    if subscription.failed_payments >= 3:
-                        subscription.auto_renewal = False
-                        subscription.rebill_id = None
-                        await notify_user(
-                            subscription.user.telegram_id,
-                            "❌ Автоплатеж отключен из-за повторных неудач.\n"
-                            "Для возобновления подписки, пожалуйста, оплатите её заново."
-                        )
-                    else:
-                        retry_in = 2 ** subscription.failed_payments  # Экспоненциальная задержка
-                        subscription.next_payment_date = now + datetime.timedelta(minutes=retry_in)
-                        await notify_user(
-                            subscription.user.telegram_id,
-                            f"⚠️ Автоплатеж не удался (попытка {subscription.failed_payments}/3).\n"
-                            f"Следующая попытка через {retry_in} минут."
-                        )
-                
-                db.commit()
-                
-            except Exception as e:
-                logger.error(f"Ошибка при обработке автоплатежа для подписки {subscription.id}: {e}")
-                db.rollback()
-
-# Запускаем проверку автоплатежей каждые 10 секунд
-async def schedule_auto_payments():
+            )
+            .values(
+                renewal_claimed_until=now + datetime.timedelta(seconds=RENEWAL_CLAIM_TIMEOUT),
+                last_renewal_attempt=now
+            )
+        )
+        if result.rowcount != 1:
+            await db.rollback()
+            return None
+        subscription = await db.scalar(
+            select(Subscription)
+            .options(selectinload(Subscription.user))
+            .where(Subscription.id == subscription_id)
+        )
+        await db.commit()
+        return subscription
+
+async def save_auto_payment_result(subscription_id: int, telegram_id: int, payment: dict | None,
+                                   now: datetime.datetime) -> str:
+    """Записывает результат списания одной транзакцией и снимает захват; возвращает сообщение пользователю."""
+    async with get_async_db() as db:
+        subscription = await db.get(Subscription, subscription_id)
+        if payment:
+            # Обновляем даты подписки
+            subscription.end_date = subscription.end_date + SUBSCRIPTION_DURATION
+            subscription.last_payment_date = now
+            subscription.next_payment_date = subscription.end_date - datetime.timedelta(minutes=2)
+            subscription.failed_payments = 0
+            subscription.notification_sent = False  # Сбрасываем флаг уведомления
+            
+            # Создаем запись о платеже
+            new_payment = Payment(
+                user_id=subscription.user_id,
+                subscription_id=subscription.id,
+                external_id=payment.get('PaymentId'),  # Исправляем payment_id на external_id
+                amount=subscription.payment_amount,
+                currency='RUB',
+                status=PaymentStatus.COMPLETED,
+                payment_method=PaymentMethod.CARD,
+                completed_at=now
+            )
+            db.add(new_payment)
+            await stats.increment_async(db, {
+                stats.PAYMENTS_COMPLETED: 1,
+                stats.REVENUE_TOTAL: subscription.payment_amount
+            })
+            
+            message = (
+                f"✅ Автоплатеж успешно выполнен\n"
+                f"Сумма: {subscription.payment_amount}₽\n"
+                f"Подписка продлена до: {subscription.end_date.strftime('%d.%m.%Y %H:%M')} UTC"
+            )
+        else:
+            subscription.failed_payments += 1
+            # Неудачное списание сохраняем платежом FAILED: по нему аналитика считает неудачные продления
+            db.add(Payment(
+                user_id=subscription.user_id,
+                subscription_id=subscription.id,
+                amount=subscription.payment_amount,
+                currency='RUB',
+                status=PaymentStatus.FAILED,
+                payment_method=PaymentMethod.CARD,
+                error_message="Автоплатеж не прошел"
+            ))
+            
+            if subscription.failed_payments >= 3:
+                subscription.auto_renewal = False
+                subscription.rebill_id = None
+                message = (
+                    "❌ Автоплатеж отключен из-за повторных неудач.\n"
+                    "Для возобновления подписки, пожалуйста, оплатите её заново."
+                )
+            else:
+                retry_in = 2 ** subscription.failed_payments  # Экспоненциальная задержка
+                subscription.next_payment_date = now + datetime.timedelta(minutes=retry_in)
+                message = (
+                    f"⚠️ Автоплатеж не удался (попытка {subscription.failed_payments}/3).\n"
+                    f"Следующая попытка через {retry_in} минут."
+                )
+        subscription.renewal_claimed_until = None
+        await publish_access_change_async(db, telegram_id)
+        await db.commit()
+    return message
+
+async def park_charged_subscription(subscription_id: int, payment: dict):
+    """
+    Деньги списаны, а продление записать не удалось: захват ставится без
+    срока, а в renewal_error — номер платежа для ручной сверки. Пока захват
+    не снят вручную, подписка не спишется второй раз. Запись — один UPDATE;
+    повторяется, пока не пройдет, иначе захват истечет через RENEWAL_CLAIM_TIMEOUT.
+    """
+    error = f"Платеж {payment.get('PaymentId')} списан, продление не записано"
+    delay = RENEWAL_SAVE_RETRY_DELAY
     while True:
         try:
-            await process_auto_payments()
+            async with get_async_db() as db:
+                await db.execute(
+                    update(Subscription)
+                    .where(Subscription.id == subscription_id)
+                    .values(renewal_claimed_until=RENEWAL_PARKED, renewal_error=error)
+                )
+                await db.commit()
+            logger.critical(f"Подписка {subscription_id} снята с автоплатежей до ручной сверки: {error}")
+            return
         except Exception as e:
-            logger.error(f"Ошибка в планировщике автоплатежей: {e}")
-        await asyncio.sleep(10)  # Проверяем каждые 10 секунд вместо часа
-
-async def tbank_create_rebill_payment(rebill_id: str, amount: int, order_id: str, description: str) -> bool:
-    """Создает рекуррентный платеж через Тинькофф."""
-    url = "https://securepay.tinkoff.ru/v2/Init"
-    payload = {
-        "TerminalKey": TBANK_SHOP_ID,
-        "Amount": amount * 100,  # сумма в копейках
-        "OrderId": order_id,
-        "Description": description,
-        "Recurrent": "Y",
-        "PaymentMethod": "Recurrent",
-        "RebillId": rebill_id
-    }
-    sign_params = {k: v for k, v in payload.items() if k not in ("Token", "DATA")}
-    token = generate_token(sign_params, TBANK_SECRET_KEY)
-    payload["Token"] = token
-    headers = {"Content-Type": "application/json"}
-    
+            logger.error(f"Не удалось остановить автоплатежи подписки {subscription_id} ({error}): {e}")
+            await asyncio.sleep(delay)
+            delay = min(max(delay * 2, 1), 60)
+
+async def process_auto_payment(subscription_id: int):
+    """Списывает автоплатеж по подписке, если срок наступил.
+
+    Захват, обращение к шлюзу и запись результата идут отдельно: пока идет
+    списание, соединение с БД не удерживается. Если шлюз недоступен, попытка
+    не считается неудачной: подписка остается в очереди планировщика.
+    Запись результата повторяется RENEWAL_SAVE_ATTEMPTS раз; если успешное
+    списание так и не записано, подписка останавливается до ручной сверки —
+    повторно она не спишется.
+    """
+    if not tbank_client.available:
+        logger.info(f"Автоплатеж по подписке {subscription_id} отложен: платежный шлюз недоступен")
+        return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    claimed = await claim_auto_payment(subscription_id, now)
+    if not claimed:
+        return
+    logger.info(f"Автоплатеж по подписке {subscription_id}")
+    telegram_id = claimed.user.telegram_id
+
+    # Создаем платеж
+    order_id = f"auto_{telegram_id}_{int(now.timestamp())}"
+    try:
+        payment = await tbank_create_rebill_payment(
+            rebill_id=claimed.rebill_id,
+            amount=claimed.payment_amount,
+            order_id=order_id,
+            description=f"Автоплатеж за подписку {subscription_id}"
+        )
+    except GatewayUnavailable as e:
+        # Списание не отправлялось: снимаем захват, планировщик повторит попытку
+        logger.warning(f"Автоплатеж по подписке {subscription_id} отложен: {e}")
+        async with get_async_db() as db:
+            await db.execute(
+                update(Subscription)
+                .where(Subscription.id == subscription_id)
+                .values(renewal_claimed_until=None)
+            )
+            await db.commit()
+        return
+
+    # Запись результата повторяется: после успешного списания ее потеря означала бы повторное списание
+    message = None
+    for attempt in range(1, RENEWAL_SAVE_ATTEMPTS + 1):
+        try:
+            message = await save_auto_payment_result(subscription_id, telegram_id, payment, now)
+            break
+        except Exception as e:
+            logger.error(
+                f"Ошибка при записи автоплатежа для подписки {subscription_id} "
+                f"(платеж {payment.get('PaymentId') if payment else None}, попытка {attempt}/{RENEWAL_SAVE_ATTEMPTS}): {e}"
+            )
+            if attempt < RENEWAL_SAVE_ATTEMPTS:
+                await asyncio.sleep(RENEWAL_SAVE_RETRY_DELAY * 2 ** (attempt - 1))
+    if message is None:
+        if payment:
+            await park_charged_subscription(subscription_id, payment)
+        # Неудачное списание не записано: деньги не списаны, попытка повторится после истечения захвата
+        return
+
+    invalidate_access(telegram_id)
+    await notify_user(telegram_id, message)
+
+async def purge_abandoned_checkouts() -> tuple[int, int]:
+    """Удаляет брошенные попытки оплаты старше CHECKOUT_RETENTION.
+
+    Сначала неподтвержденные платежи (PENDING/FAILED) неактивных подписок,
+    которые ни разу не были оплачены, затем неактивные подписки, у которых не
+    осталось ни одного платежа. Неудачные продления оплаченных и затем
+    закончившихся подписок — история, на ней строится аналитика; они не удаляются.
+    Удаление идет пачками по CHECKOUT_GC_BATCH_SIZE строк, каждая пачка —
+    отдельная короткая транзакция. Возвращает число удаленных платежей и подписок.
+    """
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=CHECKOUT_RETENTION)
+    paid = aliased(Payment)
+    payments_deleted = 0
+    while True:
+        async with get_async_db() as db:
+            ids = (await db.scalars(
+                select(Payment.id)
+                .join(Subscription, Payment.subscription_id == Subscription.id)
+                .where(
+                    Payment.status.in_([PaymentStatus.PENDING, PaymentStatus.FAILED]),
+                    Payment.created_at < cutoff,
+                    Subscription.is_active == False,
+                    ~exists().where(paid.subscription_id == Subscription.id, paid.status == PaymentStatus.COMPLETED)
+                )
+                .limit(CHECKOUT_GC_BATCH_SIZE)
+            )).all()
+            if not ids:
+                break
+            await db.execute(delete(Payment).where(Payment.id.in_(ids)))
+            await db.commit()
+        payments_deleted += len(ids)
+
+    subscriptions_deleted = 0
+    while True:
+        async with get_async_db() as db:
+            ids = (await db.scalars(
+                select(Subscription.id)
+                .where(
+                    Subscription.is_active == False,
+                    Subscription.start_date < cutoff,
+                    ~exists().where(Payment.subscription_id == Subscription.id)
+                )
+                .limit(CHECKOUT_GC_BATCH_SIZE)
+            )).all()
+            if not ids:
+                break
+            tariff_ids = (await db.scalars(
+                delete(Subscription).where(Subscription.id.in_(ids)).returning(Subscription.tariff_id)
+            )).all()
+            # Удаляются только неактивные подписки
+            deltas = {stats.SUBSCRIPTIONS_TOTAL: -len(tariff_ids)}
+            for tariff_id, count in Counter(tariff_ids).items():
+                deltas[stats.tariff_counter(tariff_id)] = -count
+            await stats.increment_async(db, deltas)
+            await db.commit()
+        subscriptions_deleted += len(ids)
+    return payments_deleted, subscriptions_deleted
+
+# Удаляем брошенные попытки оплаты
+async def schedule_checkout_gc():
+    while True:
+        try:
+            payments, subscriptions = await purge_abandoned_checkouts()
+            if payments or subscriptions:
+                logger.info(f"Удалено брошенных попыток оплаты: платежей {payments}, подписок {subscriptions}")
+        except Exception as e:
+            logger.error(f"Ошибка при удалении брошенных попыток оплаты: {e}")
+        await asyncio.sleep(CHECKOUT_GC_INTERVAL)
+
+# Сверяем зависшие платежи, которые пользователь так и не проверил
+async def schedule_payment_reconciliation():
+    while True:
+        try:
+            confirmed, failed = await reconcile_pending_payments()
+            if confirmed or failed:
+                logger.info(f"Сверка платежей: подтверждено {confirmed}, отклонено {failed}")
+        except Exception as e:
+            logger.error(f"Ошибка при сверке платежей: {e}")
+        await asyncio.sleep(RECONCILE_INTERVAL)
+
+# Полный пересчет счетчиков статистики (страховка от расхождений)
+async def schedule_stats_recompute():
+    while True:
+        try:
+            values = await stats.recompute_counters()
+            logger.info(f"Счетчики статистики пересчитаны: {values}")
+        except Exception as e:
+            logger.error(f"Ошибка при пересчете статистики: {e}")
+        await asyncio.sleep(STATS_RECOMPUTE_INTERVAL)
+
+async def schedule_analytics_rollup():
+    # При запуске догоняет пропущенные дни, дальше — раз в сутки в ANALYTICS_ROLLUP_HOUR по Москве
+    while True:
+        try:
+            days = await analytics.refresh_rollups()
+            logger.info(f"Дневные сводки аналитики обновлены: {days} дней")
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении дневных сводок: {e}")
+        now = datetime.datetime.now(MSK)
+        next_run = now.replace(hour=ANALYTICS_ROLLUP_HOUR, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += datetime.timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+
+# Задачи, которые выполняет только реплика-лидер
+leader_jobs: list[asyncio.Task] = []
+
+async def start_leader_jobs():
+    payment_scheduler.start(process_payment_notifications, process_auto_payment)
+    leader_jobs.append(asyncio.create_task(schedule_payment_reconciliation()))
+    leader_jobs.append(asyncio.create_task(schedule_checkout_gc()))
+    leader_jobs.append(asyncio.create_task(schedule_stats_recompute()))
+    leader_jobs.append(asyncio.create_task(schedule_analytics_rollup()))
+    broadcast_worker.start()
+
+async def stop_leader_jobs():
+    await payment_scheduler.stop()
+    await broadcast_worker.stop()
+    for task in leader_jobs:
+        task.cancel()
+    await asyncio.gather(*leader_jobs, return_exceptions=True)
+    leader_jobs.clear()
+
+# Удаляем брошенные состояния FSM (незавершенные регистрации)
+async def schedule_fsm_cleanup():
+    while True:
+        try:
+            removed = await storage.purge_expired()
+            if removed:
+                logger.info(f"Удалено устаревших состояний FSM: {removed}")
+        except Exception as e:
+            logger.error(f"Ошибка при очистке состояний FSM: {e}")
+        await asyncio.sleep(FSM_CLEANUP_INTERVAL)
+
+async def tbank_create_rebill_payment(rebill_id: str, amount: float, order_id: str, description: str) -> dict | None:
+    """Создает рекуррентный платеж через Тинькофф (Init + Charge по RebillId).
+
+    Возвращает ответ GetState подтвержденного платежа или None. Если Init или
+    Charge не были отправлены из-за недоступности шлюза, пробрасывает
+    GatewayUnavailable.
+    """
+    payment_id = None
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload, headers=headers) as resp:
-                data = await resp.json()
-                if data.get("Success"):
-                    # Проверяем статус платежа
-                    payment_id = str(data["PaymentId"])
-                    for _ in range(3):  # Пробуем 3 раза
-                        await asyncio.sleep(5)  # Ждем 5 секунд
-                        payment_info = await tbank_get_payment_info(payment_id)
-                        if payment_info and payment_info.get("Status") == "CONFIRMED":
-                            return True
-                    return False
-                return False
+        data = await tbank_client.init(amount, order_id, description)
+        if not data.get("Success"):
+            logger.error(f"Ошибка Init рекуррентного платежа: {data}")
+            return None
+        payment_id = str(data["PaymentId"])
+        # Ожидание регистрируем до Charge, чтобы не пропустить раннее уведомление
+        notification_waiters.register(payment_id)
+        charge = await tbank_client.charge(payment_id, rebill_id)
+        if not charge.get("Success"):
+            logger.error(f"Ошибка Charge рекуррентного платежа {payment_id}: {charge}")
+            return None
+        if charge.get("Status") == "CONFIRMED":
+            return {**charge, "PaymentId": payment_id}
+        # Ждем уведомление шлюза; если оно не пришло (или ушло в другой процесс) — спрашиваем GetState
+        payment_info = await notification_waiters.wait(payment_id, timeout=15)
+        if not payment_info:
+            payment_info = await tbank_get_payment_info(payment_id)
+        if payment_info and payment_info.get("Status") == "CONFIRMED":
+            return {**payment_info, "PaymentId": payment_id}
+        return None
+    except GatewayUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при создании рекуррентного платежа: {e}")
-        return False
+        return None
+    finally:
+        if payment_id is not None:
+            notification_waiters.discard(payment_id)
+
+async def handle_tbank_notification(request: web.Request) -> web.Response:
+    """Уведомление Т-Банка о смене статуса платежа (NotificationURL).
+
+    Шлюз повторяет уведомление, пока не получит ответ «OK», поэтому
+    обработка идемпотентна, а при ошибке возвращается 500.
+    """
+    try:
+        payload = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(payload, dict) or not tbank_client.verify(payload):
+        logger.warning(f"Rejected T-Bank notification with invalid token from {request.remote}")
+        return web.Response(status=403)
+
+    payment_id = str(payload.get("PaymentId"))
+    status = payload.get("Status")
+    logger.info(f"T-Bank notification: payment {payment_id}, status {status}")
+    # Будим автоплатеж, ожидающий этот платеж в текущем процессе; «Проверить оплату» не пойдет в GetState
+    notification_waiters.resolve(payment_id, payload)
+    tbank_client.remember_state(payment_id, payload)
+    try:
+        if status == "CONFIRMED" and payload.get("Success"):
+            sub, confirmed = await confirm_payment(payment_id, payload)
+            if confirmed:
+                await send_payment_confirmed(sub)
+        elif status in FAILED_STATUSES:
+            await fail_payment(payment_id, payload)
+    except Exception as e:
+        logger.error(f"Ошибка обработки уведомления о платеже {payment_id}: {e}")
+        return web.Response(status=500)
+    return web.Response(text="OK")
+
+def create_webhook_app(with_telegram: bool = True) -> web.Application:
+    """aiohttp-приложение: обновления Telegram на WEBHOOK_PATH и уведомления Т-Банка."""
+    app = web.Application()
+    app.router.add_post(TBANK_NOTIFICATION_PATH, handle_tbank_notification)
+    if with_telegram:
+        # Запросы без верного X-Telegram-Bot-Api-Secret-Token отклоняются с 401
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    return app
+
+async def start_http_server(app: web.Application) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # reuse_port позволяет нескольким процессам слушать один порт, ядро распределяет соединения
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_WORKERS > 1)
+    await site.start()
+    return runner
+
+async def serve_webhook():
+    runner = await start_http_server(create_webhook_app())
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+def run_webhook_worker():
+    """Точка входа дополнительного процесса, обрабатывающего вебхук."""
+    asyncio.run(serve_webhook())
+
+def start_webhook_workers(count: int) -> list[multiprocessing.Process]:
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for _ in range(max(count, 0)):
+        worker = context.Process(target=run_webhook_worker, daemon=True)
+        worker.start()
+        workers.append(worker)
+    if workers:
+        logger.info(f"Started {len(workers)} additional webhook workers")
+    return workers
 
 async def main():
     logger.info("bot.py main() called!")
     logger.info("Initializing database...")
-    init_db()
+    await init_async_db()
     
     # Создаем базовый тариф, если его нет
-    with get_db() as db:
-        basic_tariff = db.query(TariffPlan).filter(TariffPlan.type == SubscriptionType.BASIC).first()
+    async with get_async_db() as db:
+        basic_tariff = await db.scalar(select(TariffPlan).where(TariffPlan.type == SubscriptionType.BASIC))
         if not basic_tariff:
             basic_tariff = TariffPlan(
                 type=SubscriptionType.BASIC,
@@ -944,21 +1483,50 @@ async def main():
                 is_active=True
             )
             db.add(basic_tariff)
-            db.commit()
+            await db.commit()
             logger.info("Basic tariff plan created")
     
     logger.info("Database initialized.")
 
-    try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        logger.info("Webhook deleted successfully")
-    except Exception as e:
-        logger.error(f"Failed to delete webhook: {e}")
+    if BOT_MODE == "webhook":
+        try:
+            await bot.set_webhook(
+                f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info("Webhook set successfully")
+        except Exception as e:
+            logger.error(f"Failed to set webhook: {e}")
+    else:
+        try:
+            await bot.delete_webhook(drop_pending_updates=True)
+            logger.info("Webhook deleted successfully")
+        except Exception as e:
+            logger.error(f"Failed to delete webhook: {e}")
 
-    # Запускаем планировщик автоплатежей
-    asyncio.create_task(schedule_auto_payments())
-    logger.info("Auto-payments scheduler started")
+    # Планировщик автоплатежей и сверка платежей работают только в реплике, удерживающей аренду лидера
+    leader_task = asyncio.create_task(scheduler_leader.run(start_leader_jobs, stop_leader_jobs))
+    asyncio.create_task(schedule_fsm_cleanup())
 
-    logger.info("Starting bot polling...")
-    await dp.start_polling(bot)
-    logger.info("Polling stopped!")
\ No newline at end of file
+    http_runner = None
+    try:
+        if BOT_MODE == "webhook":
+            # Дополнительные процессы только принимают обновления, планировщик работает здесь
+            start_webhook_workers(WEBHOOK_WORKERS - 1)
+            logger.info(f"Starting webhook server on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}...")
+            await serve_webhook()
+        else:
+            if TBANK_NOTIFICATION_URL:
+                # В режиме polling HTTP-сервер нужен только для уведомлений Т-Банка
+                http_runner = await start_http_server(create_webhook_app(with_telegram=False))
+                logger.info(f"Listening for T-Bank notifications on {WEBHOOK_HOST}:{WEBHOOK_PORT}{TBANK_NOTIFICATION_PATH}")
+            logger.info("Starting bot polling...")
+            await dp.start_polling(bot)
+            logger.info("Polling stopped!")
+    finally:
+        if http_runner is not None:
+            await http_runner.cleanup()
+        leader_task.cancel()
+        await asyncio.gather(leader_task, return_exceptions=True)
+        await tbank_client.close()
@@ -0,0 +1,371 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+
+from aiogram.types import BufferedInputFile
+from sqlalchemy import case, exists, func, insert, literal, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from config import BROADCAST_BATCH_SIZE, BROADCAST_POLL_INTERVAL
+from database import get_async_db
+from models import (
+    BroadcastJob, BroadcastRecipient, BroadcastStatus, MediaFile, RecipientStatus, Subscription, User, Whitelist
+)
+from send_queue import send_queue, PRIORITY_MARKETING
+
+logger = logging.getLogger(__name__)
+
+# Аудитории рассылки: ключ -> подпись в админ-панели
+AUDIENCES = {
+    'all': 'Всем пользователям',
+    'students': 'Ученикам (с доступом)',
+    'selected': 'Выбранному пользователю'
+}
+
+# Вид медиа -> метод бота; имя аргумента с файлом совпадает с видом
+MEDIA_METHODS = {
+    'photo': 'send_photo',
+    'video': 'send_video',
+    'animation': 'send_animation',
+    'document': 'send_document'
+}
+MAX_CAPTION_LENGTH = 1024  # лимит Telegram на подпись к медиа
+PHOTO_MAX_SIZE = 10 * 1024 * 1024  # фото больше этого Telegram не примет, такие уходят документом
+
+def media_kind(content_type: str | None, size: int) -> str:
+    """Вид медиа по MIME-типу загруженного файла."""
+    content_type = (content_type or '').lower()
+    if content_type.startswith('image/') and content_type != 'image/gif' and size <= PHOTO_MAX_SIZE:
+        return 'photo'
+    if content_type == 'image/gif':
+        return 'animation'
+    if content_type == 'video/mp4':
+        return 'video'
+    return 'document'
+
+def save_media(db, data: bytes, file_name: str, content_type: str | None) -> int:
+    """Сохраняет файл для рассылки (синхронная сессия) и возвращает его id.
+
+    Файлы различаются по sha256 содержимого: тот же файл в новой рассылке
+    получает прежнюю запись, а с ней и уже известный file_id — повторной
+    загрузки в Telegram не будет.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    media_id = db.scalar(select(MediaFile.id).where(MediaFile.sha256 == digest))
+    if media_id is not None:
+        return media_id
+    media = MediaFile(
+        sha256=digest,
+        kind=media_kind(content_type, len(data)),
+        file_name=os.path.basename(file_name or 'file')[:255] or 'file',
+        data=data
+    )
+    db.add(media)
+    try:
+        db.flush()
+    except IntegrityError:
+        # Тот же файл одновременно сохранил другой запрос
+        db.rollback()
+        return db.scalar(select(MediaFile.id).where(MediaFile.sha256 == digest))
+    return media.id
+
+def create_broadcast(db, text: str, audience: str, target_user_id: int | None = None,
+                     media_id: int | None = None) -> int:
+    """Ставит рассылку в очередь (синхронная сессия админ-панели) и возвращает ее id; отправляет воркер."""
+    job = BroadcastJob(text=text, audience=audience, target_user_id=target_user_id, media_id=media_id)
+    db.add(job)
+    db.flush()
+    job_id = job.id
+    db.commit()
+    broadcast_worker.wake_threadsafe()
+    return job_id
+
+def audience_query(job: BroadcastJob, now: datetime.datetime):
+    """select(job_id, user_id, telegram_id) всех получателей задачи."""
+    query = select(literal(job.id), User.id, User.telegram_id).where(User.telegram_id.isnot(None))
+    if job.audience == 'selected':
+        query = query.where(User.id == job.target_user_id)
+    elif job.audience == 'students':
+        query = query.where(or_(
+            exists().where(
+                Subscription.user_id == User.id,
+                Subscription.is_active == True,
+                Subscription.end_date > now
+            ),
+            exists().where(
+                Whitelist.telegram_id == User.telegram_id,
+                or_(Whitelist.expires_at.is_(None), Whitelist.expires_at > now)
+            )
+        ))
+    return query
+
+class BroadcastWorker:
+    """
+    Фоновая отправка рассылок из таблицы broadcast_jobs.
+
+    Админ-панель только создает задачу. Воркер берет ее, одним
+    INSERT ... SELECT записывает получателей в broadcast_recipients и
+    отправляет сообщения страницами по batch_size через send_queue (лимиты
+    Telegram, приоритет ниже платежных сообщений). После каждой страницы
+    статусы получателей и счетчики задачи сохраняются, поэтому после
+    перезапуска рассылка продолжается с неотправленных. Задачи выполняются
+    по одной в порядке создания.
+
+    Медиа загружается в Telegram только первому получателю; полученный
+    file_id сохраняется в media_files, и остальным (а также следующим
+    рассылкам с тем же файлом) уходит только идентификатор.
+    """
+
+    def __init__(self, batch_size: int, poll_interval: float):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.current_job: int | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Broadcast worker started")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self.current_job = None
+
+    def wake_threadsafe(self):
+        """Будит воркер из другого потока; без запущенного воркера задачу подхватит опрос."""
+        if self.running:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def stats(self) -> dict:
+        return {"running": self.running, "current_job": self.current_job}
+
+    async def _run(self):
+        while True:
+            try:
+                self._wakeup.clear()
+                job_id = await self._next_job()
+                if job_id is None:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                self.current_job = job_id
+                await self._process(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка воркера рассылок: {e}")
+                await asyncio.sleep(self.poll_interval)
+            finally:
+                self.current_job = None
+
+    async def _next_job(self) -> int | None:
+        """Прерванная перезапуском задача или следующая из очереди."""
+        async with get_async_db() as db:
+            job_id = await db.scalar(
+                select(BroadcastJob.id)
+                .where(BroadcastJob.status == BroadcastStatus.RUNNING)
+                .order_by(BroadcastJob.id)
+                .limit(1)
+            )
+            if job_id is not None:
+                logger.info(f"Resuming broadcast {job_id}")
+                return job_id
+
+            job = await db.scalar(
+                select(BroadcastJob)
+                .where(BroadcastJob.status == BroadcastStatus.PENDING)
+                .order_by(BroadcastJob.id)
+                .limit(1)
+            )
+            if job is None:
+                return None
+            now = datetime.datetime.now(datetime.timezone.utc)
+            claimed = await db.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job.id, BroadcastJob.status == BroadcastStatus.PENDING)
+                .values(status=BroadcastStatus.RUNNING, started_at=now)
+            )
+            if claimed.rowcount != 1:
+                await db.rollback()
+                return None
+            # Список получателей фиксируется в момент запуска
+            await db.execute(
+                insert(BroadcastRecipient).from_select(
+                    ['job_id', 'user_id', 'telegram_id'], audience_query(job, now)
+                )
+            )
+            total = await db.scalar(
+                select(func.count()).select_from(BroadcastRecipient).where(BroadcastRecipient.job_id == job.id)
+            )
+            await db.execute(update(BroadcastJob).where(BroadcastJob.id == job.id).values(total=total))
+            await db.commit()
+            logger.info(f"Broadcast {job.id} started: {total} recipients")
+            return job.id
+
+    async def _process(self, job_id: int):
+        last_user_id = 0
+        while True:
+            async with get_async_db() as db:
+                job = await db.get(BroadcastJob, job_id)
+                if job is None or job.status != BroadcastStatus.RUNNING:
+                    # Задачу отменили из админ-панели
+                    return
+                media = None
+                if job.media_id is not None:
+                    media = (await db.execute(
+                        select(MediaFile.id, MediaFile.kind, MediaFile.file_name, MediaFile.file_id)
+                        .where(MediaFile.id == job.media_id)
+                    )).one_or_none()
+                page = (await db.execute(
+                    select(BroadcastRecipient.user_id, BroadcastRecipient.telegram_id)
+                    .where(
+                        BroadcastRecipient.job_id == job_id,
+                        BroadcastRecipient.status == RecipientStatus.PENDING,
+                        BroadcastRecipient.user_id > last_user_id
+                    )
+                    .order_by(BroadcastRecipient.user_id)
+                    .limit(self.batch_size)
+                )).all()
+            if not page:
+                await self._finish(job_id)
+                return
+            last_user_id = page[-1].user_id
+
+            kind = file_ref = None
+            if media is not None:
+                kind, file_ref = media.kind, media.file_id
+                if file_ref is None:
+                    # Файл еще не загружен: первому получателю — загрузка, остальным — file_id
+                    kind, file_ref, page = await self._upload(job_id, media, job.text, page)
+                    if not page:
+                        continue
+
+            sends = [asyncio.ensure_future(self._send(row.telegram_id, job.text, kind, file_ref)) for row in page]
+            try:
+                await asyncio.gather(*sends, return_exceptions=True)
+            except asyncio.CancelledError:
+                # Остановка (выключение, смена лидера): уже отправленные сохраняем, чтобы не повторить их
+                await asyncio.shield(self._checkpoint(job_id, *self._results(page, sends)))
+                raise
+            await self._checkpoint(job_id, *self._results(page, sends))
+
+    @staticmethod
+    def _send(telegram_id: int, text: str, kind: str | None = None, file_ref=None):
+        if kind is None:
+            return send_queue.send_message(telegram_id, text, priority=PRIORITY_MARKETING)
+        return send_queue.enqueue(
+            telegram_id, MEDIA_METHODS[kind], PRIORITY_MARKETING, **{kind: file_ref}, caption=text or None
+        )
+
+    async def _upload(self, job_id: int, media, text: str, page) -> tuple[str | None, str | None, list]:
+        """
+        Отправляет файл получателям страницы по одному, пока Telegram не
+        вернет file_id (заблокировавшим бота отправить не получится).
+        Возвращает (вид, file_id, оставшиеся получатели страницы).
+        """
+        async with get_async_db() as db:
+            data = await db.scalar(select(MediaFile.data).where(MediaFile.id == media.id))
+        upload = BufferedInputFile(data, filename=media.file_name)
+        sent = []
+        errors = {}
+        try:
+            for i, row in enumerate(page):
+                try:
+                    message = await self._send(row.telegram_id, text, media.kind, upload)
+                except Exception as e:
+                    errors[row.user_id] = str(e)[:255]
+                    continue
+                sent.append(row.user_id)
+                uploaded = _uploaded_file(message)
+                if uploaded is None:
+                    continue
+                kind, file_id = uploaded
+                async with get_async_db() as db:
+                    # Telegram мог сменить вид (видео без звука — анимация); дальше шлем тем же методом
+                    await db.execute(update(MediaFile).where(MediaFile.id == media.id).values(kind=kind, file_id=file_id))
+                    await db.commit()
+                logger.info(f"Broadcast {job_id}: media {media.id} uploaded as {kind}")
+                await self._checkpoint(job_id, sent, errors)
+                return kind, file_id, page[i + 1:]
+        except asyncio.CancelledError:
+            await asyncio.shield(self._checkpoint(job_id, sent, errors))
+            raise
+        await self._checkpoint(job_id, sent, errors)
+        return None, None, []
+
+    @staticmethod
+    def _results(page, sends: list[asyncio.Future]) -> tuple[list[int], dict[int, str]]:
+        """Завершенные отправки страницы: (отправлено, {user_id: ошибка})."""
+        sent = []
+        errors = {}
+        for row, send in zip(page, sends):
+            if not send.done() or send.cancelled():
+                continue
+            if send.exception() is None:
+                sent.append(row.user_id)
+            else:
+                errors[row.user_id] = str(send.exception())[:255]
+        return sent, errors
+
+    async def _checkpoint(self, job_id: int, sent: list[int], errors: dict[int, str]):
+        """Сохраняет результат страницы: статусы получателей и счетчики задачи."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        async with get_async_db() as db:
+            if sent:
+                await db.execute(
+                    update(BroadcastRecipient)
+                    .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.user_id.in_(sent))
+                    .values(status=RecipientStatus.SENT, sent_at=now)
+                )
+            if errors:
+                await db.execute(
+                    update(BroadcastRecipient)
+                    .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.user_id.in_(errors))
+                    .values(status=RecipientStatus.FAILED, error=case(errors, value=BroadcastRecipient.user_id))
+                )
+            await db.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id)
+                .values(sent=BroadcastJob.sent + len(sent), failed=BroadcastJob.failed + len(errors))
+            )
+            await db.commit()
+
+    async def _finish(self, job_id: int):
+        async with get_async_db() as db:
+            await db.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id, BroadcastJob.status == BroadcastStatus.RUNNING)
+                .values(status=BroadcastStatus.DONE, finished_at=datetime.datetime.now(datetime.timezone.utc))
+            )
+            await db.commit()
+        logger.info(f"Broadcast {job_id} finished")
+
+def _uploaded_file(message) -> tuple[str, str] | None:
+    """(вид, file_id) медиа из отправленного сообщения."""
+    if message.photo:
+        # Самый большой размер; Telegram принимает его file_id для любой отправки фото
+        return 'photo', message.photo[-1].file_id
+    # У анимации заполнен и document, поэтому она проверяется раньше
+    for kind in ('video', 'animation', 'document'):
+        attachment = getattr(message, kind, None)
+        if attachment is not None:
+            return kind, attachment.file_id
+    return None
+
+broadcast_worker = BroadcastWorker(BROADCAST_BATCH_SIZE, BROADCAST_POLL_INTERVAL)
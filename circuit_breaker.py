@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Состояния предохранителя
+CLOSED = "closed"        # вызовы идут как обычно
+OPEN = "open"            # вызовы сразу отклоняются
+HALF_OPEN = "half_open"  # пропускается один пробный вызов
+
+class CircuitOpenError(Exception):
+    """Вызов отклонен без обращения к сервису: предохранитель разомкнут или нет свободных слотов."""
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса.
+
+    После failure_threshold ошибок подряд размыкается и reset_timeout секунд
+    отклоняет вызовы сразу, не дожидаясь таймаутов. Затем пропускает один
+    пробный вызов: успех замыкает цепь, ошибка снова размыкает ее.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probe = False
+
+    def allow(self) -> bool:
+        """Можно ли сейчас обращаться к сервису (без учета занятого пробного вызова)."""
+        return self.state == CLOSED or time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def before_call(self):
+        if self.state == CLOSED:
+            return
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self._probe = False
+        if self.state == HALF_OPEN and not self._probe:
+            self._probe = True
+            return
+        self.rejected += 1
+        raise CircuitOpenError(f"{self.name}: предохранитель разомкнут")
+
+    def cancel_probe(self):
+        """Пробный вызов так и не был выполнен — пропустить следующий."""
+        self._probe = False
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logger.info(f"Circuit {self.name} closed")
+        self.state = CLOSED
+        self.failures = 0
+        self._probe = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning(f"Circuit {self.name} opened after {self.failures} failures")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._probe = False
+
+    def stats(self) -> dict:
+        retry_in = 0.0
+        if self.state == OPEN:
+            retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "retry_in": round(retry_in, 1)
+        }
+
+class AdaptiveLimiter:
+    """
+    Адаптивный предел одновременных вызовов (AIMD).
+
+    Пока вызовы успешны и укладываются в latency_target, предел растет
+    примерно на единицу за «окно» из limit вызовов. При ошибке или медленном
+    ответе предел уменьшается вдвое, но не чаще раза в latency_target секунд:
+    пачка медленных ответов — одна перегрузка, а не десяток. Вызов, не получивший слот за
+    queue_timeout секунд, отклоняется — корутины не копятся за медленным сервисом.
+    """
+
+    def __init__(self, name: str, min_limit: int, max_limit: int, latency_target: float, queue_timeout: float):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.queue_timeout = queue_timeout
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.rejected = 0
+        self._decreased_at = 0.0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # Слот выдан одновременно с таймаутом — возвращаем его
+                self.release(None)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.name}: нет свободных слотов (предел {int(self.limit)})") from None
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self, latency: float | None, ok: bool = True):
+        """Освобождает слот; latency=None — вызов прерван, предел не меняется."""
+        if latency is not None:
+            if ok and latency <= self.latency_target:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif time.monotonic() - self._decreased_at >= self.latency_target:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self._decreased_at = time.monotonic()
+        self.in_flight -= 1
+        # Слот передается следующему ожидающему (in_flight учитывается сразу)
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "rejected": self.rejected
+        }
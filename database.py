@@ -1,8 +1,10 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, scoped_session
-from config import DATABASE_URL, DB_POOL_SIZE
+from config import DATABASE_URL, ASYNC_DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW
 from models import Base
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
 
 engine = create_engine(
     DATABASE_URL,
@@ -15,13 +17,48 @@ SessionLocal = scoped_session(
     sessionmaker(autocommit=False, autoflush=False, bind=engine)
 )
 
+# Асинхронные драйверы для синхронных URL из DATABASE_URL
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+}
+
+def get_async_database_url(url: str):
+    """Возвращает URL базы данных с асинхронным драйвером."""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+async_database_url = get_async_database_url(ASYNC_DATABASE_URL or DATABASE_URL)
+async_engine_options = {'pool_pre_ping': True, 'pool_recycle': 300}
+if async_database_url.get_backend_name() != 'sqlite':
+    async_engine_options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+
+async_engine = create_async_engine(async_database_url, **async_engine_options)
+
+# expire_on_commit=False: после commit атрибуты остаются доступны без
+# неявного обращения к БД, которое в asyncio невозможно
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
 def init_db():
     Base.metadata.create_all(bind=engine)
 
+async def init_async_db():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
 @contextmanager
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+@asynccontextmanager
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
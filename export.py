@@ -0,0 +1,124 @@
+import csv
+import datetime
+import enum
+import io
+import json
+import zlib
+
+from sqlalchemy import select
+
+from config import EXPORT_BATCH_SIZE
+from models import Payment, PaymentStatus, SessionLocal, Subscription, TariffPlan, User
+
+# Выгрузки: ключ -> подпись в админ-панели
+EXPORTS = {
+    'users': 'Пользователи',
+    'subscriptions': 'Подписки',
+    'payments': 'Платежи'
+}
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8'
+}
+CHUNK_SIZE = 64 * 1024  # байт в одном куске ответа
+
+def export_query(kind: str, date_from: datetime.datetime | None = None, date_to: datetime.datetime | None = None,
+                 status: PaymentStatus | None = None):
+    """
+    select выгрузки kind: только нужные колонки, без ORM-объектов.
+
+    Период [date_from, date_to) фильтрует по дате регистрации, начала
+    подписки или создания платежа; строки идут в порядке этой даты —
+    так их отдает индекс, и первые строки приходят без сортировки всей таблицы.
+    """
+    if kind == 'users':
+        date_column, id_column = User.registration_date, User.id
+        query = select(
+            User.id, User.telegram_id, User.telegram_username, User.email, User.registration_date,
+            User.last_active, User.is_active, User.referral_balance
+        )
+    elif kind == 'subscriptions':
+        date_column, id_column = Subscription.start_date, Subscription.id
+        query = (select(
+            Subscription.id, Subscription.user_id, User.email, TariffPlan.name.label('tariff'),
+            Subscription.start_date, Subscription.end_date, Subscription.is_active, Subscription.auto_renewal,
+            Subscription.payment_amount, Subscription.last_payment_date, Subscription.next_payment_date
+        )
+            .join(User, User.id == Subscription.user_id)
+            .join(TariffPlan, TariffPlan.id == Subscription.tariff_id))
+    elif kind == 'payments':
+        date_column, id_column = Payment.created_at, Payment.id
+        query = (select(
+            Payment.id, Payment.user_id, User.email, Payment.subscription_id, Payment.external_id,
+            Payment.amount, Payment.currency, Payment.status, Payment.payment_method,
+            Payment.created_at, Payment.completed_at, Payment.error_message
+        )
+            .join(User, User.id == Payment.user_id))
+        if status is not None:
+            query = query.where(Payment.status == status)
+    else:
+        raise ValueError(f"Неизвестная выгрузка: {kind}")
+
+    if date_from is not None:
+        query = query.where(date_column >= date_from)
+    if date_to is not None:
+        query = query.where(date_column < date_to)
+    return query.order_by(date_column, id_column)
+
+def _value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    return value
+
+def stream_export(query, fmt: str, compress: bool = False):
+    """
+    Генератор байтов выгрузки для потокового ответа.
+
+    Строки читаются серверным курсором пачками по EXPORT_BATCH_SIZE
+    (yield_per) и отдаются кусками по ~CHUNK_SIZE, поэтому память не растет
+    с размером выгрузки, а первые байты уходят сразу. С compress ответ —
+    gzip; каждый кусок сжимается с Z_SYNC_FLUSH и тоже уходит сразу.
+    Сессия открывается при первом чтении и закрывается, когда выгрузка
+    закончилась или клиент отключился.
+    """
+    db = SessionLocal()
+    try:
+        result = db.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        columns = list(result.keys())
+        buffer = io.StringIO()
+        compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 — формат gzip
+
+        def take() -> bytes:
+            data = buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            if compressor is not None:
+                data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            return data
+
+        if fmt == 'csv':
+            writer = csv.writer(buffer)
+            # BOM: иначе Excel открывает UTF-8 как cp1251
+            buffer.write('\ufeff')
+            writer.writerow(columns)
+
+            def write(row):
+                writer.writerow([_value(value) for value in row])
+        else:
+            def write(row):
+                record = {column: _value(value) for column, value in zip(columns, row)}
+                buffer.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+        for row in result:
+            write(row)
+            if buffer.tell() >= CHUNK_SIZE:
+                yield take()
+        data = take()
+        if compressor is not None:
+            data += compressor.flush()
+        if data:
+            yield data
+    finally:
+        db.close()
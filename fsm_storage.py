@@ -0,0 +1,108 @@
+import datetime
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from sqlalchemy import case, delete, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from database import async_engine, get_async_db
+from models import FSMStorageRecord
+
+logger = logging.getLogger(__name__)
+
+class SQLAlchemyStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в таблице fsm_storage.
+
+    Состояния переживают перезапуск и доступны всем процессам бота. Кэша в
+    памяти нет: следующий апдейт пользователя может попасть в другой процесс,
+    поэтому каждое чтение и запись — один запрос по первичному ключу.
+    Записи, не обновлявшиеся дольше state_ttl, считаются брошенными.
+    """
+
+    def __init__(self, state_ttl: int):
+        self.state_ttl = datetime.timedelta(seconds=state_ttl)
+
+    @staticmethod
+    def build_key(key: StorageKey) -> str:
+        parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+        if key.thread_id:
+            parts.append(str(key.thread_id))
+        parts.append(key.destiny)
+        return ":".join(parts)
+
+    async def _load(self, key: str) -> tuple[Optional[str], Dict[str, Any]]:
+        expired_before = datetime.datetime.now(datetime.timezone.utc) - self.state_ttl
+        async with get_async_db() as db:
+            record = (await db.execute(
+                select(FSMStorageRecord.state, FSMStorageRecord.data).where(
+                    FSMStorageRecord.key == key,
+                    FSMStorageRecord.updated_at > expired_before
+                )
+            )).one_or_none()
+        if record is None:
+            return None, {}
+        return record.state, json.loads(record.data or "{}")
+
+    async def _save(self, key: str, column: str, value: Optional[str], empty: bool):
+        """
+        Записывает одну колонку (state или data) без предварительного чтения.
+
+        Вторая колонка сохраняется, если запись не брошена; у брошенной она
+        сбрасывается, как если бы записи не было. Запись без состояния и
+        данных удаляется.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        other = FSMStorageRecord.data if column == "state" else FSMStorageRecord.state
+        insert = pg_insert if async_engine.dialect.name == "postgresql" else sqlite_insert
+        statement = insert(FSMStorageRecord).values(key=key, updated_at=now, **{column: value})
+        async with get_async_db() as db:
+            await db.execute(statement.on_conflict_do_update(
+                index_elements=["key"],
+                set_={
+                    column: value,
+                    other.key: case((FSMStorageRecord.updated_at > now - self.state_ttl, other), else_=None),
+                    "updated_at": now
+                }
+            ))
+            if empty:
+                await db.execute(
+                    delete(FSMStorageRecord).where(
+                        FSMStorageRecord.key == key,
+                        FSMStorageRecord.state.is_(None),
+                        or_(FSMStorageRecord.data.is_(None), FSMStorageRecord.data == "{}")
+                    )
+                )
+            await db.commit()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self._save(self.build_key(key), "state", state, empty=state is None)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self.build_key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._save(self.build_key(key), "data", json.dumps(dict(data), ensure_ascii=False), empty=not data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self.build_key(key))
+        return data
+
+    async def purge_expired(self) -> int:
+        """Удаляет брошенные состояния (например, незавершенные регистрации)."""
+        expired_before = datetime.datetime.now(datetime.timezone.utc) - self.state_ttl
+        async with get_async_db() as db:
+            result = await db.execute(
+                delete(FSMStorageRecord).where(FSMStorageRecord.updated_at <= expired_before)
+            )
+            await db.commit()
+        return result.rowcount
+
+    async def close(self) -> None:
+        pass
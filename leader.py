@@ -0,0 +1,96 @@
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable
+
+from sqlalchemy import case, delete, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import LEADER_LEASE_TTL
+from database import async_engine, get_async_db
+from models import LeaderLease
+
+logger = logging.getLogger(__name__)
+
+class LeaderElection:
+    """
+    Выбор лидера среди реплик бота через аренду в таблице leader_leases.
+
+    Лидер продлевает аренду каждые ttl/3 секунд. Если он упал или потерял
+    связь с БД, аренда истекает и через ttl секунд ее забирает другая
+    реплика. Работает и на PostgreSQL, и на SQLite. Повторное списание при
+    смене лидера дополнительно исключает захват подписки (renewal_claimed_until).
+    """
+
+    def __init__(self, name: str, ttl: int):
+        self.name = name
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.renew_interval = ttl / 3
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+
+    async def try_acquire(self) -> bool:
+        """Берет аренду, если она свободна или истекла, либо продлевает свою."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        insert = pg_insert if async_engine.dialect.name == "postgresql" else sqlite_insert
+        statement = insert(LeaderLease).values(
+            name=self.name,
+            holder=self.holder,
+            expires_at=now + self.ttl,
+            acquired_at=now
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=["name"],
+            set_={
+                "holder": self.holder,
+                "expires_at": now + self.ttl,
+                "acquired_at": case((LeaderLease.holder == self.holder, LeaderLease.acquired_at), else_=now)
+            },
+            where=or_(LeaderLease.holder == self.holder, LeaderLease.expires_at < now)
+        )
+        async with get_async_db() as db:
+            result = await db.execute(statement)
+            await db.commit()
+        return result.rowcount == 1
+
+    async def release(self):
+        """Освобождает аренду, чтобы другая реплика подхватила работу без ожидания ttl."""
+        async with get_async_db() as db:
+            await db.execute(
+                delete(LeaderLease).where(LeaderLease.name == self.name, LeaderLease.holder == self.holder)
+            )
+            await db.commit()
+        self.is_leader = False
+
+    async def run(self, on_elected: Callable[[], Awaitable[None]], on_revoked: Callable[[], Awaitable[None]]):
+        """Поддерживает аренду и вызывает on_elected / on_revoked при смене роли."""
+        try:
+            while True:
+                try:
+                    acquired = await self.try_acquire()
+                except Exception as e:
+                    # Без связи с БД аренду не продлить: считаем, что роль потеряна
+                    logger.error(f"Ошибка продления аренды {self.name}: {e}")
+                    acquired = False
+                if acquired and not self.is_leader:
+                    logger.info(f"Became leader for {self.name} ({self.holder})")
+                    self.is_leader = True
+                    await on_elected()
+                elif not acquired and self.is_leader:
+                    logger.warning(f"Lost leadership for {self.name} ({self.holder})")
+                    self.is_leader = False
+                    await on_revoked()
+                await asyncio.sleep(self.renew_interval)
+        finally:
+            if self.is_leader:
+                await on_revoked()
+                try:
+                    await self.release()
+                except Exception as e:
+                    logger.error(f"Ошибка освобождения аренды {self.name}: {e}")
+
+scheduler_leader = LeaderElection("payment_scheduler", LEADER_LEASE_TTL)
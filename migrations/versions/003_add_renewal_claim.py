@@ -0,0 +1,25 @@
+"""add renewal claim field
+
+Revision ID: 003
+Revises: 002
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '003'
+down_revision = '002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Захват подписки на время автоплатежа: пока срок не истек, другие воркеры ее не списывают
+    op.add_column('subscriptions', sa.Column('renewal_claimed_until', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('subscriptions', 'renewal_claimed_until')
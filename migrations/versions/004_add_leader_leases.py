@@ -0,0 +1,31 @@
+"""add leader leases table
+
+Revision ID: 004
+Revises: 003
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '004'
+down_revision = '003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Аренда роли лидера (планировщик автоплатежей) между репликами бота
+    op.create_table(
+        'leader_leases',
+        sa.Column('name', sa.String(100), primary_key=True),
+        sa.Column('holder', sa.String(255), nullable=False),
+        sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('acquired_at', sa.DateTime(timezone=True), nullable=False)
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('leader_leases')
@@ -0,0 +1,54 @@
+"""add scheduler and payment indexes
+
+Revision ID: 005
+Revises: 004
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '005'
+down_revision = '004'
+branch_labels = None
+depends_on = None
+
+
+def _renewal_due_where():
+    return sa.and_(
+        sa.column('auto_renewal') == sa.true(),
+        sa.column('is_active') == sa.true(),
+        sa.column('rebill_id').isnot(None)
+    )
+
+
+INDEXES = [
+    # (имя, таблица, колонки, доп. параметры)
+    ('idx_sub_renewal_due', 'subscriptions', ['next_payment_date', 'id'], {
+        'postgresql_where': _renewal_due_where(),
+        'sqlite_where': _renewal_due_where(),
+        'postgresql_include': ['notification_sent'],
+    }),
+    ('idx_sub_active_end', 'subscriptions', ['end_date'], {
+        'postgresql_where': sa.column('is_active') == sa.true(),
+        'sqlite_where': sa.column('is_active') == sa.true(),
+    }),
+    ('idx_payment_status_created', 'payments', ['status', 'created_at'], {}),
+    ('idx_payment_subscription_status', 'payments', ['subscription_id', 'status'], {}),
+]
+
+
+def upgrade() -> None:
+    # На PostgreSQL индексы строятся CONCURRENTLY, без блокировки записи в таблицы;
+    # такой CREATE INDEX нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        for name, table, columns, kwargs in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, **kwargs)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,32 @@
+"""add pending payments index
+
+Revision ID: 006
+Revises: 005
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '006'
+down_revision = '005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Частичный индекс: в нем только PENDING-платежи, поэтому он остается маленьким
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'idx_payment_pending', 'payments', ['id'],
+            postgresql_where=sa.column('status') == 'PENDING',
+            sqlite_where=sa.column('status') == 'PENDING',
+            postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('idx_payment_pending', table_name='payments', postgresql_concurrently=True)
@@ -0,0 +1,43 @@
+"""add user list pagination and search indexes
+
+Revision ID: 007
+Revises: 006
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '007'
+down_revision = '006'
+branch_labels = None
+depends_on = None
+
+# Индексы по выражению: в PostgreSQL с text_pattern_ops, чтобы LIKE 'abc%' шел по индексу
+PREFIX_INDEXES = [
+    ('idx_user_email_prefix', 'lower(email)'),
+    ('idx_user_username_prefix', 'lower(telegram_username)'),
+]
+
+
+def upgrade() -> None:
+    postgresql = op.get_context().dialect.name == 'postgresql'
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'idx_user_registration', 'users', ['registration_date', 'id'],
+            postgresql_concurrently=True
+        )
+        for name, expression in PREFIX_INDEXES:
+            if postgresql:
+                op.execute(f'CREATE INDEX CONCURRENTLY {name} ON users ({expression} text_pattern_ops)')
+            else:
+                op.create_index(name, 'users', [sa.text(expression)])
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, _ in reversed(PREFIX_INDEXES):
+            op.drop_index(name, table_name='users', postgresql_concurrently=True)
+        op.drop_index('idx_user_registration', table_name='users', postgresql_concurrently=True)
@@ -0,0 +1,30 @@
+"""add stats counters table
+
+Revision ID: 008
+Revises: 007
+Create Date: 2026-10-17 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '008'
+down_revision = '007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Счетчики дашборда; заполняются первым полным пересчетом при запуске бота
+    op.create_table(
+        'stats_counters',
+        sa.Column('name', sa.String(100), primary_key=True),
+        sa.Column('value', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.func.now())
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('stats_counters')
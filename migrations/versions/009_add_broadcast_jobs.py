@@ -0,0 +1,62 @@
+"""add broadcast jobs and recipients
+
+Revision ID: 009
+Revises: 008
+Create Date: 2026-10-17 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '009'
+down_revision = '008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Задачи рассылки и статус каждого получателя (возобновление после перезапуска)
+    op.create_table(
+        'broadcast_jobs',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.Column('audience', sa.String(20), nullable=False),
+        sa.Column('target_user_id', sa.Integer(), sa.ForeignKey('users.id', ondelete='SET NULL')),
+        sa.Column(
+            'status',
+            sa.Enum('PENDING', 'RUNNING', 'DONE', 'CANCELED', name='broadcaststatus'),
+            nullable=False
+        ),
+        sa.Column('total', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('sent', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('failed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False),
+        sa.Column('started_at', sa.DateTime(timezone=True)),
+        sa.Column('finished_at', sa.DateTime(timezone=True))
+    )
+    op.create_index('idx_broadcast_status', 'broadcast_jobs', ['status', 'id'])
+    op.create_table(
+        'broadcast_recipients',
+        sa.Column('job_id', sa.Integer(), sa.ForeignKey('broadcast_jobs.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('user_id', sa.Integer(), primary_key=True),
+        sa.Column('telegram_id', sa.BigInteger(), nullable=False),
+        sa.Column(
+            'status',
+            sa.Enum('PENDING', 'SENT', 'FAILED', name='recipientstatus'),
+            nullable=False
+        ),
+        sa.Column('error', sa.String()),
+        sa.Column('sent_at', sa.DateTime(timezone=True))
+    )
+    op.create_index('idx_broadcast_recipient_status', 'broadcast_recipients', ['job_id', 'status', 'user_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('idx_broadcast_recipient_status', table_name='broadcast_recipients')
+    op.drop_table('broadcast_recipients')
+    op.drop_index('idx_broadcast_status', table_name='broadcast_jobs')
+    op.drop_table('broadcast_jobs')
+    sa.Enum(name='recipientstatus').drop(op.get_bind(), checkfirst=True)
+    sa.Enum(name='broadcaststatus').drop(op.get_bind(), checkfirst=True)
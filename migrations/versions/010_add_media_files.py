@@ -0,0 +1,40 @@
+"""add media files for broadcasts
+
+Revision ID: 010
+Revises: 009
+Create Date: 2026-10-17 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '010'
+down_revision = '009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Медиа рассылок: файл загружается в Telegram один раз, дальше отправляется по file_id
+    op.create_table(
+        'media_files',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('sha256', sa.String(64), nullable=False),
+        sa.Column('kind', sa.String(20), nullable=False),
+        sa.Column('file_name', sa.String(255), nullable=False),
+        sa.Column('data', sa.LargeBinary(), nullable=False),
+        sa.Column('file_id', sa.String()),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False),
+        sa.UniqueConstraint('sha256', name='uq_media_sha256')
+    )
+    op.add_column(
+        'broadcast_jobs',
+        sa.Column('media_id', sa.Integer(), sa.ForeignKey('media_files.id', ondelete='SET NULL'))
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('broadcast_jobs', 'media_id')
+    op.drop_table('media_files')
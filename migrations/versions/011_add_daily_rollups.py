@@ -0,0 +1,47 @@
+"""add daily analytics rollups
+
+Revision ID: 011
+Revises: 010
+Create Date: 2026-10-17 22:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '011'
+down_revision = '010'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Дневные сводки; история заполняется командой python analytics.py
+    op.create_table(
+        'daily_rollups',
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('revenue', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('payments', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('new_subscriptions', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('renewals', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('failed_renewals', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('churned', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('active_subscribers', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.func.now())
+    )
+    # Платежи, выданные из админ-панели, сохранялись без времени оплаты
+    op.execute("UPDATE payments SET completed_at = created_at WHERE status = 'COMPLETED' AND completed_at IS NULL")
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'idx_payment_completed', 'payments', ['completed_at'],
+            postgresql_where=sa.column('status') == 'COMPLETED',
+            sqlite_where=sa.column('status') == 'COMPLETED',
+            postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('idx_payment_completed', table_name='payments', postgresql_concurrently=True)
+    op.drop_table('daily_rollups')
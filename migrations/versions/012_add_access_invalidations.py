@@ -0,0 +1,32 @@
+"""add access cache invalidations
+
+Revision ID: 012
+Revises: 011
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '012'
+down_revision = '011'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Сброс кэша доступа между процессами: каждый процесс бота читает новые строки
+    op.create_table(
+        'access_invalidations',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('telegram_id', sa.BigInteger(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False)
+    )
+    op.create_index('idx_access_invalidation_created', 'access_invalidations', ['created_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('idx_access_invalidation_created', table_name='access_invalidations')
+    op.drop_table('access_invalidations')
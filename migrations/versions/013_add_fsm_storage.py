@@ -0,0 +1,33 @@
+"""add fsm storage
+
+Revision ID: 013
+Revises: 012
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '013'
+down_revision = '012'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Состояния FSM aiogram (регистрация), общие для всех процессов бота
+    op.create_table(
+        'fsm_storage',
+        sa.Column('key', sa.String(255), primary_key=True),
+        sa.Column('state', sa.String(255)),
+        sa.Column('data', sa.Text()),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False)
+    )
+    op.create_index('idx_fsm_storage_updated', 'fsm_storage', ['updated_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('idx_fsm_storage_updated', table_name='fsm_storage')
+    op.drop_table('fsm_storage')
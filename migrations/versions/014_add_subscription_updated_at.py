@@ -0,0 +1,32 @@
+"""add subscription updated_at
+
+Revision ID: 014
+Revises: 013
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '014'
+down_revision = '013'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Планировщик автоплатежей раз в несколько секунд читает подписки, измененные после прошлого опроса
+    op.add_column(
+        'subscriptions',
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.func.now(), nullable=False)
+    )
+    with op.get_context().autocommit_block():
+        op.create_index('idx_sub_updated', 'subscriptions', ['updated_at'], postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('idx_sub_updated', table_name='subscriptions', postgresql_concurrently=True)
+    op.drop_column('subscriptions', 'updated_at')
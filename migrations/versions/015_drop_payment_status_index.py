@@ -0,0 +1,28 @@
+"""drop redundant payment status index
+
+Revision ID: 015
+Revises: 014
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '015'
+down_revision = '014'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # status — начало idx_payment_status_created; отдельный индекс только замедляет запись
+    # и перебивает частичный idx_payment_pending в плане сверки платежей
+    # Индекс создавался только через create_all, в базе его может не быть
+    with op.get_context().autocommit_block():
+        op.drop_index('idx_payment_status', table_name='payments', if_exists=True, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('idx_payment_status', 'payments', ['status'], postgresql_concurrently=True)
@@ -0,0 +1,25 @@
+"""add renewal error field
+
+Revision ID: 016
+Revises: 015
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '016'
+down_revision = '015'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Деньги списаны, а продление не записано: подписка снята с автоплатежей до ручной сверки
+    op.add_column('subscriptions', sa.Column('renewal_error', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('subscriptions', 'renewal_error')
@@ -1,9 +1,9 @@
 from sqlalchemy import (
     create_engine, Column, Integer, String, Boolean, DateTime, 
-    ForeignKey, BigInteger, Enum, Index, Float, Text, CheckConstraint
+    ForeignKey, BigInteger, Enum, Index, Float, Text, CheckConstraint, LargeBinary, Date
 )
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, literal
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
 from contextlib import contextmanager
@@ -30,6 +30,17 @@ class SubscriptionType(enum.Enum):
     PREMIUM = "premium"
     VIP = "vip"
 
+class BroadcastStatus(enum.Enum):
+    PENDING = "pending"  # ждет воркера
+    RUNNING = "running"
+    DONE = "done"
+    CANCELED = "canceled"
+
+class RecipientStatus(enum.Enum):
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+
 class User(Base):
     __tablename__ = 'users'
     
@@ -57,7 +68,17 @@ class User(Base):
     __table_args__ = (
         Index('idx_user_telegram', 'telegram_id'),
         Index('idx_user_email', 'email'),
-        Index('idx_user_active', 'is_active')
+        Index('idx_user_active', 'is_active'),
+        Index('idx_user_registration', 'registration_date', 'id'),  # постраничный список в админ-панели
+        # Поиск по началу email / username без учета регистра: lower(...) LIKE 'abc%'
+        Index(
+            'idx_user_email_prefix', func.lower(email).label('email_lower'),
+            postgresql_ops={'email_lower': 'text_pattern_ops'}
+        ),
+        Index(
+            'idx_user_username_prefix', func.lower(telegram_username).label('username_lower'),
+            postgresql_ops={'username_lower': 'text_pattern_ops'}
+        )
     )
 
     @hybrid_property
@@ -102,9 +123,15 @@ class Subscription(Base):
     rebill_id = Column(String)
     last_renewal_attempt = Column(DateTime(timezone=True))
     renewal_failed_count = Column(Integer, default=0)
+    renewal_claimed_until = Column(DateTime(timezone=True))  # Подписку списывает воркер, захват действует до этого момента
+    renewal_error = Column(String)  # Деньги списаны, а продление не записано: автоплатежи остановлены до ручной сверки
     notification_sent = Column(Boolean, default=False)  # Флаг отправки уведомления
     next_payment_date = Column(DateTime(timezone=True))  # Дата следующего платежа
+    last_payment_date = Column(DateTime(timezone=True))  # Дата последнего успешного платежа
+    failed_payments = Column(Integer, default=0, server_default='0', nullable=False)  # Неудачные попытки подряд
     payment_amount = Column(Float, default=1500.0)  # Сумма платежа
+    # Время последнего изменения: по нему планировщик подхватывает правки из других процессов
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
     
     # Связи
     user = relationship("User", back_populates="subscriptions")
@@ -115,6 +142,21 @@ class Subscription(Base):
     __table_args__ = (
         Index('idx_sub_user_active', 'user_id', 'is_active'),
         Index('idx_sub_dates', 'start_date', 'end_date'),
+        # Планировщик автоплатежей: только подписки с автопродлением, по сроку списания.
+        # notification_sent в INCLUDE — загрузка расписания читает только индекс (PostgreSQL)
+        Index(
+            'idx_sub_renewal_due', 'next_payment_date', 'id',
+            postgresql_where=(auto_renewal == True) & (is_active == True) & rebill_id.isnot(None),
+            sqlite_where=(auto_renewal == True) & (is_active == True) & rebill_id.isnot(None),
+            postgresql_include=['notification_sent']
+        ),
+        # Активные подписки по дате окончания (подписки, заканчивающиеся сегодня)
+        Index(
+            'idx_sub_active_end', 'end_date',
+            postgresql_where=(is_active == True),
+            sqlite_where=(is_active == True)
+        ),
+        Index('idx_sub_updated', 'updated_at'),
         CheckConstraint('end_date > start_date', name='valid_dates')
     )
 
@@ -146,10 +188,34 @@ class Payment(Base):
     # Индексы
     __table_args__ = (
         Index('idx_payment_user', 'user_id'),
-        Index('idx_payment_status', 'status'),
         Index('idx_payment_dates', 'created_at', 'completed_at'),
+        Index('idx_payment_status_created', 'status', 'created_at'),  # платежи со статусом за период
+        Index('idx_payment_subscription_status', 'subscription_id', 'status'),  # Subscription.payments + статус
+        # Оплаченные за день — дневные сводки аналитики
+        Index(
+            'idx_payment_completed', 'completed_at',
+            postgresql_where=(status == PaymentStatus.COMPLETED),
+            sqlite_where=(status == PaymentStatus.COMPLETED)
+        ),
+        # Незавершенные платежи по id — постраничная сверка со шлюзом
+        Index(
+            'idx_payment_pending', 'id',
+            postgresql_where=(status == PaymentStatus.PENDING),
+            sqlite_where=(status == PaymentStatus.PENDING)
+        ),
     )
 
+def payment_status_is(status: PaymentStatus):
+    """
+    Payment.status == status со значением прямо в тексте SQL.
+
+    Частичные индексы по статусу (idx_payment_pending, idx_payment_completed)
+    подходят только к условию с тем же значением. asyncpg кэширует
+    подготовленные запросы, и общий план PostgreSQL с параметром $1 такой
+    индекс не использует; литерал подходит к любому плану.
+    """
+    return Payment.status == literal(status, Payment.status.type, literal_execute=True)
+
 class Referral(Base):
     __tablename__ = 'referrals'
     
@@ -201,6 +267,108 @@ class Whitelist(Base):
         CheckConstraint('expires_at IS NULL OR expires_at > added_date', name='valid_expiration')
     )
 
+class FSMStorageRecord(Base):
+    __tablename__ = 'fsm_storage'
+    
+    key = Column(String(255), primary_key=True)  # bot_id:chat_id:user_id[:thread_id]:destiny
+    state = Column(String(255))
+    data = Column(Text)  # JSON с данными состояния
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    
+    __table_args__ = (
+        Index('idx_fsm_storage_updated', 'updated_at'),
+    )
+
+class LeaderLease(Base):
+    __tablename__ = 'leader_leases'
+    
+    name = Column(String(100), primary_key=True)  # роль, например payment_scheduler
+    holder = Column(String(255), nullable=False)  # hostname:pid:случайный суффикс процесса-лидера
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+    acquired_at = Column(DateTime(timezone=True), nullable=False)
+
+class MediaFile(Base):
+    __tablename__ = 'media_files'
+
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String(64), nullable=False)
+    kind = Column(String(20), nullable=False)  # photo, video, animation, document
+    file_name = Column(String(255), nullable=False)
+    data = Column(LargeBinary, nullable=False)  # исходный файл для первой загрузки в Telegram
+    file_id = Column(String)  # file_id после первой отправки; дальше файл не загружается
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        # Повторно загруженный в админ-панель файл находит уже сохраненный file_id
+        UniqueConstraint('sha256', name='uq_media_sha256'),
+    )
+
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+    
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)  # для медиа — подпись, может быть пустой
+    media_id = Column(Integer, ForeignKey('media_files.id', ondelete='SET NULL'))
+    audience = Column(String(20), nullable=False)  # all, students, selected
+    target_user_id = Column(Integer, ForeignKey('users.id', ondelete='SET NULL'))  # для audience=selected
+    status = Column(Enum(BroadcastStatus), default=BroadcastStatus.PENDING, nullable=False)
+    total = Column(Integer, default=0, nullable=False)
+    sent = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        Index('idx_broadcast_status', 'status', 'id'),
+    )
+
+class BroadcastRecipient(Base):
+    __tablename__ = 'broadcast_recipients'
+    
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id', ondelete='CASCADE'), primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    telegram_id = Column(BigInteger, nullable=False)
+    status = Column(Enum(RecipientStatus), default=RecipientStatus.PENDING, nullable=False)
+    error = Column(String)
+    sent_at = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        # Воркер читает неотправленных получателей задачи по user_id
+        Index('idx_broadcast_recipient_status', 'job_id', 'status', 'user_id'),
+    )
+
+class AccessInvalidation(Base):
+    __tablename__ = 'access_invalidations'
+
+    id = Column(Integer, primary_key=True)
+    telegram_id = Column(BigInteger, nullable=False)  # чью запись кэша доступа сбросить во всех процессах
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index('idx_access_invalidation_created', 'created_at'),
+    )
+
+class StatsCounter(Base):
+    __tablename__ = 'stats_counters'
+    
+    name = Column(String(100), primary_key=True)  # например users_total, revenue_total
+    value = Column(Float, nullable=False, default=0.0, server_default='0')
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class DailyRollup(Base):
+    __tablename__ = 'daily_rollups'
+
+    day = Column(Date, primary_key=True)  # сутки по Москве
+    revenue = Column(Float, nullable=False, default=0.0, server_default='0')
+    payments = Column(Integer, nullable=False, default=0, server_default='0')  # успешные платежи
+    new_subscriptions = Column(Integer, nullable=False, default=0, server_default='0')  # первая оплата подписки
+    renewals = Column(Integer, nullable=False, default=0, server_default='0')  # успешные автопродления
+    failed_renewals = Column(Integer, nullable=False, default=0, server_default='0')
+    churned = Column(Integer, nullable=False, default=0, server_default='0')  # оплаченные подписки, закончившиеся без продления
+    active_subscribers = Column(Integer, nullable=False, default=0, server_default='0')  # на конец суток
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
 class Admin(Base):
     __tablename__ = 'admins'
     
@@ -0,0 +1,312 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+from typing import Awaitable, Callable
+
+from sqlalchemy import and_, func, select
+
+from config import AUTO_PAYMENT_NOTIFY_BEFORE, SCHEDULER_CHANGES_INTERVAL, SCHEDULER_RELOAD_INTERVAL, RENEWAL_CONCURRENCY
+from database import get_async_db
+from models import Subscription
+
+logger = logging.getLogger(__name__)
+
+# Виды событий по подписке
+NOTIFY = "notify"  # уведомление о предстоящем списании
+CHARGE = "charge"  # автоплатеж
+
+# updated_at ставится в момент UPDATE, а видна строка после коммита: окно опроса перекрывается
+CHANGES_OVERLAP = datetime.timedelta(seconds=30)
+
+Handler = Callable[[int], Awaitable[None]]
+BatchHandler = Callable[[list[int]], Awaitable[None]]
+
+def _as_utc(value: datetime.datetime) -> datetime.datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+class PaymentScheduler:
+    """
+    Планировщик автоплатежей по сроку (min-heap).
+
+    В куче лежат ближайшие события (уведомление и списание) всех подписок с
+    автопродлением на горизонте reload_interval. Цикл спит ровно до ближайшего
+    события, поэтому в простое нет ни опросов БД, ни работы процессора.
+    Раз в changes_interval секунд планировщик читает подписки, у которых
+    изменился updated_at (оплата, отключение автоплатежа, правка в
+    админ-панели — в любом процессе), и пересчитывает их события; поэтому
+    изменение из другого процесса опаздывает не больше чем на changes_interval.
+    refresh() делает то же сразу для одной подписки, но только в процессе,
+    где планировщик запущен. Устаревшие элементы кучи не удаляются, а
+    пропускаются при извлечении. Раз в reload_interval куча строится заново.
+    Обработчики сами перепроверяют подписку в БД.
+
+    Списания выполняются параллельно, но не более charge_concurrency
+    одновременно — это предел нагрузки на платежный шлюз и пул соединений БД.
+    Уведомления, наступившие в один момент, передаются обработчику пачками
+    до notify_batch_size подписок.
+    """
+
+    def __init__(self, notify_before: datetime.timedelta, reload_interval: float, charge_concurrency: int,
+                 changes_interval: float = 5, retry_delay: float = 60, notify_batch_size: int = 500):
+        self.notify_before = notify_before
+        self.reload_interval = reload_interval
+        self.changes_interval = changes_interval
+        # Если обработчик не сдвинул дату списания (ошибка), повтор не раньше чем через retry_delay
+        self.retry_delay = datetime.timedelta(seconds=retry_delay)
+        self.notify_batch_size = notify_batch_size
+        self._heap: list[tuple[datetime.datetime, int, int, str]] = []
+        self._due: dict[tuple[int, str], datetime.datetime] = {}  # актуальный срок события
+        self._running: set[tuple[int, str]] = set()
+        self._charge_slots = asyncio.Semaphore(charge_concurrency)
+        self._seq = itertools.count()
+        self._horizon: datetime.datetime | None = None  # до какого срока события лежат в куче
+        self._since: datetime.datetime | None = None  # время БД прошлого опроса изменений
+        self._seen: set[tuple[int, datetime.datetime]] = set()  # уже примененные изменения окна
+        self._wakeup: asyncio.Event | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+        self._on_notify: BatchHandler | None = None
+        self._on_charge: Handler | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, on_notify: BatchHandler, on_charge: Handler):
+        if self.running:
+            return
+        self._on_notify = on_notify
+        self._on_charge = on_charge
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Payment scheduler started")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Начатые списания не прерываем: платеж мог уже пройти в банке
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        next_due = self._peek()
+        return {
+            "scheduled": len(self._due),
+            "heap_size": len(self._heap),
+            "in_progress": len(self._running),
+            "next_due": next_due.isoformat() if next_due else None,
+            "running": self.running
+        }
+
+    @staticmethod
+    def _eligible():
+        return and_(
+            Subscription.auto_renewal == True,
+            Subscription.is_active == True,
+            Subscription.rebill_id.isnot(None),
+            Subscription.next_payment_date.isnot(None),
+            Subscription.renewal_error.is_(None)  # ждет ручной сверки
+        )
+
+    def _push(self, subscription_id: int, kind: str, due: datetime.datetime):
+        key = (subscription_id, kind)
+        self._due[key] = due
+        seq = next(self._seq)
+        heapq.heappush(self._heap, (due, seq, subscription_id, kind))
+        # Будим цикл, если новое событие раньше того, до которого он спит
+        if self._heap[0][1] == seq and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _unschedule(self, subscription_id: int):
+        self._due.pop((subscription_id, NOTIFY), None)
+        self._due.pop((subscription_id, CHARGE), None)
+
+    def _schedule_row(self, subscription_id: int, next_payment_date: datetime.datetime, notification_sent: bool,
+                      not_before: datetime.datetime | None = None):
+        charge_at = _as_utc(next_payment_date)
+        # Уведомлять о списании, которое уже должно было произойти, незачем
+        if not notification_sent and charge_at > datetime.datetime.now(datetime.timezone.utc):
+            self._push(subscription_id, NOTIFY, charge_at - self.notify_before)
+        if not_before is not None and charge_at < not_before:
+            charge_at = not_before
+        self._push(subscription_id, CHARGE, charge_at)
+
+    def _peek(self) -> datetime.datetime | None:
+        """Срок ближайшего актуального события; устаревшие элементы выбрасываются."""
+        while self._heap:
+            due, _, subscription_id, kind = self._heap[0]
+            if self._due.get((subscription_id, kind)) == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    async def reload(self):
+        """Полностью перестраивает кучу по событиям на горизонте reload_interval."""
+        horizon = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.reload_interval)
+        async with get_async_db() as db:
+            # Все, что изменится после этого момента, подхватит poll_changes()
+            since = await db.scalar(select(func.now()))
+            rows = (await db.execute(
+                select(Subscription.id, Subscription.next_payment_date, Subscription.notification_sent)
+                .where(self._eligible(), Subscription.next_payment_date <= horizon + self.notify_before)
+            )).all()
+        self._heap = []
+        self._due = {}
+        self._horizon = horizon
+        if self._since is None:
+            self._since = since
+        for subscription_id, next_payment_date, notification_sent in rows:
+            self._schedule_row(subscription_id, next_payment_date, notification_sent)
+        logger.info(f"Payment scheduler loaded {len(rows)} subscriptions")
+
+    async def poll_changes(self) -> int:
+        """
+        Пересчитывает события подписок, измененных после прошлого опроса
+        (по часам БД, с перекрытием CHANGES_OVERLAP); возвращает их число.
+
+        Повтор списания после неудачи — не раньше last_renewal_attempt +
+        retry_delay: сам захват подписки тоже меняет updated_at.
+        """
+        async with get_async_db() as db:
+            now = await db.scalar(select(func.now()))
+            rows = (await db.execute(
+                select(
+                    Subscription.id, Subscription.updated_at, Subscription.next_payment_date,
+                    Subscription.notification_sent, Subscription.last_renewal_attempt,
+                    self._eligible().label('eligible')
+                )
+                .where(Subscription.updated_at >= self._since - CHANGES_OVERLAP)
+            )).all()
+        count = 0
+        for row in rows:
+            if (row.id, row.updated_at) in self._seen:
+                continue
+            self._unschedule(row.id)
+            if row.eligible and _as_utc(row.next_payment_date) <= self._horizon + self.notify_before:
+                not_before = None
+                if row.last_renewal_attempt is not None:
+                    not_before = _as_utc(row.last_renewal_attempt) + self.retry_delay
+                self._schedule_row(row.id, row.next_payment_date, row.notification_sent, not_before=not_before)
+            count += 1
+        # Строки окна прочитаются и в следующий раз; повторно их не применяем
+        self._seen = {(row.id, row.updated_at) for row in rows}
+        self._since = now
+        return count
+
+    async def refresh(self, subscription_id: int, not_before: datetime.datetime | None = None):
+        """
+        Перечитывает одну подписку после изменения (оплата, отключение автоплатежа).
+
+        Без запущенного планировщика (не лидер, воркер вебхуков) ничего не
+        делает — изменение подхватит poll_changes() в процессе-лидере.
+        """
+        if not self.running:
+            return
+        async with get_async_db() as db:
+            row = (await db.execute(
+                select(Subscription.next_payment_date, Subscription.notification_sent)
+                .where(Subscription.id == subscription_id, self._eligible())
+            )).first()
+        self._unschedule(subscription_id)
+        if row is not None:
+            self._schedule_row(subscription_id, *row, not_before=not_before)
+
+    def refresh_threadsafe(self, subscription_id: int):
+        """refresh() из другого потока (админ-панель); без запущенного планировщика ничего не делает."""
+        if self.running:
+            asyncio.run_coroutine_threadsafe(self.refresh(subscription_id), self._loop)
+
+    async def _run(self):
+        self._since = None
+        await self.reload()
+        reload_at = self._loop.time() + self.reload_interval
+        changes_at = self._loop.time() + self.changes_interval
+        while True:
+            try:
+                if self._loop.time() >= reload_at:
+                    await self.reload()
+                    reload_at = self._loop.time() + self.reload_interval
+                if self._loop.time() >= changes_at:
+                    await self.poll_changes()
+                    changes_at = self._loop.time() + self.changes_interval
+                self._fire_due()
+                next_due = self._peek()
+                timeout = min(reload_at, changes_at) - self._loop.time()
+                if next_due is not None:
+                    until_due = (next_due - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                    timeout = min(timeout, until_due)
+                self._wakeup.clear()
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике автоплатежей: {e}")
+                await asyncio.sleep(1)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _fire_due(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        notify_ids = []
+        while True:
+            due = self._peek()
+            if due is None or due > now:
+                break
+            _, _, subscription_id, kind = heapq.heappop(self._heap)
+            key = (subscription_id, kind)
+            del self._due[key]
+            if key in self._running:
+                continue
+            self._running.add(key)
+            if kind == NOTIFY:
+                notify_ids.append(subscription_id)
+            else:
+                self._spawn(self._handle_charge(subscription_id))
+        for i in range(0, len(notify_ids), self.notify_batch_size):
+            self._spawn(self._handle_notify(notify_ids[i:i + self.notify_batch_size]))
+
+    async def _handle_notify(self, subscription_ids: list[int]):
+        try:
+            await self._on_notify(subscription_ids)
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомлений о списании ({len(subscription_ids)} подписок): {e}")
+        finally:
+            for subscription_id in subscription_ids:
+                self._running.discard((subscription_id, NOTIFY))
+
+    async def _handle_charge(self, subscription_id: int):
+        key = (subscription_id, CHARGE)
+        try:
+            async with self._charge_slots:
+                await self._on_charge(subscription_id)
+        except Exception as e:
+            logger.error(f"Ошибка обработки автоплатежа подписки {subscription_id}: {e}")
+        finally:
+            self._running.discard(key)
+        # Подписка могла получить новую дату списания (продление, повторная попытка)
+        try:
+            not_before = datetime.datetime.now(datetime.timezone.utc) + self.retry_delay
+            await self.refresh(subscription_id, not_before=not_before)
+        except Exception as e:
+            logger.error(f"Ошибка обновления расписания подписки {subscription_id}: {e}")
+
+payment_scheduler = PaymentScheduler(
+    datetime.timedelta(seconds=AUTO_PAYMENT_NOTIFY_BEFORE),
+    SCHEDULER_RELOAD_INTERVAL,
+    RENEWAL_CONCURRENCY,
+    SCHEDULER_CHANGES_INTERVAL
+)
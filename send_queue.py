@@ -0,0 +1,209 @@
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+from config import SEND_RATE_GLOBAL, SEND_PROCESSES, SEND_RATE_PER_CHAT, SEND_WORKERS, SEND_MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше — раньше
+PRIORITY_PAYMENT = 0  # подтверждения оплат, автоплатежи, уведомления о списании
+PRIORITY_SERVICE = 1
+PRIORITY_MARKETING = 2  # рассылки
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """Забирает токен и возвращает 0 или возвращает, сколько секунд ждать до токена."""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        """Резервирует токен (баланс может уйти в минус) и ждет своей очереди — FIFO между ожидающими."""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        delay = max(self.paused_until - now, -self.tokens / self.rate if self.tokens < 0 else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+@dataclass(order=True)
+class SendJob:
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    method: str = field(compare=False)
+    kwargs: dict = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+
+class SendQueue:
+    """
+    Единая очередь исходящих сообщений Telegram.
+
+    Отправка ограничена token bucket процесса (его доля общего лимита
+    ~30 сообщений/с, см. SEND_PROCESSES) и отдельным bucket на каждый чат.
+    Ответ 429 (RetryAfter) приостанавливает чат и возвращает сообщение в
+    очередь. Платежные сообщения идут раньше рассылок, поэтому рассылка не
+    задерживает подтверждения продлений.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, workers: int, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.workers = workers
+        self.max_retries = max_retries
+        self.bot: Bot | None = None
+        self._queue: asyncio.PriorityQueue | None = None
+        self._chats: dict[int, TokenBucket] = {}
+        self._seq = itertools.count()
+        self._tasks: list[asyncio.Task] = []
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def _get_queue(self) -> asyncio.PriorityQueue:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        return self._queue
+
+    def start(self, bot: Bot):
+        if self.running:
+            return
+        self.bot = bot
+        self._loop = asyncio.get_running_loop()
+        queue = self._get_queue()
+        self._tasks = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        logger.info(f"Send queue started with {self.workers} workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, chat_id: int, method: str = "send_message", priority: int = PRIORITY_SERVICE,
+                **kwargs: Any) -> asyncio.Future:
+        """Ставит вызов метода бота в очередь; future завершится результатом или исключением."""
+        future = asyncio.get_running_loop().create_future()
+        job = SendJob(priority, next(self._seq), chat_id, method, kwargs, future)
+        self._get_queue().put_nowait(job)
+        return future
+
+    async def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_SERVICE, **kwargs: Any):
+        return await self.enqueue(chat_id, "send_message", priority, text=text, **kwargs)
+
+    def submit_threadsafe(self, chat_id: int, method: str = "send_message", priority: int = PRIORITY_SERVICE,
+                          **kwargs: Any) -> concurrent.futures.Future:
+        """Постановка в очередь из другого потока (например, из админ-панели)."""
+        async def submit():
+            return await self.enqueue(chat_id, method, priority, **kwargs)
+        return asyncio.run_coroutine_threadsafe(submit(), self._loop)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "chats_tracked": len(self._chats),
+            "running": self.running
+        }
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Забываем чаты, чей bucket уже полностью восстановился
+                self._chats = {k: v for k, v in self._chats.items() if not v.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+        return bucket
+
+    def _requeue(self, job: SendJob, delay: float):
+        self._loop.call_later(delay, self._queue.put_nowait, job)
+
+    async def _worker(self, queue: asyncio.PriorityQueue):
+        while True:
+            job: SendJob = await queue.get()
+            try:
+                if job.future.done():
+                    continue
+                chat_delay = self._chat_bucket(job.chat_id).take()
+                if chat_delay > 0:
+                    # Чат еще «остывает» — не занимаем воркер ожиданием
+                    self._requeue(job, chat_delay)
+                    continue
+                await self.global_bucket.acquire()
+                await self._execute(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Send queue worker error: {e}")
+            finally:
+                queue.task_done()
+
+    async def _execute(self, job: SendJob):
+        job.attempts += 1
+        try:
+            result = await getattr(self.bot, job.method)(chat_id=job.chat_id, **job.kwargs)
+        except TelegramRetryAfter as e:
+            self._chat_bucket(job.chat_id).pause(e.retry_after)
+            self._retry_or_fail(job, e, e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self._retry_or_fail(job, e, 2 ** job.attempts)
+        except Exception as e:
+            self.failed += 1
+            job.future.set_exception(e)
+        else:
+            self.sent += 1
+            job.future.set_result(result)
+
+    def _retry_or_fail(self, job: SendJob, error: Exception, delay: float):
+        if job.attempts > self.max_retries:
+            self.failed += 1
+            job.future.set_exception(error)
+            return
+        self.retried += 1
+        logger.warning(f"Retrying {job.method} to {job.chat_id} in {delay}s: {error}")
+        self._requeue(job, delay)
+
+# Bucket у каждого процесса свой: общий лимит Telegram делится между процессами бота
+send_queue = SendQueue(SEND_RATE_GLOBAL / SEND_PROCESSES, SEND_RATE_PER_CHAT, SEND_WORKERS, SEND_MAX_RETRIES)
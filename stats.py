@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from config import STATS_CACHE_TTL
+from database import get_async_db
+from models import Payment, PaymentStatus, StatsCounter, Subscription, TariffPlan, User
+
+logger = logging.getLogger(__name__)
+
+# Имена счетчиков в таблице stats_counters
+USERS_TOTAL = "users_total"
+USERS_ACTIVE = "users_active"
+SUBSCRIPTIONS_TOTAL = "subscriptions_total"
+SUBSCRIPTIONS_ACTIVE = "subscriptions_active"
+PAYMENTS_COMPLETED = "payments_completed"
+REVENUE_TOTAL = "revenue_total"
+TARIFF_PREFIX = "subscriptions_tariff_"  # + id тарифа: число подписок на тарифе
+
+def tariff_counter(tariff_id: int) -> str:
+    return f"{TARIFF_PREFIX}{tariff_id}"
+
+def _upsert(db, values: dict[str, float], replace: bool):
+    insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    # Строки в порядке имени: одинаковый порядок блокировок у конкурентных транзакций
+    statement = insert(StatsCounter).values([
+        {"name": name, "value": value} for name, value in sorted(values.items())
+    ])
+    value = statement.excluded.value if replace else StatsCounter.value + statement.excluded.value
+    return statement.on_conflict_do_update(
+        index_elements=["name"],
+        set_={"value": value, "updated_at": func.now()}
+    )
+
+def _increment_statement(db, deltas: dict[str, float]):
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    return _upsert(db, deltas, replace=False) if deltas else None
+
+def increment(db, deltas: dict[str, float]):
+    """Прибавляет deltas к счетчикам в транзакции db (синхронная сессия), без commit."""
+    statement = _increment_statement(db, deltas)
+    if statement is not None:
+        db.execute(statement)
+
+async def increment_async(db, deltas: dict[str, float]):
+    """То же для асинхронной сессии: счетчики меняются атомарно вместе с данными."""
+    statement = _increment_statement(db, deltas)
+    if statement is not None:
+        await db.execute(statement)
+
+async def recompute_counters() -> dict[str, float]:
+    """Полный пересчет счетчиков по таблицам — страховка от расхождений.
+
+    Сначала блокируются строки счетчиков (PostgreSQL): increment() из
+    конкурентных транзакций дождется записи пересчета и ляжет поверх нее, а
+    уже зафиксированные изменения попадут в агрегаты. Так приращения не
+    теряются и не учитываются дважды.
+    """
+    async with get_async_db() as db:
+        existing = (await db.scalars(
+            select(StatsCounter.name).order_by(StatsCounter.name).with_for_update()
+        )).all()
+
+        users_total, users_active = (await db.execute(
+            select(func.count(), func.count().filter(User.is_active == True)).select_from(User)
+        )).one()
+        subscriptions_total, subscriptions_active = (await db.execute(
+            select(func.count(), func.count().filter(Subscription.is_active == True)).select_from(Subscription)
+        )).one()
+        payments_completed, revenue_total = (await db.execute(
+            select(func.count(), func.coalesce(func.sum(Payment.amount), 0))
+            .where(Payment.status == PaymentStatus.COMPLETED)
+        )).one()
+        by_tariff = (await db.execute(
+            select(Subscription.tariff_id, func.count()).group_by(Subscription.tariff_id)
+        )).all()
+
+        values = {
+            USERS_TOTAL: users_total,
+            USERS_ACTIVE: users_active,
+            SUBSCRIPTIONS_TOTAL: subscriptions_total,
+            SUBSCRIPTIONS_ACTIVE: subscriptions_active,
+            PAYMENTS_COMPLETED: payments_completed,
+            REVENUE_TOTAL: float(revenue_total)
+        }
+        # Тарифы без подписок обнуляются
+        values.update({name: 0 for name in existing if name.startswith(TARIFF_PREFIX)})
+        values.update({tariff_counter(tariff_id): count for tariff_id, count in by_tariff})
+
+        await db.execute(_upsert(db, values, replace=True))
+        await db.commit()
+    stats_cache.invalidate()
+    return values
+
+class StatsCache:
+    """
+    Статистика дашборда из stats_counters с коротким кэшем в памяти процесса.
+
+    Чтение — два запроса к маленьким таблицам (счетчики и тарифы), поэтому
+    время ответа не зависит от числа пользователей и платежей.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._value: dict | None = None
+        self._expires_at = 0.0
+        # Flask обслуживает запросы в потоках
+        self._lock = threading.Lock()
+
+    def get(self, db) -> dict:
+        """Статистика для синхронной сессии db (админ-панель)."""
+        with self._lock:
+            if self._value is not None and time.monotonic() < self._expires_at:
+                return self._value
+        counters = {name: value for name, value in db.execute(select(StatsCounter.name, StatsCounter.value))}
+        tariffs = {tariff_id: tariff_type for tariff_id, tariff_type in db.execute(select(TariffPlan.id, TariffPlan.type))}
+        value = self._build(counters, tariffs)
+        with self._lock:
+            self._value = value
+            self._expires_at = time.monotonic() + self.ttl
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+
+    @staticmethod
+    def _build(counters: dict[str, float], tariffs: dict) -> dict:
+        subscription_types = Counter()
+        for name, value in counters.items():
+            if name.startswith(TARIFF_PREFIX):
+                tariff_type = tariffs.get(int(name[len(TARIFF_PREFIX):]))
+                if tariff_type is not None:
+                    subscription_types[str(tariff_type.value)] += int(value)
+        return {
+            'total_users': int(counters.get(USERS_TOTAL, 0)),
+            'active_users': int(counters.get(USERS_ACTIVE, 0)),
+            'total_subscriptions': int(counters.get(SUBSCRIPTIONS_TOTAL, 0)),
+            'active_subscriptions': int(counters.get(SUBSCRIPTIONS_ACTIVE, 0)),
+            'completed_payments': int(counters.get(PAYMENTS_COMPLETED, 0)),
+            'total_revenue': round(counters.get(REVENUE_TOTAL, 0.0), 2),
+            'subscription_types': dict(subscription_types)
+        }
+
+stats_cache = StatsCache(STATS_CACHE_TTL)
@@ -0,0 +1,292 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import random
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from config import (
+    TBANK_SHOP_ID,
+    TBANK_SECRET_KEY,
+    TBANK_API_URL,
+    TBANK_TIMEOUT,
+    TBANK_CONNECTIONS_PER_HOST,
+    TBANK_RETRIES,
+    TBANK_NOTIFICATION_URL,
+    TBANK_STATE_CACHE_TTL,
+    TBANK_STATE_CACHE_MAX_SIZE,
+    TBANK_BREAKER_FAILURES,
+    TBANK_BREAKER_RESET,
+    TBANK_MIN_CONCURRENCY,
+    TBANK_LATENCY_TARGET,
+    TBANK_QUEUE_TIMEOUT
+)
+from circuit_breaker import AdaptiveLimiter, CircuitBreaker, CircuitOpenError
+from singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+def generate_token(params: dict, secret_key: str) -> str:
+    params = dict(params)
+    params.pop('Token', None)
+    params['Password'] = secret_key
+    sorted_keys = sorted(params.keys())
+    values_str = ''.join(str(params[k]) for k in sorted_keys)
+    return hashlib.sha256(values_str.encode('utf-8')).hexdigest()
+
+# Конечные статусы платежа: после них уведомлений по платежу больше не будет
+FINAL_STATUSES = {"CONFIRMED", "REJECTED", "CANCELED", "DEADLINE_EXPIRED", "AUTH_FAIL", "REFUNDED"}
+# Статусы, при которых оплата уже не состоится
+FAILED_STATUSES = {"REJECTED", "CANCELED", "DEADLINE_EXPIRED", "AUTH_FAIL"}
+
+def _token_value(value) -> str:
+    # В уведомлениях булевы значения подписываются как "true"/"false"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+def verify_notification(payload: dict, secret_key: str) -> bool:
+    """Проверяет Token уведомления шлюза (вложенные объекты в подписи не участвуют)."""
+    token = payload.get("Token")
+    if not isinstance(token, str):
+        return False
+    sign_params = {k: _token_value(v) for k, v in payload.items() if not isinstance(v, (dict, list))}
+    return hmac.compare_digest(generate_token(sign_params, secret_key), token)
+
+class TBankError(Exception):
+    """Ошибка обращения к платежному шлюзу Т-Банка."""
+
+class GatewayUnavailable(TBankError):
+    """Запрос не отправлен: шлюз недоступен или перегружен (предохранитель, нет слотов)."""
+
+class TBankClient:
+    """
+    Клиент API Т-Банка (securepay) с одной долгоживущей HTTP-сессией.
+
+    Соединения переиспользуются (keep-alive), поэтому TCP+TLS рукопожатие
+    выполняется один раз на соединение, а не на каждый вызов. Временные
+    ошибки повторяются с экспоненциальной задержкой и случайным джиттером.
+
+    Одновременные GetState по одному PaymentId объединяются в один запрос,
+    а ответы с конечным статусом кэшируются на state_cache_ttl секунд.
+
+    Каждая попытка идет через предохранитель и адаптивный предел
+    одновременных запросов (не выше connections_per_host). Если шлюз
+    недоступен или перегружен, запрос не отправляется и выбрасывается
+    GatewayUnavailable — вызывающий сразу знает, что запрос не дошел до шлюза.
+    """
+
+    def __init__(self, terminal_key: str, secret_key: str, base_url: str = TBANK_API_URL,
+                 timeout: float = TBANK_TIMEOUT, connections_per_host: int = TBANK_CONNECTIONS_PER_HOST,
+                 retries: int = TBANK_RETRIES, notification_url: str = TBANK_NOTIFICATION_URL,
+                 state_cache_ttl: float = TBANK_STATE_CACHE_TTL, state_cache_max_size: int = TBANK_STATE_CACHE_MAX_SIZE):
+        self.terminal_key = terminal_key
+        self.secret_key = secret_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 5))
+        self.connections_per_host = connections_per_host
+        self.retries = retries
+        self.notification_url = notification_url
+        self.state_cache_ttl = state_cache_ttl
+        self.state_cache_max_size = state_cache_max_size
+        self._final_states: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._state_flight = SingleFlight()
+        self.breaker = CircuitBreaker("tbank", TBANK_BREAKER_FAILURES, TBANK_BREAKER_RESET)
+        self.limiter = AdaptiveLimiter(
+            "tbank", min(TBANK_MIN_CONCURRENCY, connections_per_host), connections_per_host,
+            TBANK_LATENCY_TARGET, TBANK_QUEUE_TIMEOUT
+        )
+        self._session: aiohttp.ClientSession | None = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Сессия создается лениво: ей нужен запущенный event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.connections_per_host,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Content-Type": "application/json"}
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def sign(self, payload: dict) -> dict:
+        """Добавляет в запрос TerminalKey и Token (вложенные объекты в подписи не участвуют)."""
+        payload = {"TerminalKey": self.terminal_key, **payload}
+        sign_params = {k: v for k, v in payload.items() if not isinstance(v, (dict, list))}
+        payload["Token"] = generate_token(sign_params, self.secret_key)
+        return payload
+
+    async def request(self, method: str, payload: dict, idempotent: bool = False) -> dict:
+        """
+        Выполняет метод API и возвращает ответ шлюза.
+
+        Неидемпотентные методы (Init, Charge) повторяются только если запрос
+        гарантированно не дошел до шлюза (ошибка установки соединения),
+        чтобы не создать повторное списание.
+        """
+        url = f"{self.base_url}/{method}"
+        body = self.sign(payload)
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._attempt(method, url, body, retry_5xx=idempotent and attempt < self.retries)
+            except CircuitOpenError as e:
+                raise GatewayUnavailable(f"Запрос {method} не отправлен: {e}") from e
+            except (aiohttp.ClientConnectorError, aiohttp.ClientResponseError,
+                    aiohttp.ServerDisconnectedError, asyncio.TimeoutError) as e:
+                retriable = idempotent or isinstance(e, aiohttp.ClientConnectorError)
+                if not retriable or attempt >= self.retries:
+                    raise TBankError(f"Ошибка запроса {method}: {e!r}") from e
+                delay = min(0.25 * 2 ** attempt, 5) * random.uniform(0.5, 1.5)
+                logger.warning(f"T-Bank {method} attempt {attempt + 1} failed: {e!r}, retry in {delay:.2f}s")
+                await asyncio.sleep(delay)
+        raise TBankError(f"Ошибка запроса {method}")
+
+    async def _attempt(self, method: str, url: str, body: dict, retry_5xx: bool) -> dict:
+        """Одна попытка запроса через предохранитель и адаптивный предел."""
+        self.breaker.before_call()
+        try:
+            await self.limiter.acquire()
+        except BaseException:
+            self.breaker.cancel_probe()
+            raise
+        started = time.monotonic()
+        healthy = None
+        try:
+            async with self._get_session().post(url, json=body) as resp:
+                healthy = resp.status < 500
+                if not healthy and retry_5xx:
+                    raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+                text = await resp.text()
+                try:
+                    return await resp.json(content_type=None)
+                except ValueError:
+                    healthy = False
+                    raise TBankError(f"Некорректный ответ {method}: {resp.status}, ответ: {text}")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+            raise
+        finally:
+            # Отмена вызывающим (healthy is None) ничего не говорит о шлюзе
+            self.limiter.release(time.monotonic() - started if healthy is not None else None, bool(healthy))
+            if healthy:
+                self.breaker.record_success()
+            elif healthy is False:
+                self.breaker.record_failure()
+            else:
+                self.breaker.cancel_probe()
+
+    @property
+    def available(self) -> bool:
+        """False, пока предохранитель разомкнут: запросы к шлюзу будут сразу отклонены."""
+        return self.breaker.allow()
+
+    def stats(self) -> dict:
+        return {
+            "breaker": self.breaker.stats(),
+            "concurrency": self.limiter.stats(),
+            "cached_states": len(self._final_states)
+        }
+
+    async def init(self, amount: float, order_id: str, description: str, **extra) -> dict:
+        """Init: создает платеж (сумма в рублях, в запрос уходит в копейках)."""
+        payload = {
+            "Amount": int(round(amount * 100)),
+            "OrderId": order_id,
+            "Description": description,
+            **extra
+        }
+        if self.notification_url:
+            payload.setdefault("NotificationURL", self.notification_url)
+        return await self.request("Init", payload)
+
+    async def get_state(self, payment_id: str) -> dict:
+        """GetState: текущий статус платежа."""
+        payment_id = str(payment_id)
+        cached = self._cached_state(payment_id)
+        if cached is not None:
+            return cached
+        state = await self._state_flight.do(
+            payment_id, lambda: self.request("GetState", {"PaymentId": payment_id}, idempotent=True)
+        )
+        self.remember_state(payment_id, state)
+        return dict(state)
+
+    def _cached_state(self, payment_id: str) -> dict | None:
+        entry = self._final_states.get(payment_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.state_cache_ttl:
+            del self._final_states[payment_id]
+            return None
+        return dict(entry[1])
+
+    def remember_state(self, payment_id: str, state: dict):
+        """Запоминает конечный статус платежа (из GetState или уведомления)."""
+        if not state.get("Success") or state.get("Status") not in FINAL_STATUSES:
+            return
+        self._final_states[str(payment_id)] = (time.monotonic(), dict(state))
+        self._final_states.move_to_end(str(payment_id))
+        while len(self._final_states) > self.state_cache_max_size:
+            self._final_states.popitem(last=False)
+
+    async def charge(self, payment_id: str, rebill_id: str) -> dict:
+        """Charge: списание по сохраненной карте (RebillId) для платежа, созданного через Init."""
+        return await self.request("Charge", {"PaymentId": payment_id, "RebillId": rebill_id})
+
+    def verify(self, payload: dict) -> bool:
+        """Уведомление пришло от шлюза для нашего терминала."""
+        return payload.get("TerminalKey") == self.terminal_key and verify_notification(payload, self.secret_key)
+
+class NotificationWaiters:
+    """
+    Ожидание уведомлений шлюза о конкретных платежах внутри процесса.
+
+    Ожидание регистрируется до запроса к шлюзу, чтобы не пропустить
+    уведомление, пришедшее раньше ответа. Уведомление могло уйти в другой
+    процесс, поэтому после таймаута вызывающий сам опрашивает GetState.
+    """
+
+    def __init__(self):
+        self._futures: dict[str, asyncio.Future] = {}
+
+    def register(self, payment_id: str) -> asyncio.Future:
+        future = self._futures.get(payment_id)
+        if future is None or future.done():
+            future = self._futures[payment_id] = asyncio.get_running_loop().create_future()
+        return future
+
+    async def wait(self, payment_id: str, timeout: float) -> dict | None:
+        """Ждет уведомление с конечным статусом; None — если не пришло за timeout секунд."""
+        future = self.register(payment_id)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            if self._futures.get(payment_id) is future:
+                del self._futures[payment_id]
+
+    def discard(self, payment_id: str):
+        self._futures.pop(payment_id, None)
+
+    def resolve(self, payment_id: str, payload: dict):
+        if payload.get("Status") not in FINAL_STATUSES:
+            return
+        future = self._futures.get(payment_id)
+        if future is not None and not future.done():
+            future.set_result(payload)
+
+tbank_client = TBankClient(TBANK_SHOP_ID, TBANK_SECRET_KEY)
+notification_waiters = NotificationWaiters()
@@ -0,0 +1,33 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+# Модули читают настройки при импорте: тестовая БД задается до них
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from database import async_engine, engine
+from models import Base
+
+@pytest.fixture(autouse=True)
+def schema():
+    """Чистая схема для каждого теста."""
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    yield
+
+@pytest.fixture
+def run():
+    """Выполняет корутину в новом цикле событий; соединения асинхронного движка к нему привязаны."""
+    def runner(coro):
+        async def wrapped():
+            try:
+                return await coro
+            finally:
+                await async_engine.dispose()
+        return asyncio.run(wrapped())
+    return runner
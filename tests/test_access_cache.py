@@ -0,0 +1,39 @@
+import datetime
+
+from access_cache import InvalidationPoller, access_cache, get_access, publish_access_change
+from database import SessionLocal
+from models import Subscription, TariffPlan, SubscriptionType, User
+
+def test_change_from_another_process_invalidates_cached_access(run):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with SessionLocal() as db:
+        tariff = TariffPlan(type=SubscriptionType.BASIC, name="basic", price=1500, duration_days=30)
+        user = User(telegram_id=42, email="user@example.com")
+        db.add_all([tariff, user])
+        db.flush()
+        subscription = Subscription(
+            user_id=user.id, tariff_id=tariff.id, start_date=now, end_date=now + datetime.timedelta(days=1)
+        )
+        db.add(subscription)
+        db.commit()
+        subscription_id = subscription.id
+    poller = InvalidationPoller(interval=0, retention=3600)
+
+    async def scenario():
+        access_cache.clear()
+        await poller.poll()  # первый опрос только запоминает момент
+        assert (await get_access(42)).has_access(now)
+
+        # Отмена в админ-панели: другой процесс, локальный кэш бота она не видит
+        with SessionLocal() as db:
+            db.get(Subscription, subscription_id).is_active = False
+            publish_access_change(db, 42)
+            db.commit()
+        assert (await get_access(42)).has_access(now)
+
+        assert await poller.poll() == 1
+        assert not (await get_access(42)).has_access(now)
+        # Уже примененный сброс повторно не применяется
+        assert await poller.poll() == 0
+
+    run(scenario())
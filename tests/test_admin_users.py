@@ -0,0 +1,34 @@
+import datetime
+
+from admin_panel.app import decode_cursor, encode_cursor, users_by_subscription_end
+from models import Payment, PaymentMethod, PaymentStatus, SessionLocal, Subscription, SubscriptionType, TariffPlan, User
+
+def test_subscription_end_pages_show_each_user_once_by_latest_subscription():
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    with SessionLocal() as db:
+        tariff = TariffPlan(type=SubscriptionType.BASIC, name="Базовый", price=1500, duration_days=30)
+        users = [User(telegram_id=i, email=f"user{i}@example.com") for i in range(1, 4)]
+        db.add_all(users)
+        # У первого две активные оплаченные подписки, у второго одна, у третьего нет
+        for user, days in [(users[0], 1), (users[0], 3), (users[1], 2)]:
+            sub = Subscription(user=user, tariff=tariff, start_date=now - datetime.timedelta(days=30),
+                               end_date=now + datetime.timedelta(days=days), is_active=True)
+            db.add(Payment(user=user, subscription=sub, amount=1500, status=PaymentStatus.COMPLETED,
+                           payment_method=PaymentMethod.CARD))
+        db.commit()
+
+        order = []
+        position = None
+        while True:
+            rows = users_by_subscription_end(db, None, position, 2, now)
+            user, end_date = rows[0]
+            order.append((user.telegram_id, end_date and end_date.replace(tzinfo=datetime.timezone.utc)))
+            if len(rows) < 2:
+                break
+            position = decode_cursor(encode_cursor(end_date, user.id))
+
+    assert order == [
+        (1, now + datetime.timedelta(days=3)),
+        (2, now + datetime.timedelta(days=2)),
+        (3, None)
+    ]
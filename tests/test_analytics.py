@@ -0,0 +1,9 @@
+import datetime
+
+from analytics import day_bounds
+
+def test_day_bounds_follow_moscow_midnight():
+    start, end = day_bounds(datetime.date(2026, 3, 1))
+    utc = datetime.timezone.utc
+    assert start.astimezone(utc) == datetime.datetime(2026, 2, 28, 21, 0, tzinfo=utc)
+    assert end.astimezone(utc) == datetime.datetime(2026, 3, 1, 21, 0, tzinfo=utc)
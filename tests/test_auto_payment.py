@@ -0,0 +1,86 @@
+import datetime
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import bot
+from database import SessionLocal
+from models import Payment, PaymentStatus, Subscription, SubscriptionType, TariffPlan, User
+
+@pytest.fixture
+def charges(monkeypatch):
+    """Списания через шлюз (подменен) — их число и есть проверка."""
+    calls = []
+
+    async def create_rebill_payment(**kwargs):
+        calls.append(kwargs)
+        return {"Success": True, "PaymentId": f"payment-{len(calls)}"}
+
+    async def notify_user(telegram_id, message):
+        pass
+
+    monkeypatch.setattr(bot, "tbank_create_rebill_payment", create_rebill_payment)
+    monkeypatch.setattr(bot, "notify_user", notify_user)
+    monkeypatch.setattr(bot, "RENEWAL_SAVE_RETRY_DELAY", 0)
+    return calls
+
+def fail_completed_payment_commits(monkeypatch, times: int):
+    """Первые times коммитов с записью успешного платежа падают, как при сбое БД."""
+    commit = AsyncSession.commit
+    failed = []
+
+    async def failing_commit(self):
+        if len(failed) < times and any(
+            isinstance(obj, Payment) and obj.status == PaymentStatus.COMPLETED for obj in self.sync_session.new
+        ):
+            failed.append(True)
+            await self.rollback()
+            raise ConnectionError("connection lost")
+        await commit(self)
+
+    monkeypatch.setattr(AsyncSession, "commit", failing_commit)
+
+def due_subscription() -> int:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with SessionLocal() as db:
+        sub = Subscription(
+            user=User(telegram_id=1, email="user@example.com"),
+            tariff=TariffPlan(type=SubscriptionType.BASIC, name="Базовый", price=1500, duration_days=30),
+            start_date=now - datetime.timedelta(days=30), end_date=now + datetime.timedelta(minutes=2),
+            is_active=True, auto_renewal=True, rebill_id="rebill", next_payment_date=now - datetime.timedelta(seconds=1)
+        )
+        db.add(sub)
+        db.commit()
+        return sub.id
+
+def test_charge_is_not_repeated_when_its_result_cannot_be_saved(run, monkeypatch, charges):
+    subscription_id = due_subscription()
+    fail_completed_payment_commits(monkeypatch, times=bot.RENEWAL_SAVE_ATTEMPTS)
+
+    run(bot.process_auto_payment(subscription_id))
+    assert len(charges) == 1
+
+    # И после истечения обычного захвата подписка больше не захватывается и не списывается
+    later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=bot.RENEWAL_CLAIM_TIMEOUT + 60)
+    assert run(bot.claim_auto_payment(subscription_id, later)) is None
+    run(bot.process_auto_payment(subscription_id))
+    assert len(charges) == 1
+
+    with SessionLocal() as db:
+        sub = db.get(Subscription, subscription_id)
+        assert "payment-1" in sub.renewal_error
+        assert db.query(Payment).count() == 0
+
+def test_result_write_is_retried_after_a_transient_failure(run, monkeypatch, charges):
+    subscription_id = due_subscription()
+    fail_completed_payment_commits(monkeypatch, times=1)
+
+    run(bot.process_auto_payment(subscription_id))
+
+    assert len(charges) == 1
+    with SessionLocal() as db:
+        sub = db.get(Subscription, subscription_id)
+        assert sub.renewal_error is None
+        assert sub.renewal_claimed_until is None
+        assert sub.next_payment_date.replace(tzinfo=datetime.timezone.utc) > datetime.datetime.now(datetime.timezone.utc)
+        assert db.query(Payment).filter(Payment.status == PaymentStatus.COMPLETED).count() == 1
@@ -0,0 +1,35 @@
+import datetime
+
+from sqlalchemy import select
+
+import bot
+from database import SessionLocal
+from models import Payment, PaymentMethod, PaymentStatus, Subscription, SubscriptionType, TariffPlan, User
+
+def test_purge_keeps_failed_renewals_of_paid_lapsed_subscription(run):
+    old = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=60)
+    with SessionLocal() as db:
+        user = User(telegram_id=1, email="user@example.com")
+        tariff = TariffPlan(type=SubscriptionType.BASIC, name="Базовый", price=1500, duration_days=30)
+
+        def subscription(*statuses):
+            sub = Subscription(user=user, tariff=tariff, start_date=old, end_date=old + datetime.timedelta(days=30),
+                               is_active=False)
+            for status in statuses:
+                db.add(Payment(user=user, subscription=sub, amount=1500, status=status,
+                               payment_method=PaymentMethod.CARD, created_at=old))
+            return sub
+
+        # Брошенная оплата и подписка, которая была оплачена, а потом не продлилась
+        abandoned = subscription(PaymentStatus.PENDING, PaymentStatus.FAILED)
+        lapsed = subscription(PaymentStatus.COMPLETED, PaymentStatus.FAILED)
+        db.add_all([abandoned, lapsed])
+        db.commit()
+        abandoned_id, lapsed_id = abandoned.id, lapsed.id
+
+    assert run(bot.purge_abandoned_checkouts()) == (2, 1)
+    with SessionLocal() as db:
+        assert db.scalars(select(Subscription.id)).all() == [lapsed_id]
+        assert sorted(db.scalars(select(Payment.status).where(Payment.subscription_id == lapsed_id)).all(),
+                      key=lambda status: status.value) == [PaymentStatus.COMPLETED, PaymentStatus.FAILED]
+        assert db.get(Subscription, abandoned_id) is None
@@ -0,0 +1,57 @@
+import datetime
+
+from aiogram.fsm.storage.base import StorageKey
+from sqlalchemy import func, select, update
+
+from database import SessionLocal
+from fsm_storage import SQLAlchemyStorage
+from models import FSMStorageRecord
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+
+def test_state_written_by_one_process_is_visible_to_another(run):
+    # Два экземпляра хранилища — два процесса бота
+    first = SQLAlchemyStorage(state_ttl=3600)
+    second = SQLAlchemyStorage(state_ttl=3600)
+
+    async def scenario():
+        await first.set_state(KEY, "Registration:waiting_for_email")
+        await first.set_data(KEY, {"user_id_to_update": 5})
+        assert await second.get_state(KEY) == "Registration:waiting_for_email"
+        assert await second.get_data(KEY) == {"user_id_to_update": 5}
+
+        # Следующий апдейт пришел во второй процесс — первый сразу видит изменение
+        await second.set_state(KEY, None)
+        assert await first.get_state(KEY) is None
+        assert await first.get_data(KEY) == {"user_id_to_update": 5}
+
+        await second.set_data(KEY, {})
+        assert await first.get_data(KEY) == {}
+
+    run(scenario())
+    with SessionLocal() as db:
+        # Пустая запись не хранится
+        assert db.scalar(select(func.count()).select_from(FSMStorageRecord)) == 0
+
+def test_expired_record_is_reset_on_write(run):
+    storage = SQLAlchemyStorage(state_ttl=3600)
+
+    async def prepare():
+        await storage.set_state(KEY, "Registration:waiting_for_email")
+        await storage.set_data(KEY, {"stale": True})
+
+    run(prepare())
+    with SessionLocal() as db:
+        db.execute(update(FSMStorageRecord).values(
+            updated_at=datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=2)
+        ))
+        db.commit()
+
+    async def scenario():
+        assert await storage.get_state(KEY) is None
+        await storage.set_state(KEY, "Registration:waiting_for_email")
+        # Данные брошенной записи не возвращаются вместе с новым состоянием
+        assert await storage.get_data(KEY) == {}
+        assert await storage.purge_expired() == 0
+
+    run(scenario())
@@ -0,0 +1,114 @@
+import contextlib
+import datetime
+import re
+
+import pytest
+from sqlalchemy import event
+
+import analytics
+import bot
+import models
+from admin_panel.app import app
+from database import async_engine, engine, get_async_db
+from models import Payment, Subscription, TariffPlan, User
+from payment_scheduler import PaymentScheduler
+
+USERS = 3000
+
+@pytest.fixture(autouse=True)
+def data():
+    """
+    Данные с типичным распределением и статистика ANALYZE: без них SQLite
+    выбирает индекс наугад, и проверка плана ничего не показывает.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with engine.begin() as conn:
+        conn.execute(TariffPlan.__table__.insert(), [dict(id=1, type='BASIC', name="Базовый", price=1500, duration_days=30)])
+        conn.execute(User.__table__.insert(), [
+            dict(id=i, telegram_id=10 ** 9 + i, email=f"user{i}@example.com", telegram_username=f"name{i}",
+                 registration_date=now - datetime.timedelta(minutes=i))
+            for i in range(1, USERS + 1)
+        ])
+        conn.execute(Subscription.__table__.insert(), [
+            dict(id=i, user_id=i, tariff_id=1, start_date=now - datetime.timedelta(days=100),
+                 end_date=now + datetime.timedelta(days=i % 90 - 60), is_active=i % 3 != 0,
+                 auto_renewal=i % 2 == 0, rebill_id="rebill" if i % 2 == 0 else None,
+                 next_payment_date=now + datetime.timedelta(days=i % 90 - 60))
+            for i in range(1, USERS + 1)
+        ])
+        # Почти все платежи завершены; незавершенные свежие — сверка не обращается к шлюзу
+        conn.execute(Payment.__table__.insert(), [
+            dict(id=i, user_id=i % USERS + 1, subscription_id=i % USERS + 1, amount=1500, payment_method='CARD',
+                 status='PENDING' if i % 50 == 0 else 'FAILED' if i % 10 == 0 else 'COMPLETED',
+                 external_id=str(i), created_at=now if i % 50 == 0 else now - datetime.timedelta(minutes=i),
+                 completed_at=now - datetime.timedelta(minutes=i))
+            for i in range(1, 3 * USERS + 1)
+        ])
+        conn.exec_driver_sql("ANALYZE")
+    yield
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DELETE FROM sqlite_stat1")
+
+@contextlib.contextmanager
+def captured():
+    """SELECT-запросы (текст и параметры), выполненные кодом внутри блока через любой из движков."""
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    engines = [engine, models.engine, async_engine.sync_engine]
+    for target in engines:
+        event.listen(target, "before_cursor_execute", capture)
+    try:
+        yield statements
+    finally:
+        for target in engines:
+            event.remove(target, "before_cursor_execute", capture)
+
+def plans(statements) -> list[str]:
+    with engine.connect() as conn:
+        return [
+            "\n".join(row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", tuple(parameters)))
+            for statement, parameters in statements
+        ]
+
+def assert_uses(statements, *indexes):
+    found = plans(statements)
+    for index in indexes:
+        assert any(re.search(rf"INDEX {index}\b", plan) for plan in found), f"{index} не используется:\n" + "\n\n".join(found)
+
+def test_scheduler_load_uses_renewal_due_index(run):
+    scheduler = PaymentScheduler(datetime.timedelta(seconds=120), reload_interval=3600, charge_concurrency=1)
+    with captured() as statements:
+        run(scheduler.reload())
+    assert_uses(statements, "idx_sub_renewal_due")
+
+def test_reconcile_page_uses_pending_index(run):
+    with captured() as statements:
+        run(bot.reconcile_pending_payments())
+    assert_uses(statements, "idx_payment_pending")
+
+def test_revenue_rollup_uses_completed_index(run):
+    async def compute():
+        async with get_async_db() as db:
+            await analytics.compute_day(db, datetime.date.today() - datetime.timedelta(days=1))
+
+    with captured() as statements:
+        run(compute())
+    assert_uses(statements, "idx_payment_completed")
+
+@pytest.mark.parametrize("url, indexes", [
+    ("/users", ["idx_user_registration"]),
+    ("/users?q=user12", ["idx_user_email_prefix", "idx_user_username_prefix"]),
+    ("/users?sort=subscription_end", ["idx_sub_active_end"]),
+    ("/subscriptions", ["idx_sub_active_end"])
+])
+def test_admin_queries_use_indexes(url, indexes):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    with captured() as statements:
+        assert client.get(url).status_code == 200
+    assert_uses(statements, *indexes)
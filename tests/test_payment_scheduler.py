@@ -0,0 +1,77 @@
+import asyncio
+import datetime
+
+from sqlalchemy import update
+
+from database import SessionLocal
+from models import Subscription, SubscriptionType, TariffPlan, User
+from payment_scheduler import PaymentScheduler
+
+def make_scheduler(**kwargs) -> PaymentScheduler:
+    return PaymentScheduler(datetime.timedelta(seconds=1), reload_interval=3600, charge_concurrency=2, **kwargs)
+
+def create_subscription(next_payment_date: datetime.datetime) -> int:
+    """Подписка с автопродлением, записанная в обход планировщика — как это делает другой процесс."""
+    with SessionLocal() as db:
+        user = User(telegram_id=1, email="user@example.com")
+        tariff = TariffPlan(type=SubscriptionType.BASIC, name="Базовый", price=1500, duration_days=30)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        sub = Subscription(
+            user=user, tariff=tariff, start_date=now - datetime.timedelta(days=30), end_date=now + datetime.timedelta(days=1),
+            is_active=True, auto_renewal=True, rebill_id="rebill", next_payment_date=next_payment_date
+        )
+        db.add(sub)
+        db.commit()
+        return sub.id
+
+def test_refresh_without_running_scheduler_is_noop(run):
+    scheduler = make_scheduler()
+    subscription_id = create_subscription(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=5))
+
+    run(scheduler.refresh(subscription_id))
+    # Процесс без лидерства не копит события, которые никто не обработает
+    assert scheduler.stats()["heap_size"] == 0
+
+def charge_time(run, scheduler: PaymentScheduler, change) -> datetime.datetime:
+    """Запускает планировщик, вносит change в БД в обход него и ждет списания."""
+    charged = asyncio.Event()
+    charged_at = []
+
+    async def on_notify(subscription_ids):
+        pass
+
+    async def on_charge(subscription_id):
+        charged_at.append(datetime.datetime.now(datetime.timezone.utc))
+        charged.set()
+
+    async def scenario():
+        scheduler.start(on_notify, on_charge)
+        try:
+            await asyncio.sleep(0.2)  # расписание загружено до изменения
+            change()
+            await asyncio.wait_for(charged.wait(), 10)
+        finally:
+            await scheduler.stop()
+
+    run(scenario())
+    return charged_at[0]
+
+def test_subscription_created_in_another_process_is_charged_when_due(run):
+    scheduler = make_scheduler(changes_interval=0.2)
+    due = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=2)
+
+    charged_at = charge_time(run, scheduler, lambda: create_subscription(due))
+    assert due <= charged_at < due + datetime.timedelta(seconds=1)
+
+def test_subscription_moved_in_another_process_is_charged_when_due(run):
+    subscription_id = create_subscription(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=30))
+    scheduler = make_scheduler(changes_interval=0.2)
+    due = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=2)
+
+    def change():
+        with SessionLocal() as db:
+            db.execute(update(Subscription).where(Subscription.id == subscription_id).values(next_payment_date=due))
+            db.commit()
+
+    charged_at = charge_time(run, scheduler, change)
+    assert due <= charged_at < due + datetime.timedelta(seconds=1)
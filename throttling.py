@@ -0,0 +1,80 @@
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update, User
+
+logger = logging.getLogger(__name__)
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Ограничение частоты обновлений от одного пользователя (token bucket).
+
+    На пользователя хранится три значения: остаток токенов, время
+    последнего пересчета и флаг «предупреждение уже отправлено». Записи
+    пользователей, чей bucket полностью восстановился, периодически
+    удаляются. Регистрируется на уровне update до FSM-middleware, поэтому
+    отклоненное обновление не трогает ни хранилище состояний, ни обработчики.
+    """
+
+    def __init__(self, requests: int, period: int, sweep_interval: int = 60):
+        self.capacity = float(requests)
+        self.rate = requests / period
+        self.sweep_interval = sweep_interval
+        self._buckets: Dict[int, list] = {}
+        self._last_sweep = time.monotonic()
+        self.rejected = 0
+
+    def _allow(self, user_id: int, now: float) -> tuple[bool, bool]:
+        """Возвращает (разрешено, нужно ли предупредить пользователя)."""
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            self._buckets[user_id] = [self.capacity - 1, now, False]
+            return True, False
+        tokens = min(self.capacity, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            bucket[2] = False
+            return True, False
+        bucket[0] = tokens
+        warn = not bucket[2]
+        bucket[2] = True
+        return False, warn
+
+    def _sweep(self, now: float):
+        self._last_sweep = now
+        full_after = self.capacity / self.rate
+        self._buckets = {
+            user_id: bucket for user_id, bucket in self._buckets.items()
+            if now - bucket[1] < full_after
+        }
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user: User | None = data.get("event_from_user")
+        if not isinstance(event, Update) or user is None or not (event.message or event.callback_query):
+            return await handler(event, data)
+
+        now = time.monotonic()
+        if now - self._last_sweep > self.sweep_interval:
+            self._sweep(now)
+
+        allowed, warn = self._allow(user.id, now)
+        if allowed:
+            return await handler(event, data)
+
+        self.rejected += 1
+        logger.warning(f"Throttled update {event.update_id} from user {user.id}")
+        text = "⏳ Слишком много запросов. Пожалуйста, подождите немного и попробуйте снова."
+        if event.callback_query:
+            # Ответ на callback обязателен, иначе кнопка «зависнет»
+            await event.callback_query.answer(text if warn else None, show_alert=warn)
+        elif warn:
+            await event.message.answer(text)
+        return None